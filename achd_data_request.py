@@ -1,12 +1,112 @@
 from ckanapi import RemoteCKAN
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import hashlib
 import json
+import logging
 import time
 import os
+import random
+import sys
+import threading
+
+logger = logging.getLogger('sniff.achd')
 
 output_dir = "achd_updates"
 
-rc = RemoteCKAN('https://data.wprdc.org/')
+# Point ACHD_CKAN_URL at a local fake_ckan.py server to run the import offline
+CKAN_URL = os.getenv('ACHD_CKAN_URL', 'https://data.wprdc.org/')
+RESOURCE_ID = "36fb4629-8003-4acc-a1ca-3302778a530d"
+REQUEST_TIMEOUT = 30  # seconds
+
+# Backfill: missing hours are fetched in ranges by a bounded pool of workers,
+# each range retried with exponential backoff before its hours count as failed
+BACKFILL_WORKERS = int(os.getenv('ACHD_BACKFILL_WORKERS', '8'))
+BACKFILL_RANGE_HOURS = int(os.getenv('ACHD_BACKFILL_RANGE_HOURS', '24'))
+BACKFILL_RETRIES = 4
+BACKFILL_BACKOFF = 1.0  # seconds before the first retry, doubled each time
+BACKFILL_MAX_HOURS = int(os.getenv('ACHD_BACKFILL_MAX_HOURS', str(14 * 24)))
+
+# An hour that still has no data this long after it ended is taken to have
+# none; more recent empty hours may not be published yet
+FINAL_AFTER = datetime.timedelta(hours=int(os.getenv('ACHD_FINAL_AFTER_HOURS', '48')))
+
+# requests sessions are not thread-safe, so each worker gets its own client
+ckan_clients = threading.local()
+
+def ckan_client():
+    client = getattr(ckan_clients, 'client', None)
+    if client is None:
+        client = ckan_clients.client = RemoteCKAN(CKAN_URL)
+    return client
+
+# Optional on-disk cache of the raw CKAN records, one file per hour, so any
+# range (whatever the checkpoint or ACHD_BACKFILL_RANGE_HOURS) is served from
+# the hours it covers. Hours that are final (see FINAL_AFTER) are kept for
+# good under final/; newer ones go under recent/ and are refetched and
+# pruned after CACHE_TTL seconds.
+CACHE_DIR = os.getenv('ACHD_CACHE_DIR') or None
+CACHE_TTL = int(os.getenv('ACHD_CACHE_TTL', '900'))
+
+# Replay: answer every request from the cache, whatever its age, and never
+# touch the network, so the import can run (and be benchmarked) offline
+REPLAY = os.getenv('ACHD_REPLAY') == '1'
+
+class CacheMiss(Exception):
+    """A request in replay mode that is not in the cache"""
+
+def cache_path(kind, hour):
+    """File for one hour's records; the directory changes with the resource and parameters fetched"""
+    query = json.dumps({"resource": RESOURCE_ID, "parameters": sorted(PARAM_MAP)}, separators=(',', ':'))
+    namespace = hashlib.sha256(query.encode()).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, kind, namespace, hour.strftime("%Y-%m-%d"), hour.strftime("%H") + ".json")
+
+def read_cache(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_cache(path, entry):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def read_cached_hour(hour):
+    """Cached records for the hour starting at hour, or None if missing or expired"""
+    entry = read_cache(cache_path("final", hour))
+    if entry is None:
+        entry = read_cache(cache_path("recent", hour))
+        if entry is not None and not REPLAY and time.time() - entry["fetched_at"] >= CACHE_TTL:
+            entry = None
+    return None if entry is None else entry["records"]
+
+def write_cached_hour(hour, records):
+    final = datetime.datetime.now() - (hour + datetime.timedelta(hours=1)) >= FINAL_AFTER
+    write_cache(cache_path("final" if final else "recent", hour), {"fetched_at": time.time(), "records": records})
+
+def call_ckan(action, data_dict):
+    return ckan_client().call_action(action, data_dict, requests_kwargs={"timeout": REQUEST_TIMEOUT})
+
+def prune_cache():
+    """Delete recent cache entries older than CACHE_TTL; returns how many were removed"""
+    if not CACHE_DIR or REPLAY:
+        return 0
+    removed = 0
+    cutoff = time.time() - CACHE_TTL
+    for directory, _, filenames in os.walk(os.path.join(CACHE_DIR, "recent")):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
 
 location_map = {
     "Fulton St. Fridge": (40.449895, -80.023159),
@@ -62,47 +162,120 @@ def calculate_location_id(lat, lon):
     lon_int = int(lon * 1000000)
     return lat_int ^ lon_int
 
-def get_hour_measurements(date, hour):
-    print("Getting data for date "+str(date)+" hour "+str(hour))
-    
-    query_date = f"{date}T{hour:02d}:00:00"
-
-    dt = datetime.datetime.fromisoformat(query_date).replace(tzinfo=datetime.timezone.utc)
-
-    epoch_seconds = int(dt.timestamp())
-   
-    result = rc.action.datastore_search(
-        resource_id="36fb4629-8003-4acc-a1ca-3302778a530d",
-        filters={
-            "is_valid": "True",
-            "parameter": [
-        "NOX",
-        "PM10", "PM10A", "PM10B", "PM10_640", "PM10RAW", "PM10_FL",
-        "PM25", "PM25(2)", "PM25B", "PM25RAW", "PM25T", "PM25_FL", "PM25_640",
-        "OUT_T", "OUT_RH", "RH%",
-    ],
-            "datetime_est" : query_date
-            
+# Rows per request; CKAN silently caps datastore_search at 100 rows unless
+# a limit is given, and datastore_search_sql at its rows_max (32000 by default)
+PAGE_ROWS = int(os.getenv('ACHD_PAGE_ROWS', '10000'))
+
+# 'sql' pulls a time range with datastore_search_sql; 'search' pages through
+# datastore_search for CKAN instances that do not allow SQL
+FETCH_METHOD = os.getenv('ACHD_FETCH_METHOD', 'sql')
+
+def hour_key(datetime_est):
+    """Start of the hour a datetime_est value falls in, as a naive datetime"""
+    return datetime.datetime.fromisoformat(str(datetime_est).replace(' ', 'T')[:19]).replace(minute=0, second=0)
+
+def search_sql(start_hour, end_hour, offset):
+    """One page of the range query for start_hour <= datetime_est < end_hour"""
+    parameters = ", ".join(f"'{param}'" for param in PARAM_MAP)
+    sql = (
+        f'SELECT "_id", "site", "parameter", "datetime_est", "report_value" FROM "{RESOURCE_ID}" '
+        f'WHERE "is_valid" = \'True\' AND "parameter" IN ({parameters}) '
+        f'AND "datetime_est" >= \'{start_hour.isoformat()}\' AND "datetime_est" < \'{end_hour.isoformat()}\' '
+        f'ORDER BY "_id" LIMIT {PAGE_ROWS} OFFSET {offset}'
+    )
+    result = call_ckan("datastore_search_sql", {"sql": sql})
+    return result['records']
+
+def search_page(start_hour, end_hour, offset):
+    """One page of datastore_search filtered to every hour in the range"""
+    hours = []
+    hour = start_hour
+    while hour < end_hour:
+        hours.append(hour.isoformat())
+        hour += datetime.timedelta(hours=1)
+
+    result = call_ckan(
+        "datastore_search",
+        {
+            "resource_id": RESOURCE_ID,
+            "filters": {
+                "is_valid": "True",
+                "parameter": list(PARAM_MAP),
+                "datetime_est": hours
             },
-        q = "2025"
+            "fields": ["_id", "site", "parameter", "datetime_est", "report_value"],
+            "sort": "_id",
+            "limit": PAGE_ROWS,
+            "offset": offset,
+            "include_total": False
+        }
     )
+    return result['records']
+
+def fetch_records(start_hour, end_hour, method=None):
+    """Every valid record for the PARAM_MAP parameters in [start_hour, end_hour), all pages"""
+    fetch_page = search_sql if (method or FETCH_METHOD) == 'sql' else search_page
+    offset = 0
+    while True:
+        records = fetch_page(start_hour, end_hour, offset)
+        yield from records
+        if len(records) < PAGE_ROWS:
+            return
+        offset += len(records)
 
-    # Build combined records per (site, query_date)
+def range_records(start_hour, end_hour, method=None):
+    """
+    Every record in [start_hour, end_hour), through the cache when CACHE_DIR
+    is set: cached hours are read from disk and only the span from the first
+    to the last uncached hour is fetched, then stored hour by hour
+    """
+    if not CACHE_DIR:
+        if REPLAY:
+            raise CacheMiss("replay needs ACHD_CACHE_DIR")
+        return list(fetch_records(start_hour, end_hour, method))
+
+    hours = []
+    hour = start_hour
+    while hour < end_hour:
+        hours.append(hour)
+        hour += datetime.timedelta(hours=1)
+
+    cached = {hour: read_cached_hour(hour) for hour in hours}
+    missing = [hour for hour in hours if cached[hour] is None]
+    if missing:
+        if REPLAY:
+            raise CacheMiss(f"ACHD hour {missing[0].isoformat()} is not cached")
+        fetched = {}
+        for record in fetch_records(missing[0], missing[-1] + datetime.timedelta(hours=1), method):
+            fetched.setdefault(hour_key(record.get("datetime_est")), []).append(record)
+        for hour in hours:
+            if missing[0] <= hour <= missing[-1]:
+                cached[hour] = fetched.get(hour, [])
+                write_cached_hour(hour, cached[hour])
+
+    return [record for hour in hours for record in cached[hour]]
+
+def pivot_records(records):
+    """
+    Combine (site, parameter, hour) records into one reading per site and
+    hour, in a single pass
+    Returns {hour start: [readings]}
+    """
     combined_records = {}
 
-    for r in result['records']:
+    for r in records:
         site = r.get("site")
         if site not in location_map:
             continue
-        lat, lon = location_map[site]
-        location_id = calculate_location_id(lat, lon)
 
-        key = (site, query_date)
+        key = (site, hour_key(r.get("datetime_est")))
 
-        if key not in combined_records:
-            combined_records[key] = {
-                "id": location_id,
-                "t": epoch_seconds,
+        reading = combined_records.get(key)
+        if reading is None:
+            lat, lon = location_map[site]
+            reading = combined_records[key] = {
+                "id": calculate_location_id(lat, lon),
+                "t": int(key[1].replace(tzinfo=datetime.timezone.utc).timestamp()),
                 "la": round(lat, 5),
                 "lo": round(lon, 5),
                 "pm1": -1,
@@ -121,9 +294,7 @@ def get_hour_measurements(date, hour):
                 "rh": -1,
                 "src": 0
             }
-            print(combined_records[key])
 
-        
         param = r.get("parameter")
         if param not in PARAM_MAP:
             continue
@@ -134,25 +305,138 @@ def get_hour_measurements(date, hour):
         if value is not None:
             # Insert the fetched measurement in the proper field
             if field in ["pm10", "pm25", "tmp"]:
-                combined_records[key][field] = round(float(value), 1)
+                reading[field] = round(float(value), 1)
             elif field in ["rh", "n"]:
-                combined_records[key][field] = round(float(value), 2)
+                reading[field] = round(float(value), 2)
 
-    return list(combined_records.values())
+    by_hour = {}
+    for (site, hour), reading in combined_records.items():
+        by_hour.setdefault(hour, []).append(reading)
+    return by_hour
 
-def write_json(records, filename):
+def get_range_measurements(start_hour, end_hour, method=None):
+    """
+    Readings for every hour in [start_hour, end_hour), fetched as one range
+    Returns {hour start: [readings]}, with an empty list for hours without data
+    """
+    logger.debug("Getting ACHD data", extra={'start': start_hour.isoformat(), 'end': end_hour.isoformat()})
+
+    by_hour = pivot_records(range_records(start_hour, end_hour, method))
+
+    hours = {}
+    hour = start_hour
+    while hour < end_hour:
+        hours[hour] = by_hour.get(hour, [])
+        hour += datetime.timedelta(hours=1)
+    return hours
+
+def get_hour_measurements(date, hour):
+
+    start_hour = datetime.datetime.fromisoformat(f"{date}T{hour:02d}:00:00")
+    return get_range_measurements(start_hour, start_hour + datetime.timedelta(hours=1))[start_hour]
+
+def write_json(records, filename, directory=None):
+    """Write records as a JSON array, replacing the file atomically"""
     if not records:
-        print("not records")
         return
-    with open(output_dir + "/"+ filename, "a") as f:
-        f.write("[")
-        for r in records:
-            json.dump(r,f, indent=4)
-            f.write(",")
-        f.write("]")
-        print("Wrote to "+str(filename))
-
-def collect_data():
+    directory = directory or output_dir
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, filename)
+    with open(path + ".tmp", "w") as f:
+        json.dump(records, f, indent=4)
+    os.replace(path + ".tmp", path)
+    logger.debug("Wrote ACHD hour", extra={'path': path})
+
+def archive_hour(hour, records, directory=None):
+    """Keep a copy of one hour's readings as achd_update_date_<date>_hour_<hour>.json"""
+    write_json(records, f"achd_update_date_{hour.strftime('%Y-%m-%d')}_hour_{hour.hour}.json", directory)
+
+def fetch_range(start_hour, end_hour, retries=BACKFILL_RETRIES, backoff=BACKFILL_BACKOFF):
+    """
+    get_range_measurements for [start_hour, end_hour), retried with
+    exponential backoff and jitter; raises the last error if every attempt fails
+    """
+    for attempt in range(retries + 1):
+        try:
+            return get_range_measurements(start_hour, end_hour)
+        except CacheMiss:
+            raise
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning("ACHD fetch failed, retrying", extra={
+                'start': start_hour.isoformat(), 'end': end_hour.isoformat(), 'error': str(e), 'retry_in': round(delay, 1)
+            })
+            time.sleep(delay)
+
+def missing_hours(last_processed, now, max_hours=BACKFILL_MAX_HOURS):
+    """Start of every hour after last_processed up to now, oldest first"""
+    hours = []
+    next_hour = last_processed + datetime.timedelta(hours=1)
+    while next_hour <= now and len(hours) < max_hours:
+        hours.append(next_hour)
+        next_hour += datetime.timedelta(hours=1)
+    return hours
+
+def iter_backfill(last_processed, now, workers=BACKFILL_WORKERS, retries=BACKFILL_RETRIES, backoff=BACKFILL_BACKOFF,
+                  range_hours=BACKFILL_RANGE_HOURS):
+    """
+    Fetch every missing hour after last_processed, in ranges of range_hours
+    fetched concurrently, and yield (hour start, readings) oldest first as
+    soon as each hour and all hours before it are in
+    Stops at the first hour that failed or may not be published yet, so the
+    hours yielded are always contiguous and complete; the rest are left for
+    the next run
+    """
+    hours = missing_hours(last_processed, now)
+    ranges = [hours[i:i + range_hours] for i in range(0, len(hours), range_hours)]
+    pruned = prune_cache()
+    if pruned:
+        logger.info("Pruned expired ACHD cache entries", extra={'entries': pruned})
+
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = [
+            pool.submit(fetch_range, chunk[0], chunk[-1] + datetime.timedelta(hours=1), retries, backoff)
+            for chunk in ranges
+        ]
+        for chunk, future in zip(ranges, futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error("Giving up on ACHD hours", extra={'start': chunk[0].isoformat(), 'end': chunk[-1].isoformat(), 'error': str(e)})
+                return
+
+            for hour in chunk:
+                if not results[hour] and now - (hour + datetime.timedelta(hours=1)) < FINAL_AFTER:
+                    logger.info("No ACHD data yet", extra={'hour': hour.isoformat()})
+                    return
+                yield hour, results[hour]
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def backfill(last_processed, now, **kwargs):
+    """
+    iter_backfill collected into (completed, results): the hours fetched,
+    oldest first, and their readings by hour
+    """
+    results = dict(iter_backfill(last_processed, now, **kwargs))
+    return list(results), results
+
+def save_last_processed(last_processed_file, last_processed):
+    """Replace the checkpoint file atomically, so a crash never leaves it half written"""
+    tmp_file = last_processed_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(last_processed.isoformat())
+    os.replace(tmp_file, last_processed_file)
+
+def collect_data(workers=BACKFILL_WORKERS):
+    """
+    Standalone run: fetch the missing hours into JSON files in output_dir,
+    tracked by output_dir/last_processed.txt
+    The app imports straight into the database instead (see collect_achd_data)
+    """
     os.makedirs(output_dir, exist_ok=True)
     last_processed_file = os.path.join(output_dir, "last_processed.txt")
 
@@ -167,43 +451,18 @@ def collect_data():
         # If no record exists, start from midnight today
         last_processed = datetime.datetime(now.year, now.month, now.day, 0)
 
-    # Process all hours between last processed and current hour
-    next_hour = last_processed + datetime.timedelta(hours=1)
-    last_processed_hour = None
-    
-    while next_hour <= now:
-        date_str = next_hour.strftime("%Y-%m-%d")
-        hour = next_hour.hour
-        data = get_hour_measurements(date_str, hour)
-        if data:
-            filename = f"achd_update_date_{date_str}_hour_{hour}.json"
-            write_json(data, filename)
-            last_processed_hour = (date_str, hour, filename)
-            next_hour += datetime.timedelta(hours=1)
-        else:
-            print(f"No data for {date_str} hour {hour}")
-            break
-        
-    # Save the last processed hour
-    with open(last_processed_file, "w") as f:
-        f.write((next_hour - datetime.timedelta(hours=1)).isoformat())
-    
-    # Delete all old files except the last processed hour
-    if last_processed_hour:
-        last_filename = last_processed_hour[2]
-        print(f"\n🧹 Cleaning up old files (keeping only {last_filename})...")
-        
-        for filename in os.listdir(output_dir):
-            filepath = os.path.join(output_dir, filename)
-            # Skip the last processed file, the tracking file, and non-json files
-            if filename == last_filename or filename == "last_processed.txt" or not filename.endswith(".json"):
-                continue
-            
-            try:
-                os.remove(filepath)
-                print(f"   Deleted: {filename}")
-            except Exception as e:
-                print(f"   Error deleting {filename}: {e}")
+    # Write each hour as it arrives, then move the checkpoint past it
+    processed = 0
+    for hour, records in iter_backfill(last_processed, now, workers=workers):
+        archive_hour(hour, records)
+        save_last_processed(last_processed_file, hour)
+        processed += 1
+
+    logger.info("Processed ACHD hours", extra={'hours': processed, 'after': last_processed.isoformat()})
 
 if __name__ == "__main__":
-    collect_data()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if len(sys.argv) > 1:
+        collect_data(workers=int(sys.argv[1]))
+    else:
+        collect_data()
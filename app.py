@@ -1,16 +1,51 @@
-from flask import Flask, json, request, jsonify, render_template, send_from_directory
+from flask import Flask, Response, json, request, jsonify, render_template, send_from_directory, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, timedelta
 import os
 import time
 from dotenv import load_dotenv
 import re
-from math import radians, cos, sin, asin, sqrt
+from math import radians, cos
 import threading
+import hashlib
+import base64
+import click
+import csv
+import io
+import socket
+import contextlib
+import contextvars
+import logging
 
-# Load environment variables
+# Load environment variables before the app's modules: prometheus_client
+# (imported by metrics) picks multiprocess mode from PROMETHEUS_MULTIPROC_DIR
+# when it is imported
 load_dotenv()
 
+from geo import haversine_distance, k_nearest, nearest_within, radius_bounds, GridIndex
+from broadcast import Broadcaster
+from aqi import max_aqi
+from tiles import TileCache, tile_bounds, tiles_for_point
+from arrow_export import ChunkSink, record_batch, write_batches
+from frames import FRAME_SIZE, decode_frame, decode_frames, columns_to_readings
+from scheduler import Job, Scheduler
+from migrations import Migrator
+from notifications import ChangeListener, notify_change
+from logs import sampled, setup_logging
+import metrics
+from metrics import TimedQueuePool, WEBHOOK_STAGES
+import prometheus_client
+from prometheus_client.core import GaugeMetricFamily
+
+# JSON log lines, written by a background thread (see logs.py)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Fraction of uplinks whose raw and parsed payloads are logged
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+setup_logging(LOG_LEVEL)
+logger = logging.getLogger('sniff')
+
 # Configure Flask to find templates and static files
 app = Flask(__name__, static_folder='.', template_folder='.')
 
@@ -21,27 +56,326 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
 )
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Connection pool of each process. Every web worker and the job runner has its
+# own, so workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW + 1 for the change
+# listener) plus the job runner's must stay under the server's
+# max_connections. Under gthread workers keep DB_POOL_SIZE at least the
+# threads per worker so requests do not wait for a connection.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '5'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': TimedQueuePool,  # Reports checkout waits to /metrics
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,  # Outlive idle timeouts in proxies and the server
+        'pool_pre_ping': True,  # Replace connections dropped while idle, e.g. by a database restart
+    }
+elif ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI']:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': TimedQueuePool}
+
+# Webhook ingestion mode: 'direct' writes each uplink in its own transaction,
+# 'batch' queues validated uplinks and upserts them in micro-batches
+INGEST_MODE = os.getenv('INGEST_MODE', 'direct')
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '500'))
+INGEST_BATCH_WAIT_MS = int(os.getenv('INGEST_BATCH_WAIT_MS', '200'))
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '10000'))
+
 db = SQLAlchemy(app)
 
-def haversine_distance(lat1, lon1, lat2, lon2):
+# Set METRICS_ENABLED=0 to skip recording metrics (/metrics still answers)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+
+def time_stage(stage, since):
+    """Record a /tts-webhook stage that began at since (perf_counter); returns now"""
+    now = time.perf_counter()
+    if METRICS_ENABLED:
+        WEBHOOK_STAGES[stage].observe(now - since)
+    return now
+
+class StatementTally:
+    """Database statements and time of one request"""
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+# The current request's tally; a context variable rather than flask.g,
+# whose proxy lookups cost several times the rest of a statement's hooks
+request_statements = contextvars.ContextVar('request_statements', default=None)
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    context.metrics_started = time.perf_counter()
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if not METRICS_ENABLED:
+        return
+    elapsed = time.perf_counter() - context.metrics_started
+    metrics.DB_QUERY_SECONDS.observe(elapsed)
+    tally = request_statements.get()
+    if tally is not None:
+        tally.queries += 1
+        tally.seconds += elapsed
+
+with app.app_context():
+    db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    db.event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+
+@app.before_request
+def start_request_metrics():
+    request_statements.set(StatementTally())
+
+@app.after_request
+def record_request_metrics(response):
+    """Database statements and time per request, by endpoint"""
+    tally = request_statements.get()
+    if METRICS_ENABLED and tally is not None:
+        endpoint = request.endpoint or 'none'
+        metrics.DB_QUERIES_PER_REQUEST.labels(endpoint=endpoint).observe(tally.queries)
+        metrics.DB_SECONDS_PER_REQUEST.labels(endpoint=endpoint).observe(tally.seconds)
+    return response
+
+@app.teardown_request
+def end_request_metrics(exc):
+    # Statements a thread runs between requests belong to none of them
+    request_statements.set(None)
+
+# Version of the readings data, changed after every committed write so
+# /api/data/latest can answer conditional GETs without a query. A process
+# counts its own changes, and the epoch keeps ETags from an earlier run from
+# matching after a restart. With change notifications (PostgreSQL, see
+# apply_change) the version is instead the one the last notification
+# carried, which every worker received in the same order, so all workers
+# give the same ETag for the same data.
+DATA_VERSION_EPOCH = format(time.time_ns() // 1000000, 'x')
+data_version = 0
+shared_data_version = None
+data_version_lock = threading.Lock()
+
+def bump_data_version(shared=None):
+    """Mark the readings data as changed; shared is a notification's version"""
+    global data_version, shared_data_version
+    with data_version_lock:
+        data_version += 1
+        shared_data_version = shared
+        return data_version
+
+def data_etag(version=None):
+    shared = shared_data_version
+    if version is None and shared is not None:
+        return shared
+    return f"{DATA_VERSION_EPOCH}-{data_version if version is None else version}"
+
+# Web workers and the job runner are separate processes. With
+# SHARED_CHANGES=1 on PostgreSQL each write queues a change notification in
+# its own transaction, and every web worker applies the committed changes it
+# receives (data version, tiles, nearby index, stream) from its change
+# listener. Off by default: NOTIFY makes commits take a global lock, so
+# webhook commits run one at a time. Otherwise each process applies only its
+# own writes, straight after the commit.
+SHARED_CHANGES = (
+    os.getenv('SHARED_CHANGES', '0') == '1'
+    and app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres')
+)
+
+# Live feed of committed readings for /api/stream subscribers
+STREAM_HEARTBEAT_SECONDS = 15
+
+def gevent_patched():
+    """Whether gevent has patched threading, as in gunicorn's gevent workers"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+# An open stream holds a whole thread unless the server runs on gevent, so
+# elsewhere /api/stream answers 204 and clients poll /api/data/changes
+# instead. STREAM_ENABLED=1 or 0 overrides this.
+STREAM_ENABLED = os.getenv('STREAM_ENABLED', '')
+reading_stream = Broadcaster(history=int(os.getenv('STREAM_HISTORY', '1000')))
+
+def announce_readings(rows):
     """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
-    Returns distance in meters
+    Run before committing a write of readings (dicts of READING_FIELDS): with
+    shared changes, queue them for every process in the same transaction
     """
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    
-    # Haversine formula
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    
-    # Radius of earth in meters
-    r = 6371000
-    
-    return c * r
+    if SHARED_CHANGES:
+        notify_change(db.session, os.urandom(8).hex(), rows)
+
+def readings_committed(rows):
+    """Run after the commit; without shared changes this process applies them"""
+    if not SHARED_CHANGES:
+        apply_readings(rows)
+
+def apply_readings(rows, version=None):
+    """
+    Change the data version, evict the readings' cached tiles, update the
+    nearby index and push them to stream subscribers
+    """
+    bump_data_version(version)
+    invalidate_tiles(rows)
+
+    now = time.time()
+    for row in rows:
+        index_reading(row['id'], row['la'], row['lo'], row['t'])
+        if row['la'] == -1 or row['lo'] == -1 or row['t'] is None:
+            continue
+        reading_stream.publish('reading', {**row, 'age_hours': (now - row['t']) / 3600})
+
+def readings_deleted():
+    """Run after committing deletes of readings"""
+    if SHARED_CHANGES:
+        notify_change(db.session, os.urandom(8).hex(), deleted=True)
+        db.session.commit()
+    else:
+        apply_deletes()
+
+def apply_deletes(version=None):
+    """Change the data version and drop every cached tile and old nearby entry"""
+    bump_data_version(version)
+    tile_cache.clear()
+    # Deleted rows are all older than the nearby window
+    nearby_index.prune(int(time.time()) - NEARBY_WINDOW_SECONDS)
+
+def apply_change(message):
+    """Apply a change notification from any process, this one included"""
+    if message.get('deleted'):
+        apply_deletes(message['version'])
+    else:
+        apply_readings(message['rows'], message['version'])
+
+def changes_missed():
+    """
+    The change listener started listening and may have missed notifications:
+    switch to a version of this process's own, drop the tiles, reload the
+    nearby index on next use and tell stream subscribers to reload
+    """
+    global nearby_index_loaded
+    bump_data_version()
+    tile_cache.clear()
+    nearby_index_loaded = False
+    reading_stream.publish('reset', {})
+
+change_listener = None
+change_listener_lock = threading.Lock()
+
+@app.before_request
+def start_change_listener():
+    """Start this process's change listener once, with shared changes only"""
+    global change_listener
+    if not SHARED_CHANGES or (change_listener is not None and change_listener.is_alive()):
+        return
+    with change_listener_lock:
+        if change_listener is not None and change_listener.is_alive():
+            return
+        engine = db.create_engine(app.config['SQLALCHEMY_DATABASE_URI'], poolclass=db.NullPool)
+        change_listener = ChangeListener(engine, apply_change, changes_missed)
+        change_listener.start()
+
+# Readings older than this are never matched by find_nearby_reading
+NEARBY_WINDOW_SECONDS = 24 * 60 * 60
+
+# In-memory grid over recent reading locations, so nearby lookups only
+# measure readings in neighbouring cells. Each process keeps its own copy,
+# warmed from the database on first use and updated by every write (from
+# any process, with shared changes).
+nearby_index = GridIndex(cell_deg=float(os.getenv('NEARBY_INDEX_CELL_DEG', '0.001')))
+nearby_index_loaded = False
+nearby_index_lock = threading.Lock()
+
+def load_nearby_index():
+    """Fill the nearby index from readings in the last NEARBY_WINDOW_SECONDS"""
+    global nearby_index_loaded
+    with nearby_index_lock:
+        if nearby_index_loaded:
+            return
+        recent_time = int(time.time()) - NEARBY_WINDOW_SECONDS
+        rows = db.session.query(
+            AirQualityReading.id, AirQualityReading.la, AirQualityReading.lo, AirQualityReading.t
+        ).filter(AirQualityReading.t >= recent_time)
+
+        nearby_index.clear()
+        for reading_id, la, lo, t in rows:
+            nearby_index.upsert(reading_id, la, lo, t)
+        nearby_index_loaded = True
+        logger.info("Loaded recent readings into nearby index", extra={'readings': len(nearby_index)})
+
+def index_reading(reading_id, la, lo, t):
+    """Record a written reading in the nearby index (no-op until it is loaded)"""
+    if nearby_index_loaded and reading_id is not None:
+        nearby_index.upsert(reading_id, la, lo, t)
+
+# Whether air_quality_readings has the PostGIS geog column (migration 4);
+# looked up once per process
+postgis_available = None
+
+def postgis_enabled():
+    global postgis_available
+    if postgis_available is None:
+        postgis_available = db.engine.dialect.name == 'postgresql' and db.session.execute(db.text(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = 'air_quality_readings' AND column_name = 'geog'"
+        )).scalar() is not None
+    return postgis_available
+
+def query_near(lat, lon, radius_meters, k, min_t=None):
+    """
+    Up to k readings strictly within radius_meters of (lat, lon), nearest
+    first, as (reading, distance_meters) pairs; readings with t < min_t are
+    left out
+    With PostGIS, ST_DWithin on the GiST-indexed geog column ordered by <->
+    (a nearest-neighbour index scan). Otherwise the la/lo box around the
+    circle is read and measured with k_nearest. Both measure on a sphere,
+    like haversine_distance.
+    """
+    if postgis_enabled():
+        geog = db.literal_column('air_quality_readings.geog')
+        point = db.func.geography(db.func.ST_SetSRID(db.func.ST_MakePoint(lon, lat), 4326))
+        distance = db.func.ST_Distance(geog, point, False)
+        # ST_DWithin (which uses the index) includes the radius itself; the
+        # grid index and k_nearest do not, so points on it are dropped here
+        query = db.select(AirQualityReading, distance.label('distance')).where(
+            db.func.ST_DWithin(geog, point, radius_meters, False),
+            distance < radius_meters
+        )
+        if min_t is not None:
+            query = query.where(AirQualityReading.t >= min_t)
+        query = query.order_by(geog.op('<->')(point)).limit(k)
+        return [(reading, distance) for reading, distance in db.session.execute(query)]
+
+    # Measure only id/la/lo for the box, then load the k nearest readings
+    dlat, dlon = radius_bounds(lat, radius_meters)
+    query = db.select(AirQualityReading.id, AirQualityReading.la, AirQualityReading.lo).where(
+        AirQualityReading.la.between(lat - dlat, lat + dlat),
+        AirQualityReading.lo.between(lon - dlon, lon + dlon),
+        AirQualityReading.la != -1,
+        AirQualityReading.lo != -1
+    )
+    if min_t is not None:
+        query = query.where(AirQualityReading.t >= min_t)
+    candidates = db.session.execute(query).all()
+    if not candidates:
+        return []
+
+    ids, lats, lons = zip(*candidates)
+    indices, distances = k_nearest(lat, lon, lats, lons, k, radius_meters)
+    readings = {
+        reading.id: reading
+        for reading in AirQualityReading.query.filter(AirQualityReading.id.in_([ids[i] for i in indices]))
+    }
+    return [(readings[ids[i]], distance) for i, distance in zip(indices, distances)]
+
+# A batch is matched against a NumPy snapshot of the nearby index once it
+# has at least 1/NEARBY_SNAPSHOT_RATIO as many points as the index has
+# readings; smaller ones (a webhook's single point) look up grid cells,
+# which costs per point rather than per indexed reading. Around 4000
+# points for 20000 readings is where the snapshot starts to pay off.
+NEARBY_SNAPSHOT_RATIO = 5
 
 def find_nearby_reading(lat, lon, radius_meters=50):
     """
@@ -49,160 +383,335 @@ def find_nearby_reading(lat, lon, radius_meters=50):
     Returns the nearest reading if found within radius, otherwise None
     """
     try:
-        # Get recent readings (last 24 hours) to avoid checking old data
-        recent_time = int(time.time()) - (24 * 60 * 60)
-        readings = AirQualityReading.query.filter(
-            AirQualityReading.t >= recent_time
-        ).all()
-        
-        nearest_reading = None
-        min_distance = float('inf')
-        
-        for reading in readings:
-            distance = haversine_distance(lat, lon, reading.la, reading.lo)
-            if distance < radius_meters and distance < min_distance:
-                min_distance = distance
-                nearest_reading = reading
-        
-        return nearest_reading
-    except Exception as e:
-        print(f"Error finding nearby reading: {e}")
+        return find_nearby_readings_batch([(lat, lon)], radius_meters)[0]
+    except Exception:
+        logger.exception("Error finding nearby reading")
         return None
 
+def find_nearby_readings_batch(points, radius_meters=50):
+    """
+    Nearest recent reading (or None) within radius_meters of each (lat, lon)
+    point, e.g. when deduplicating a bulk import of mobile readings
+    With PostGIS the database answers, so every worker sees the others'
+    writes at once; otherwise this process's grid index does, which hears of
+    other processes' writes only with SHARED_CHANGES
+    """
+    points = list(points)
+    if not points:
+        return []
+
+    # Only consider recent readings (last 24 hours)
+    recent_time = int(time.time()) - NEARBY_WINDOW_SECONDS
+    if postgis_enabled():
+        matches = [query_near(lat, lon, radius_meters, 1, min_t=recent_time) for lat, lon in points]
+        return [match[0][0] if match else None for match in matches]
+
+    if not nearby_index_loaded:
+        load_nearby_index()
+
+    if len(points) * NEARBY_SNAPSHOT_RATIO >= len(nearby_index):
+        ids, lats, lons = nearby_index.arrays(min_t=recent_time)
+        query_lats, query_lons = zip(*points)
+        indices, _ = nearest_within(query_lats, query_lons, lats, lons, radius_meters)
+        point_ids = [int(ids[i]) if i >= 0 else None for i in indices]
+    else:
+        point_ids = []
+        for lat, lon in points:
+            match = nearby_index.nearest(lat, lon, radius_meters, min_t=recent_time)
+            point_ids.append(match[0] if match else None)
+
+    # Load every matched reading with IN queries instead of one get per point
+    matched_ids = sorted({reading_id for reading_id in point_ids if reading_id is not None})
+    if len(matched_ids) == 1:
+        readings = {matched_ids[0]: db.session.get(AirQualityReading, matched_ids[0])}
+    else:
+        readings = {}
+        for start in range(0, len(matched_ids), UPSERT_CHUNK_ROWS):
+            chunk = matched_ids[start:start + UPSERT_CHUNK_ROWS]
+            for reading in AirQualityReading.query.filter(AirQualityReading.id.in_(chunk)):
+                readings[reading.id] = reading
+
+    return [readings.get(reading_id) if reading_id is not None else None for reading_id in point_ids]
+
+def find_nearby_reading_scan(lat, lon, radius_meters=50):
+    """
+    Brute-force version of find_nearby_reading that measures every recent row
+    Kept as the reference the grid index is checked against
+    """
+    recent_time = int(time.time()) - NEARBY_WINDOW_SECONDS
+    readings = AirQualityReading.query.filter(
+        AirQualityReading.t >= recent_time
+    ).all()
+
+    nearest_reading = None
+    min_distance = float('inf')
+
+    for reading in readings:
+        distance = haversine_distance(lat, lon, reading.la, reading.lo)
+        if distance < radius_meters and distance < min_distance:
+            min_distance = distance
+            nearest_reading = reading
+
+    return nearest_reading
+
+# Retention deletes in batches of this many rows, each in its own short
+# transaction, pausing between batches so webhook writes are not starved
+RETENTION_BATCH_ROWS = int(os.getenv('RETENTION_BATCH_ROWS', '5000'))
+RETENTION_PAUSE_SECONDS = float(os.getenv('RETENTION_PAUSE_SECONDS', '0.2'))
+
+# Progress of the running (or last) retention pass, reported by /health
+retention_status = {'state': 'idle'}
+retention_lock = threading.Lock()
+
+def delete_in_batches(table, condition, key_columns, counter):
+    """
+    Delete the rows of table matching condition RETENTION_BATCH_ROWS at a
+    time, committing and pausing after each batch
+    counter names the retention_status entry that tracks progress
+    Returns the number of rows deleted
+    """
+    deleted = 0
+    while True:
+        keys = db.select(*key_columns).where(condition).limit(RETENTION_BATCH_ROWS)
+        key = key_columns[0] if len(key_columns) == 1 else db.tuple_(*key_columns)
+        # condition is repeated so a row updated since the subquery ran is kept
+        count = db.session.execute(table.delete().where(key.in_(keys), condition)).rowcount
+        db.session.commit()
+
+        deleted += count
+        retention_status[counter] += count
+        retention_status['batches'] += 1
+        if count < RETENTION_BATCH_ROWS:
+            return deleted
+        time.sleep(RETENTION_PAUSE_SECONDS)
+
 def cleanup_old_data(days_to_keep=30):
-    """Remove database entries older than specified days"""
+    """
+    Remove database entries older than specified days
+    Readings and history are deleted in batches, and each expiring day of
+    history is first downsampled into the daily rollups, which are kept
+    """
+    if not retention_lock.acquire(blocking=False):
+        logger.info("Cleanup already running, skipping")
+        return 0
+    started = time.time()
     try:
         with app.app_context():
-            cutoff_time = int(time.time()) - (days_to_keep * 24 * 60 * 60)
+            cutoff_time = int(started) - (days_to_keep * 24 * 60 * 60)
+            retention_status.clear()
+            retention_status.update({
+                'state': 'running',
+                'started_at': datetime.utcfromtimestamp(started).isoformat(),
+                'cutoff': cutoff_time,
+                'readings_deleted': 0,
+                'history_removed': 0,
+                'history_default_deleted': 0,
+                'rollups_written': 0,
+                'batches': 0,
+            })
             
             # Delete old readings
-            deleted = AirQualityReading.query.filter(
-                AirQualityReading.t < cutoff_time
-            ).delete()
-            
-            db.session.commit()
-            
+            deleted = delete_in_batches(
+                AirQualityReading.__table__,
+                AirQualityReading.t < cutoff_time,
+                [AirQualityReading.id],
+                'readings_deleted'
+            )
+
             if deleted > 0:
-                print(f"Cleaned up {deleted} readings older than {days_to_keep} days")
+                readings_deleted()
+
+            drop_old_history(days_to_keep)
+
+            elapsed = time.time() - started
+            retention_status.update({'state': 'done', 'elapsed_seconds': round(elapsed, 3)})
+            history = 'history_partitions' if db.engine.dialect.name == 'postgresql' else 'history'
+            metrics.CLEANUP_DELETED.labels(table='readings').inc(retention_status['readings_deleted'])
+            metrics.CLEANUP_DELETED.labels(table=history).inc(retention_status['history_removed'])
+            metrics.CLEANUP_RUN_SECONDS.labels(status='ok').observe(elapsed)
+            logger.info("Retention pass finished", extra={
+                'days_to_keep': days_to_keep,
+                'readings_deleted': retention_status['readings_deleted'],
+                'history_removed': retention_status['history_removed'],
+                'history_default_deleted': retention_status['history_default_deleted'],
+                'rollups_written': retention_status['rollups_written'],
+                'batches': retention_status['batches'],
+                'seconds': round(elapsed, 3),
+            })
             
             return deleted
     except Exception as e:
-        print(f"Error during cleanup: {e}")
-        return 0
+        logger.exception("Error during cleanup")
+        retention_status.update({'state': 'failed', 'error': str(e)})
+        metrics.CLEANUP_RUN_SECONDS.labels(status='failed').observe(time.time() - started)
+        raise
+    finally:
+        retention_lock.release()
 
-def periodic_cleanup(interval_hours=24, days_to_keep=30):
-    """Run cleanup task periodically"""
-    while True:
+# Name of the ACHD import's row in ingest_checkpoints (value: last hour imported)
+ACHD_CHECKPOINT = 'achd'
+# Also write each imported hour to <dir>/achd_update_date_<date>_hour_<hour>.json
+ACHD_ARCHIVE_DIR = os.getenv('ACHD_ARCHIVE_DIR')
+
+def load_achd_checkpoint(now):
+    """
+    Start of the last ACHD hour imported
+    Falls back to the checkpoint file the JSON pipeline kept, then to
+    midnight today
+    """
+    value = load_checkpoint(ACHD_CHECKPOINT)
+    if value is None:
         try:
-            time.sleep(interval_hours * 60 * 60)  # Wait for interval
-            print(f"\nRunning periodic cleanup (keeping last {days_to_keep} days)...")
-            cleanup_old_data(days_to_keep)
-        except Exception as e:
-            print(f"Error in periodic cleanup: {e}")
-
-def start_cleanup_thread(interval_hours=24, days_to_keep=30):
-    """Start background thread for periodic cleanup"""
-    cleanup_thread = threading.Thread(
-        target=periodic_cleanup,
-        args=(interval_hours, days_to_keep),
-        daemon=True
-    )
-    cleanup_thread.start()
-    print(f"Started cleanup thread (runs every {interval_hours}h, keeps {days_to_keep} days)")
+            with open(os.path.join("achd_updates", "last_processed.txt"), "r") as f:
+                value = f.read().strip()
+        except FileNotFoundError:
+            return datetime(now.year, now.month, now.day, 0)
+    return datetime.fromisoformat(value)
 
 def collect_achd_data():
-    """Import and run ACHD data collection"""
+    """
+    Fetch the ACHD hours after the checkpoint and upsert them as they arrive
+    Each hour's readings, history and the advanced checkpoint are committed
+    in one transaction, so a crash never skips or half-imports an hour
+    """
+    started = time.time()
+    written = 0
     try:
-        import sys
-        import importlib.util
-        
-        # Load the ACHD data request module
-        spec = importlib.util.spec_from_file_location("achd_data_request", "ACHD_data_request.py")
-        achd_module = importlib.util.module_from_spec(spec)
-        sys.modules["achd_data_request"] = achd_module
-        spec.loader.exec_module(achd_module)
-        
-        # Run the collect_data function
-        print("Running ACHD data collection...")
-        achd_module.collect_data()
-        
-        # Parse and import the generated JSON file
+        import achd_data_request
 
-        import glob
-        json_files = glob.glob("achd_updates/achd_update_*.json")
-        
-        if not json_files:
-            print("WARNING: No ACHD JSON files found to import")
-            return
-        
-        # # Get the most recent file
-        # latest_file = max(json_files, key=os.path.getmtime)
-        # print(f"Importing data from {latest_file}...")
-        # There should only be one file read
-
-        with open(json_files[0], 'r') as f:
-            content = f.read().strip()
-            # Remove trailing comma if present
-            if content.endswith(',]'):
-                content = content[:-2] + ']'
-            data = json.loads(content)
-        
         with app.app_context():
-            added_count = 0
-            updated_count = 0
+            now = datetime.now()
+            last_processed = load_achd_checkpoint(now)
 
-            print(data)
-            
-            for reading_data in data:
-                # Calculate location-based ID
-                # lat = reading_data.get('la')
-                # lon = reading_data.get('lo')
-                # location_id = calculate_location_id(lat, lon)
-                location_id = reading_data.get('id')
-                
-                # Check if reading already exists at this location
-                existing = AirQualityReading.query.filter_by(id=location_id).first()
-                
-                if existing:
-                    # Update existing reading
-                    print("Updating existing reading at location ID:", location_id)
-                    for key, value in reading_data.items():
-                        setattr(existing, key, value)
-                    existing.created_at = datetime.utcnow()
-                    updated_count += 1
-                else:
-                    # Create new reading with location-based ID
-                    reading = AirQualityReading(**reading_data)
-                    db.session.add(reading)
-                    added_count += 1
-            
+            logger.info("Running ACHD data collection", extra={'after': last_processed.isoformat()})
+            hours = 0
+            for hour, readings in achd_data_request.iter_backfill(last_processed, now):
+                written += upsert_readings(readings, checkpoint=(ACHD_CHECKPOINT, hour.isoformat()))
+                hours += 1
+                if ACHD_ARCHIVE_DIR and readings:
+                    achd_data_request.archive_hour(hour, readings, ACHD_ARCHIVE_DIR)
+
+            logger.info("ACHD data imported", extra={'rows': written, 'hours': hours, 'seconds': round(time.time() - started, 3)})
+            metrics.ACHD_RUN_SECONDS.labels(status='ok').observe(time.time() - started)
+
+    except Exception:
+        logger.exception("Error collecting/importing ACHD data")
+        with app.app_context():
+            db.session.rollback()
+        metrics.ACHD_RUN_SECONDS.labels(status='failed').observe(time.time() - started)
+        raise
+    finally:
+        # Hours committed before a failure still count
+        metrics.ACHD_ROWS_PER_RUN.observe(written)
+        metrics.ACHD_ROWS_IMPORTED.inc(written)
+
+# Background jobs: (slot interval, offset into the slot) in seconds. Cleanup
+# runs daily at 03:00 UTC, the ACHD import at ten past every hour and the
+# history partitions job every six hours at half past
+CLEANUP_INTERVAL_SECONDS = int(os.getenv('CLEANUP_INTERVAL_SECONDS', str(24 * 60 * 60)))
+CLEANUP_OFFSET_SECONDS = int(os.getenv('CLEANUP_OFFSET_SECONDS', str(3 * 60 * 60)))
+ACHD_INTERVAL_SECONDS = int(os.getenv('ACHD_INTERVAL_SECONDS', '3600'))
+ACHD_OFFSET_SECONDS = int(os.getenv('ACHD_OFFSET_SECONDS', '600'))
+PARTITIONS_INTERVAL_SECONDS = int(os.getenv('PARTITIONS_INTERVAL_SECONDS', str(6 * 60 * 60)))
+PARTITIONS_OFFSET_SECONDS = int(os.getenv('PARTITIONS_OFFSET_SECONDS', '1800'))
+# Each process waits up to this long into a slot, so they do not all race for it
+JOB_JITTER_SECONDS = float(os.getenv('JOB_JITTER_SECONDS', '30'))
+SCHEDULER_POLL_SECONDS = float(os.getenv('SCHEDULER_POLL_SECONDS', '30'))
+
+def advisory_lock_key(name):
+    """64-bit Postgres advisory lock key for a job name"""
+    return int.from_bytes(hashlib.sha1(f'sniff-job:{name}'.encode()).digest()[:8], 'big', signed=True)
+
+class JobStore:
+    """
+    Scheduler store backed by the job_runs table
+    On Postgres a job's lock is a session advisory lock (pg_try_advisory_lock)
+    held on its own connection for the length of the run, so only one of the
+    processes sharing the database runs it. Other databases only lock within
+    the process, which is enough for a single-process SQLite setup.
+    """
+
+    def __init__(self):
+        self.local_locks = {}
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        with app.app_context():
+            if db.engine.dialect.name != 'postgresql':
+                local_lock = self.local_locks.setdefault(name, threading.Lock())
+                acquired = local_lock.acquire(blocking=False)
+                try:
+                    yield acquired
+                finally:
+                    if acquired:
+                        local_lock.release()
+                return
+
+            key = advisory_lock_key(name)
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                acquired = connection.execute(db.text('SELECT pg_try_advisory_lock(:key)'), {'key': key}).scalar()
+                try:
+                    yield acquired
+                finally:
+                    if acquired:
+                        connection.execute(db.text('SELECT pg_advisory_unlock(:key)'), {'key': key})
+
+    def last_slot(self, name):
+        with app.app_context():
+            return db.session.query(db.func.max(JobRun.slot)).filter(
+                JobRun.job == name,
+                JobRun.status == 'ok'
+            ).scalar()
+
+    def start_run(self, name, slot):
+        """Record a run as started; only called while holding the job's lock"""
+        with app.app_context():
+            # Holding the lock, any run still marked running died with its process
+            JobRun.query.filter_by(job=name, status='running').update({'status': 'abandoned'})
+            run = JobRun(job=name, slot=slot, status='running', worker=self.worker, started_at=datetime.utcnow())
+            db.session.add(run)
             db.session.commit()
-            print(f"ACHD data imported: {added_count} new, {updated_count} updated")
-            
-    except Exception as e:
-        print(f"Error collecting/importing ACHD data: {e}")
-        import traceback
-        traceback.print_exc()
+            return run.run_id
 
-def periodic_achd_collection(interval_hours=1):
-    """Run ACHD data collection periodically"""
-    while True:
-        try:
-            time.sleep(interval_hours * 60 * 60)  # Wait for interval
-            print(f"\nRunning periodic ACHD data collection...")
-            collect_achd_data()
-        except Exception as e:
-            print(f"Error in periodic ACHD collection: {e}")
-
-def start_achd_thread(interval_hours=1):
-    """Start background thread for ACHD data collection"""
-    achd_thread = threading.Thread(
-        target=periodic_achd_collection,
-        args=(interval_hours,),
-        daemon=True
-    )
-    achd_thread.start()
-    print(f"Started ACHD collection thread (runs every {interval_hours}h)")
+    def finish_run(self, run_id, status, error):
+        with app.app_context():
+            run = db.session.get(JobRun, run_id)
+            run.finished_at = datetime.utcnow()
+            run.duration = (run.finished_at - run.started_at).total_seconds()
+            run.status = status
+            run.error = error
+            db.session.commit()
+
+scheduler = None
+scheduler_lock = threading.Lock()
+
+def start_scheduler():
+    """Start the background jobs once per process"""
+    global scheduler
+    with scheduler_lock:
+        if scheduler is not None:
+            return scheduler
+        scheduler = Scheduler([
+            Job('cleanup', lambda: cleanup_old_data(days_to_keep=30), CLEANUP_INTERVAL_SECONDS,
+                offset=CLEANUP_OFFSET_SECONDS, jitter=JOB_JITTER_SECONDS),
+            Job('achd', collect_achd_data, ACHD_INTERVAL_SECONDS,
+                offset=ACHD_OFFSET_SECONDS, jitter=JOB_JITTER_SECONDS),
+            Job('partitions', create_history_partitions, PARTITIONS_INTERVAL_SECONDS,
+                offset=PARTITIONS_OFFSET_SECONDS, jitter=JOB_JITTER_SECONDS),
+        ], JobStore(), poll=SCHEDULER_POLL_SECONDS)
+        scheduler.start()
+        logger.info("Started scheduler", extra={'cleanup_interval': CLEANUP_INTERVAL_SECONDS, 'achd_interval': ACHD_INTERVAL_SECONDS})
+        return scheduler
+
+@app.cli.command('job-runs')
+@click.option('--limit', default=20, show_default=True, help='Most recent runs to list')
+def job_runs_command(limit):
+    """List recent scheduled job runs and their outcomes"""
+    for run in JobRun.query.order_by(JobRun.run_id.desc()).limit(limit):
+        slot = datetime.utcfromtimestamp(run.slot).isoformat()
+        duration = f"{run.duration:.1f}s" if run.duration is not None else '-'
+        print(f"{run.job:>10} {slot} {run.status:>9} {duration:>8} {run.worker or ''} {run.error or ''}")
 
 def calculate_location_id(lat, lon):
     """
@@ -213,38 +722,82 @@ def calculate_location_id(lat, lon):
     lon_int = int(lon * 1000000)
     return lat_int ^ lon_int
 
+# Apply pending schema migrations when the app starts. Deployments that run
+# `flask --app app migrate` before starting the app can turn this off.
+MIGRATE_ON_START = os.getenv('MIGRATE_ON_START', '1') == '1'
+
+def schema_migrator():
+    return Migrator(db.engine, db.metadata)
+
 def wait_for_db(max_retries=30, delay=2):
-    """Wait for database to be available and create tables"""
+    """Wait for database to be available and bring the schema up to date"""
     for attempt in range(max_retries):
         try:
             with app.app_context():
                 # Try to connect to the database
                 db.session.execute(db.text('SELECT 1'))
                 db.session.commit()
-                print("Database connection successful!")
-                
-                # Create all tables
-                print("Creating database tables...")
-                db.create_all()
-                print("Tables created successfully!")
+                logger.info("Database connection successful")
                 
-                # Run initial cleanup
-                print("Running initial cleanup...")
-                cleanup_old_data(days_to_keep=30)
+                migrator = schema_migrator()
+                if MIGRATE_ON_START:
+                    migrator.upgrade()
+                else:
+                    pending = [migration.version for migration in migrator.pending()]
+                    if pending:
+                        logger.warning("Schema migrations pending; run flask --app app migrate", extra={'pending': pending})
+                create_history_partitions()
+                logger.info("Schema up to date")
                 
                 return True
         except Exception as e:
-            print(f"Waiting for database... (attempt {attempt + 1}/{max_retries})")
-            print(f"   Error: {e}")
+            logger.warning("Waiting for database", extra={'attempt': attempt + 1, 'max_retries': max_retries, 'error': str(e)})
             if attempt < max_retries - 1:
                 time.sleep(delay)
             else:
-                print("Failed to connect to database after all retries")
+                logger.error("Failed to connect to database after all retries")
                 return False
     return False
 
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help='List migrations and whether each has run, without applying any')
+def migrate_command(status):
+    """Apply pending schema migrations (run at deploy time, before the app starts)"""
+    migrator = schema_migrator()
+    if status:
+        applied = migrator.applied()
+        for migration in migrator.migrations:
+            when = applied[migration.version].isoformat() if migration.version in applied else 'pending'
+            print(f"{migration.version:>4} {when:>26}  {migration.description}")
+        return
+    done = migrator.upgrade()
+    print(f"Applied migrations {done}" if done else "Schema already up to date")
+
+class ReadingMeasurements:
+    """Location and sensor columns shared by the current-state and history tables"""
+    la = db.Column('la', db.Float)  # Latitude
+    lo = db.Column('lo', db.Float) # Longitude
+    lad = db.Column('lad', db.String(1))  # Latitude direction (N/S)
+    lod = db.Column('lod', db.String(1))  # Longitude direction (E/W)
+    bs = db.Column('bs', db.Float)  # Bike speed (km/h or mph)
+    pm1 = db.Column('pm1', db.Float)      # PM1.0 (µg/m³)
+    pm25 = db.Column('pm25', db.Float)   # PM2.5 (µg/m³)
+    pm10 = db.Column('pm10', db.Float)    # PM10 (µg/m³)
+    p0p3 = db.Column('p0p3', db.Float)    # Particle count >0.3µm
+    p0p5 = db.Column('p0p5', db.Float)    # Particle count >0.5µm
+    p1 = db.Column('p1', db.Float)        # Particle count >1.0µm
+    p2p5 = db.Column('p2p5', db.Float)    # Particle count >2.5µm
+    p5 = db.Column('p5', db.Float)        # Particle count >5.0µm
+    p10 = db.Column('p10', db.Float)      # Particle count >10µm
+    v = db.Column('v', db.Float)          # VOC index
+    n = db.Column('n', db.Float)          # NOx index
+    c = db.Column('c', db.Float)          # CO2 (ppm)
+    tmp = db.Column('tmp', db.Float)     # Temperature (°C)
+    rh = db.Column('rh', db.Float)        # Relative Humidity (%)
+    src = db.Column('src', db.Integer)    # Data source
+
 # Simple Air Quality Data Model
-class AirQualityReading(db.Model):
+class AirQualityReading(ReadingMeasurements, db.Model):
     __tablename__ = 'air_quality_readings'
 
     '''
@@ -281,57 +834,769 @@ class AirQualityReading(db.Model):
 
     id = db.Column('id', db.BigInteger, primary_key=True)  # Location-based ID (XOR of lat/lon)
     t = db.Column('t', db.Integer)  # Timestamp
-    la = db.Column('la', db.Float)  # Latitude
-    lo = db.Column('lo', db.Float) # Longitude
-    lad = db.Column('lad', db.String(1))  # Latitude direction (N/S)
-    lod = db.Column('lod', db.String(1))  # Longitude direction (E/W)
-    bs = db.Column('bs', db.Float)  # Bike speed (km/h or mph)
-    pm1 = db.Column('pm1', db.Float)      # PM1.0 (µg/m³)
-    pm25 = db.Column('pm25', db.Float)   # PM2.5 (µg/m³)
-    pm10 = db.Column('pm10', db.Float)    # PM10 (µg/m³)
-    p0p3 = db.Column('p0p3', db.Float)    # Particle count >0.3µm
-    p0p5 = db.Column('p0p5', db.Float)    # Particle count >0.5µm
-    p1 = db.Column('p1', db.Float)        # Particle count >1.0µm
-    p2p5 = db.Column('p2p5', db.Float)    # Particle count >2.5µm
-    p5 = db.Column('p5', db.Float)        # Particle count >5.0µm
-    p10 = db.Column('p10', db.Float)      # Particle count >10µm
-    v = db.Column('v', db.Float)          # VOC index
-    n = db.Column('n', db.Float)          # NOx index
-    c = db.Column('c', db.Float)          # CO2 (ppm)
-    tmp = db.Column('tmp', db.Float)     # Temperature (°C)
-    rh = db.Column('rh', db.Float)        # Relative Humidity (%)
-    src = db.Column('src', db.Integer)    # Data source
 
     # Metadata
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Schema changes go through migrations.py as well as here
+    __table_args__ = (
+        # /api/data/latest (read backwards) and the /api/data/changes keyset scan
+        db.Index('idx_air_quality_created_at_id', 'created_at', 'id'),
+        db.Index('idx_air_quality_la_lo', 'la', 'lo'),  # Viewport bounding boxes
+        db.Index('idx_air_quality_t', 't'),  # Recent readings and retention
+    )
     
     def __repr__(self):
         return f'<Reading {self.id} at ({self.la}, {self.lo}): PM2.5={self.pm25}, PM10={self.pm10}>'
 
-def print_all_data():
-    """Print all data points in the database"""
-    print("\n" + "="*60)
-    print("ALL AIR QUALITY DATA POINTS")
-    print("="*60)
-    
-    readings = AirQualityReading.query.order_by(AirQualityReading.created_at.desc()).all()
-    
-    if not readings:
-        print("No data points in database yet.")
+# Append-only history of every reading written to air_quality_readings.
+# On Postgres the table is range-partitioned by day on t, so time-bounded
+# queries only scan the partitions they need and retention drops whole days.
+class AirQualityHistory(ReadingMeasurements, db.Model):
+    __tablename__ = 'air_quality_history'
+    __table_args__ = (
+        db.Index('idx_air_quality_history_t', 't'),  # Time ranges across locations
+        {'postgresql_partition_by': 'RANGE (t)'},
+    )
+
+    # The partition key must be part of the primary key; a repeated
+    # (location, timestamp) pair is the same reading and is stored once
+    id = db.Column('id', db.BigInteger, primary_key=True, autoincrement=False)
+    t = db.Column('t', db.Integer, primary_key=True, autoincrement=False)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<History {self.id} at t={self.t}: PM2.5={self.pm25}, PM10={self.pm10}>'
+
+# Progress markers for imports that run in steps (e.g. the last ACHD hour
+# imported), written in the same transaction as the data they cover
+# Uplinks acknowledged in batch ingestion mode and not yet written (see
+# enqueue_reading). Append-only: accepting an uplink is one small insert.
+class IngestSpool(db.Model):
+    __tablename__ = 'ingest_spool'
+
+    seq = db.Column('seq', db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    reading = db.Column('reading', db.Text, nullable=False)  # The validated reading as JSON
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<IngestSpool {self.seq}>'
+
+class IngestCheckpoint(db.Model):
+    __tablename__ = 'ingest_checkpoints'
+
+    name = db.Column('name', db.String(64), primary_key=True)
+    value = db.Column('value', db.String(64), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Checkpoint {self.name}={self.value}>'
+
+# One row per scheduled job run (see scheduler.py), with its outcome
+class JobRun(db.Model):
+    __tablename__ = 'job_runs'
+    __table_args__ = (
+        db.Index('idx_job_runs_job_slot', 'job', 'slot'),
+    )
+
+    run_id = db.Column('run_id', db.Integer, primary_key=True)
+    job = db.Column('job', db.String(64), nullable=False)
+    slot = db.Column('slot', db.Integer, nullable=False)  # Scheduled start (epoch s)
+    status = db.Column('status', db.String(16), nullable=False)  # running, ok, failed, abandoned
+    worker = db.Column('worker', db.String(128))  # host:pid that ran it
+    started_at = db.Column('started_at', db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column('finished_at', db.DateTime)
+    duration = db.Column('duration', db.Float)  # Seconds
+    error = db.Column('error', db.Text)
+
+    def __repr__(self):
+        return f'<JobRun {self.job} slot={self.slot}: {self.status}>'
+
+# Hourly and daily aggregates per location, maintained incrementally from
+# running count/sum/min/max as new history rows are written. Missing values
+# (-1 or NULL) are left out of the aggregates.
+class AirQualityRollup(db.Model):
+    __tablename__ = 'air_quality_rollups'
+    __table_args__ = (
+        db.Index('idx_air_quality_rollups_period_bucket', 'period', 'bucket'),  # Rollups of every location
+    )
+
+    id = db.Column('id', db.BigInteger, primary_key=True, autoincrement=False)  # Location ID
+    period = db.Column('period', db.Integer, primary_key=True, autoincrement=False)  # Bucket length (s)
+    bucket = db.Column('bucket', db.Integer, primary_key=True, autoincrement=False)  # Bucket start (epoch s)
+
+    pm25_count = db.Column('pm25_count', db.Integer, default=0)
+    pm25_sum = db.Column('pm25_sum', db.Float, default=0)
+    pm25_min = db.Column('pm25_min', db.Float)
+    pm25_max = db.Column('pm25_max', db.Float)
+    pm10_count = db.Column('pm10_count', db.Integer, default=0)
+    pm10_sum = db.Column('pm10_sum', db.Float, default=0)
+    pm10_min = db.Column('pm10_min', db.Float)
+    pm10_max = db.Column('pm10_max', db.Float)
+    n_count = db.Column('n_count', db.Integer, default=0)
+    n_sum = db.Column('n_sum', db.Float, default=0)
+    n_min = db.Column('n_min', db.Float)
+    n_max = db.Column('n_max', db.Float)
+    tmp_count = db.Column('tmp_count', db.Integer, default=0)
+    tmp_sum = db.Column('tmp_sum', db.Float, default=0)
+    tmp_min = db.Column('tmp_min', db.Float)
+    tmp_max = db.Column('tmp_max', db.Float)
+    rh_count = db.Column('rh_count', db.Integer, default=0)
+    rh_sum = db.Column('rh_sum', db.Float, default=0)
+    rh_min = db.Column('rh_min', db.Float)
+    rh_max = db.Column('rh_max', db.Float)
+
+    def __repr__(self):
+        return f'<Rollup {self.id} period={self.period} bucket={self.bucket}>'
+
+READING_FIELDS = [
+    'id', 't', 'la', 'lo', 'lad', 'lod', 'bs', 'pm1', 'pm25', 'pm10', 'p0p3', 'p0p5',
+    'p1', 'p2p5', 'p5', 'p10', 'v', 'n', 'c', 'tmp', 'rh', 'src',
+]
+
+def reading_values(reading):
+    """Column values of a reading row (ORM object or result row) as a dict"""
+    return {field: getattr(reading, field) for field in READING_FIELDS}
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# On Postgres the 'partitions' job creates the daily air_quality_history
+# partitions ahead of time, so writes never run DDL. Readings for a day
+# without a partition (backdated, or written while no job runner was up)
+# land in the DEFAULT partition (migration 6) instead of failing, and the
+# job's next run moves them into a partition of their own.
+HISTORY_DEFAULT_PARTITION = 'air_quality_history_default'
+HISTORY_PARTITION_DAYS_AHEAD = int(os.getenv('HISTORY_PARTITION_DAYS_AHEAD', '3'))
+
+def history_partition_name(day_start):
+    return 'air_quality_history_p' + datetime.utcfromtimestamp(day_start).strftime('%Y%m%d')
+
+def history_partition_days():
+    """Daily partitions of air_quality_history, as {day_start: name}"""
+    names = db.session.execute(db.text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'air_quality_history'"
+    )).scalars().all()
+
+    days = {}
+    for name in names:
+        try:
+            day = datetime.strptime(name.rsplit('_p', 1)[1], '%Y%m%d')
+        except (IndexError, ValueError):
+            continue  # The DEFAULT partition
+        days[int((day - datetime(1970, 1, 1)).total_seconds())] = name
+    return days
+
+def default_partition_days(condition, **params):
+    """
+    Start of each day with readings in the DEFAULT partition matching
+    condition; none before migration 6 has created the partition
+    """
+    if db.session.execute(db.text("SELECT to_regclass(:name)"), {'name': HISTORY_DEFAULT_PARTITION}).scalar() is None:
+        return set()
+    return set(db.session.execute(db.text(
+        f"SELECT DISTINCT t - t % {SECONDS_PER_DAY} FROM {HISTORY_DEFAULT_PARTITION} WHERE {condition}"
+    ), params).scalars())
+
+def create_history_partitions(days_ahead=HISTORY_PARTITION_DAYS_AHEAD, days_to_keep=30):
+    """
+    Create the daily air_quality_history partitions for today and the next
+    days_ahead days, and for each day within retention whose readings are in
+    the DEFAULT partition, moving those readings into it
+    Returns the number of partitions created. No-op outside Postgres.
+    """
+    with app.app_context():
+        if db.engine.dialect.name != 'postgresql':
+            return 0
+
+        now = int(time.time())
+        today = now - now % SECONDS_PER_DAY
+        days = {today + day * SECONDS_PER_DAY for day in range(days_ahead + 1)}
+        days |= default_partition_days('t >= :cutoff', cutoff=today - days_to_keep * SECONDS_PER_DAY)
+        days -= history_partition_days().keys()
+        db.session.commit()
+
+        created = 0
+        for day_start in sorted(days):
+            name = history_partition_name(day_start)
+            with db.engine.begin() as conn:
+                # Serialize partition creation across processes
+                conn.execute(db.text("SELECT pg_advisory_xact_lock(hashtext('air_quality_history'))"))
+                if conn.execute(db.text("SELECT to_regclass(:name)"), {'name': name}).scalar() is not None:
+                    continue
+                conn.execute(db.text(f"CREATE TABLE {name} (LIKE air_quality_history INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+                moved = 0
+                if conn.execute(db.text("SELECT to_regclass(:name)"), {'name': HISTORY_DEFAULT_PARTITION}).scalar() is not None:
+                    # Attaching checks the DEFAULT partition holds nothing for
+                    # the day under an exclusive lock on it (not on the
+                    # parent); take it first so no reading for the day can
+                    # arrive between the move and the check
+                    conn.execute(db.text(f"LOCK TABLE {HISTORY_DEFAULT_PARTITION} IN ACCESS EXCLUSIVE MODE"))
+                    moved = conn.execute(db.text(
+                        f"WITH moved AS (DELETE FROM {HISTORY_DEFAULT_PARTITION} WHERE t >= :start AND t < :end RETURNING *) "
+                        f"INSERT INTO {name} SELECT * FROM moved"
+                    ), {'start': day_start, 'end': day_start + SECONDS_PER_DAY}).rowcount
+                conn.execute(db.text(
+                    f"ALTER TABLE air_quality_history ATTACH PARTITION {name} "
+                    f"FOR VALUES FROM ({day_start}) TO ({day_start + SECONDS_PER_DAY})"
+                ))
+            created += 1
+            logger.info("Created history partition", extra={'partition': name, 'moved': moved})
+        return created
+
+def record_history(rows):
+    """
+    Append readings to air_quality_history in the current session transaction
+    and fold the newly inserted ones into the rollups
+    rows are dicts of READING_FIELDS; readings without an id or t are skipped
+    Returns the number of readings that were new to the history
+    """
+    rows = [row for row in rows if row.get('id') is not None and row.get('t') is not None]
+    if not rows:
+        return 0
+
+    now = datetime.utcnow()
+    insert = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    table = AirQualityHistory.__table__
+
+    inserted = []
+    for start in range(0, len(rows), UPSERT_CHUNK_ROWS):
+        chunk = [{**row, 'created_at': now} for row in rows[start:start + UPSERT_CHUNK_ROWS]]
+        stmt = insert(table).values(chunk).on_conflict_do_nothing(index_elements=['id', 't'])
+        stmt = stmt.returning(*[table.c[field] for field in READING_FIELDS])
+        inserted.extend(dict(row) for row in db.session.execute(stmt).mappings())
+
+    # Only readings new to the history feed the rollups, so a repeated
+    # (id, t) is never counted twice
+    update_rollups(inserted)
+
+    return len(inserted)
+
+def downsample_history(start_time, end_time):
+    """
+    Rebuild the daily rollups of the days in [start_time, end_time) from
+    air_quality_history and store them, replacing the incremental ones
+    Run before those days' raw rows are removed, so long-range trends
+    outlive retention. Returns the number of rollup rows written
+    """
+    insert = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    table = AirQualityRollup.__table__
+    written = 0
+
+    for day_start in range(start_time - start_time % SECONDS_PER_DAY, end_time, SECONDS_PER_DAY):
+        rows = list(rebuild_rollups(SECONDS_PER_DAY, day_start, min(day_start + SECONDS_PER_DAY, end_time)).values())
+        for start in range(0, len(rows), UPSERT_CHUNK_ROWS):
+            stmt = insert(table).values(rows[start:start + UPSERT_CHUNK_ROWS])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['id', 'period', 'bucket'],
+                set_={column.name: stmt.excluded[column.name] for column in table.columns if not column.primary_key}
+            )
+            db.session.execute(stmt)
+        db.session.commit()
+        written += len(rows)
+        retention_status['rollups_written'] = retention_status.get('rollups_written', 0) + len(rows)
+
+    return written
+
+def drop_old_history(days_to_keep=30):
+    """
+    Apply retention to air_quality_history, a whole day at a time, after
+    downsampling each expiring day into the daily rollups
+    On Postgres daily partitions that ended before the cutoff are detached
+    and dropped; other databases fall back to deleting rows in batches
+    Returns the number of partitions (or rows) removed
+    """
+    cutoff_time = int(time.time()) - (days_to_keep * SECONDS_PER_DAY)
+    cutoff_time -= cutoff_time % SECONDS_PER_DAY
+
+    if db.engine.dialect.name != 'postgresql':
+        oldest = db.session.query(db.func.min(AirQualityHistory.t)).scalar()
+        if oldest is None or oldest >= cutoff_time:
+            return 0
+        downsample_history(oldest, cutoff_time)
+        return delete_in_batches(
+            AirQualityHistory.__table__,
+            AirQualityHistory.t < cutoff_time,
+            [AirQualityHistory.id, AirQualityHistory.t],
+            'history_removed'
+        )
+
+    partitions = history_partition_days()
+
+    # Expired readings in the DEFAULT partition: downsample the days that
+    # have no partition (the others are downsampled below, before their
+    # partition goes), then delete them row by row
+    expired_days = default_partition_days('t < :cutoff', cutoff=cutoff_time)
+    for day_start in sorted(expired_days - partitions.keys()):
+        downsample_history(day_start, day_start + SECONDS_PER_DAY)
+    if expired_days:
+        default_partition = db.table(HISTORY_DEFAULT_PARTITION, db.column('id'), db.column('t'))
+        delete_in_batches(
+            default_partition,
+            default_partition.c.t < cutoff_time,
+            [default_partition.c.id, default_partition.c.t],
+            'history_default_deleted'
+        )
+    db.session.commit()
+
+    dropped = 0
+    for day_start, name in sorted(partitions.items()):
+        if day_start + SECONDS_PER_DAY > cutoff_time:
+            continue
+
+        downsample_history(day_start, day_start + SECONDS_PER_DAY)
+
+        # With a DEFAULT partition Postgres cannot detach concurrently, so the
+        # partition is dropped in place, briefly locking the parent. The lock
+        # timeout keeps the drop from queueing history inserts behind a long
+        # query; a day that times out is dropped on the next pass.
+        try:
+            db.session.execute(db.text("SET LOCAL lock_timeout = '2s'"))
+            db.session.execute(db.text(f"DROP TABLE IF EXISTS {name}"))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning("Could not drop history partition, leaving it for the next pass", extra={'partition': name, 'error': str(e)})
+            continue
+        dropped += 1
+        retention_status['history_removed'] = retention_status.get('history_removed', 0) + 1
+        time.sleep(RETENTION_PAUSE_SECONDS)
+
+    return dropped
+
+ROLLUP_FIELDS = ['pm25', 'pm10', 'n', 'tmp', 'rh']
+ROLLUP_PERIODS = {'hour': 60 * 60, 'day': SECONDS_PER_DAY}
+
+# Sentinel the sensors and ACHD import use for a missing measurement
+MISSING_VALUE = -1
+
+def rollup_deltas(rows):
+    """
+    Aggregate readings into per-(id, period, bucket) count/sum/min/max rows
+    ready to be merged into air_quality_rollups
+    """
+    deltas = {}
+    for row in rows:
+        for period in ROLLUP_PERIODS.values():
+            key = (row['id'], period, row['t'] - row['t'] % period)
+            delta = deltas.get(key)
+            if delta is None:
+                delta = deltas[key] = {'id': key[0], 'period': key[1], 'bucket': key[2]}
+                for field in ROLLUP_FIELDS:
+                    delta.update({f'{field}_count': 0, f'{field}_sum': 0.0, f'{field}_min': None, f'{field}_max': None})
+
+            for field in ROLLUP_FIELDS:
+                value = row.get(field)
+                if value is None or value == MISSING_VALUE:
+                    continue
+                delta[f'{field}_count'] += 1
+                delta[f'{field}_sum'] += value
+                if delta[f'{field}_min'] is None or value < delta[f'{field}_min']:
+                    delta[f'{field}_min'] = value
+                if delta[f'{field}_max'] is None or value > delta[f'{field}_max']:
+                    delta[f'{field}_max'] = value
+
+    return list(deltas.values())
+
+def update_rollups(rows):
+    """
+    Merge newly recorded readings into the hourly and daily rollups in the
+    current session transaction, adding to running count/sum and widening
+    min/max instead of rescanning raw rows
+    """
+    deltas = rollup_deltas(rows)
+    if not deltas:
+        return 0
+
+    postgres = db.engine.dialect.name == 'postgresql'
+    insert = pg_insert if postgres else sqlite_insert
+    table = AirQualityRollup.__table__
+
+    def least(current, new):
+        if postgres:
+            return db.func.least(current, new)  # LEAST ignores NULLs
+        return db.func.min(db.func.coalesce(current, new), db.func.coalesce(new, current))
+
+    def greatest(current, new):
+        if postgres:
+            return db.func.greatest(current, new)
+        return db.func.max(db.func.coalesce(current, new), db.func.coalesce(new, current))
+
+    for start in range(0, len(deltas), UPSERT_CHUNK_ROWS):
+        stmt = insert(table).values(deltas[start:start + UPSERT_CHUNK_ROWS])
+        update_cols = {}
+        for field in ROLLUP_FIELDS:
+            update_cols[f'{field}_count'] = table.c[f'{field}_count'] + stmt.excluded[f'{field}_count']
+            update_cols[f'{field}_sum'] = table.c[f'{field}_sum'] + stmt.excluded[f'{field}_sum']
+            update_cols[f'{field}_min'] = least(table.c[f'{field}_min'], stmt.excluded[f'{field}_min'])
+            update_cols[f'{field}_max'] = greatest(table.c[f'{field}_max'], stmt.excluded[f'{field}_max'])
+        stmt = stmt.on_conflict_do_update(index_elements=['id', 'period', 'bucket'], set_=update_cols)
+        db.session.execute(stmt)
+
+    return len(deltas)
+
+def rollup_to_dict(rollup):
+    """Serialize a rollup row with mean/min/max/count per measurement"""
+    data = {'id': rollup.id, 'period': rollup.period, 'bucket': rollup.bucket}
+    for field in ROLLUP_FIELDS:
+        count = getattr(rollup, f'{field}_count') or 0
+        data[field] = {
+            'count': count,
+            'mean': getattr(rollup, f'{field}_sum') / count if count else None,
+            'min': getattr(rollup, f'{field}_min'),
+            'max': getattr(rollup, f'{field}_max'),
+        }
+    return data
+
+def rebuild_rollups(period, start_time, end_time, location_id=None):
+    """
+    Recompute rollups for buckets starting in [start_time, end_time) straight
+    from air_quality_history with GROUP BY
+    Returns {(id, period, bucket): row dict} shaped like air_quality_rollups
+    """
+    history = AirQualityHistory.__table__
+    bucket = (history.c.t - history.c.t % period).label('bucket')
+
+    columns = [history.c.id, bucket]
+    for field in ROLLUP_FIELDS:
+        column = history.c[field]
+        present = db.case((db.and_(column.isnot(None), column != MISSING_VALUE), column))
+        columns += [
+            db.func.count(present).label(f'{field}_count'),
+            db.func.coalesce(db.func.sum(present), 0.0).label(f'{field}_sum'),
+            db.func.min(present).label(f'{field}_min'),
+            db.func.max(present).label(f'{field}_max'),
+        ]
+
+    query = db.select(*columns).where(
+        history.c.t >= start_time - start_time % period,
+        history.c.t < end_time
+    ).group_by(history.c.id, bucket)
+    if location_id is not None:
+        query = query.where(history.c.id == location_id)
+
+    rebuilt = {}
+    for row in db.session.execute(query).mappings():
+        if row['bucket'] < start_time:
+            continue
+        rebuilt[(row['id'], period, row['bucket'])] = {**row, 'period': period}
+    return rebuilt
+
+def check_rollups(period, start_time, end_time, location_id=None, tolerance=1e-6):
+    """
+    Diff stored rollups against a rebuild from raw history
+    Returns a list of (key, field, stored, rebuilt) mismatches
+    """
+    rebuilt = rebuild_rollups(period, start_time, end_time, location_id)
+
+    query = AirQualityRollup.query.filter(
+        AirQualityRollup.period == period,
+        AirQualityRollup.bucket >= start_time,
+        AirQualityRollup.bucket < end_time
+    )
+    if location_id is not None:
+        query = query.filter(AirQualityRollup.id == location_id)
+    stored = {(rollup.id, rollup.period, rollup.bucket): rollup for rollup in query}
+
+    mismatches = []
+    for key in sorted(set(rebuilt) | set(stored)):
+        if key not in stored or key not in rebuilt:
+            mismatches.append((key, 'row', key in stored, key in rebuilt))
+            continue
+        for field in ROLLUP_FIELDS:
+            for suffix in ('count', 'sum', 'min', 'max'):
+                column = f'{field}_{suffix}'
+                expected = rebuilt[key][column]
+                actual = getattr(stored[key], column)
+                if suffix == 'sum' and abs((actual or 0) - (expected or 0)) <= tolerance * max(1.0, abs(expected or 0)):
+                    continue
+                if actual != expected:
+                    mismatches.append((key, column, actual, expected))
+
+    return mismatches
+
+@app.cli.command('check-rollups')
+def check_rollups_command():
+    """Rebuild the last 48 hours of rollups from history and report differences"""
+    end_time = int(time.time()) + 1
+    start_time = end_time - 2 * SECONDS_PER_DAY
+
+    failed = False
+    for name, period in ROLLUP_PERIODS.items():
+        mismatches = check_rollups(period, start_time, end_time)
+        print(f"{name} rollups: {len(mismatches)} mismatches")
+        for mismatch in mismatches[:20]:
+            print(f"   {mismatch}")
+        failed = failed or bool(mismatches)
+
+    if failed:
+        raise SystemExit(1)
+
+# Values used for any field a sensor payload leaves out
+READING_DEFAULTS = {
+    't': None,
+    'la': -1,
+    'lo': -1,
+    'lad': None,
+    'lod': None,
+    'bs': -1,
+    'pm1': -1,
+    'pm25': -1,
+    'pm10': -1,
+    'p0p3': -1,
+    'p0p5': -1,
+    'p1': -1,
+    'p2p5': -1,
+    'p5': -1,
+    'p10': -1,
+    'v': -1,
+    'n': -1,
+    'c': -1,
+    'tmp': -1,
+    'rh': -1,
+    'src': -1,
+}
+
+READING_COLUMNS = set(READING_DEFAULTS) | {'id'}
+
+# Postgres caps a statement at 65535 bind parameters, so very large
+# batches are split into several INSERTs of at most this many rows
+UPSERT_CHUNK_ROWS = 1000
+
+# Uplinks on this FPort carry a binary frame (see frames.py) in frm_payload;
+# anything else is parsed as JSON text from the payload formatter
+FRAME_FPORT = int(os.getenv('FRAME_FPORT', '2'))
+
+def parse_tts_payload(data):
+    """Extract the sensor reading from a TTS uplink, binary frame or JSON text"""
+    uplink = data["uplink_message"]
+    if uplink.get('f_port') == FRAME_FPORT and uplink.get('frm_payload'):
+        return decode_frame(base64.b64decode(uplink['frm_payload']))
+
+    raw_text = uplink["decoded_payload"].get('text')
+
+    cleaned_text = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', raw_text)  # Remove control chars
+    cleaned_text = cleaned_text.replace(' ', '')
+
+    return json.loads(cleaned_text)
+
+def validate_reading(json_data):
+    """
+    Check a parsed sensor reading before it is queued for a batch write
+    Returns the reading restricted to known columns; raises ValueError if unusable
+    """
+    if not isinstance(json_data, dict):
+        raise ValueError("Sensor payload is not a JSON object")
+
+    location_id = json_data.get('id')
+    if not isinstance(location_id, int) or isinstance(location_id, bool):
+        raise ValueError(f"Sensor payload has invalid location id: {location_id!r}")
+
+    return {key: value for key, value in json_data.items() if key in READING_COLUMNS}
+
+def load_checkpoint(name):
+    """Value of an ingest checkpoint, or None if it was never saved"""
+    checkpoint = db.session.get(IngestCheckpoint, name)
+    return checkpoint.value if checkpoint else None
+
+def save_checkpoint(name, value):
+    """Upsert an ingest checkpoint in the current transaction (no commit)"""
+    insert = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    stmt = insert(IngestCheckpoint.__table__).values(name=name, value=value, updated_at=datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['name'],
+        set_={'value': stmt.excluded.value, 'updated_at': stmt.excluded.updated_at}
+    )
+    db.session.execute(stmt)
+
+def upsert_readings(readings, checkpoint=None):
+    """
+    Write readings with one INSERT ... ON CONFLICT (id) DO UPDATE per batch
+    Later readings for the same id win, and on conflict only the keys present
+    in a reading are overwritten, matching the row-at-a-time webhook path
+    The resulting rows are appended to the history table, and checkpoint (a
+    (name, value) pair) saved, in the same transaction
+    Returns the number of distinct location ids written
+    """
+    # Postgres rejects an upsert that touches the same row twice
+    merged = {}
+    for reading_data in readings:
+        merged.setdefault(reading_data['id'], {}).update(reading_data)
+
+    if not merged:
+        if checkpoint is not None:
+            save_checkpoint(*checkpoint)
+            db.session.commit()
+        return 0
+
+    # Readings with the same set of keys share one statement
+    now = datetime.utcnow()
+    groups = {}
+    for reading_data in merged.values():
+        row = {**READING_DEFAULTS, **reading_data, 'created_at': now}
+        groups.setdefault(frozenset(reading_data), []).append(row)
+
+    insert = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    table = AirQualityReading.__table__
+    written = {}
+
+    for keys, rows in groups.items():
+        for start in range(0, len(rows), UPSERT_CHUNK_ROWS):
+            stmt = insert(table).values(rows[start:start + UPSERT_CHUNK_ROWS])
+            update_cols = {key: stmt.excluded[key] for key in keys if key != 'id'}
+            update_cols['created_at'] = stmt.excluded.created_at
+            stmt = stmt.on_conflict_do_update(index_elements=['id'], set_=update_cols)
+            stmt = stmt.returning(*[table.c[field] for field in READING_FIELDS])
+            for row in db.session.execute(stmt).mappings():
+                written[row['id']] = dict(row)
+
+    # Every queued reading gets a history row, not just the last one per id;
+    # earlier readings take any field they did not send from the final row
+    record_history([
+        {**written[reading_data['id']], **{key: reading_data[key] for key in reading_data if key in written[reading_data['id']]}}
+        for reading_data in readings
+    ])
+    if checkpoint is not None:
+        save_checkpoint(*checkpoint)
+    announce_readings(list(written.values()))
+    db.session.commit()
+    readings_committed(list(written.values()))
+
+    return len(merged)
+
+# Spooled readings waiting to be written, as of the last flush; the webhook
+# answers 503 once it reaches INGEST_QUEUE_SIZE
+spool_backlog = 0
+# Set when an uplink is spooled, to wake the flusher
+ingest_wakeup = threading.Event()
+# How often an idle flusher checks the spool for readings other processes
+# left behind (e.g. a worker killed between acknowledging and flushing)
+INGEST_SPOOL_POLL_SECONDS = 5
+ingest_thread = None
+ingest_thread_lock = threading.Lock()
+
+def flush_spool(batch_size=INGEST_BATCH_SIZE):
+    """
+    Write up to batch_size spooled readings, oldest first, and remove them
+    from the spool in the same transaction
+    Returns how many were written; 0 when the spool is empty or another
+    process is flushing it (readings of one location must stay in order)
+    """
+    global spool_backlog
+    with app.app_context():
+        try:
+            if db.engine.dialect.name == 'postgresql' and not db.session.execute(
+                db.text("SELECT pg_try_advisory_xact_lock(hashtext('ingest_spool'))")
+            ).scalar():
+                return 0
+            spooled = db.session.execute(
+                db.select(IngestSpool.seq, IngestSpool.reading).order_by(IngestSpool.seq).limit(batch_size)
+            ).all()
+            if spooled:
+                db.session.execute(IngestSpool.__table__.delete().where(IngestSpool.seq.in_([seq for seq, _ in spooled])))
+                upsert_readings([json.loads(reading) for _, reading in spooled])
+            spool_backlog = db.session.query(db.func.count(IngestSpool.seq)).scalar()
+            db.session.commit()
+            return len(spooled)
+        except Exception:
+            db.session.rollback()
+            raise
+
+def periodic_ingest_flush(batch_size=INGEST_BATCH_SIZE, batch_wait_ms=INGEST_BATCH_WAIT_MS):
+    """
+    Drain the spool in batches bounded by size and wait time
+    A batch that fails stays in the spool and is retried with backoff until
+    it is written: every reading in it has already been acknowledged
+    """
+    failures = 0
+    while True:
+        try:
+            flushed = flush_spool(batch_size)
+        except Exception as e:
+            failures += 1
+            logger.warning("Error flushing ingest batch", extra={'attempt': failures, 'error': str(e)})
+            time.sleep(min(0.5 * 2 ** (failures - 1), 30))
+            continue
+        if failures:
+            logger.info("Flushed ingest batch after retries", extra={'attempts': failures + 1})
+            failures = 0
+        if flushed:
+            logger.debug("Flushed ingest batch", extra={'readings': flushed})
+        if flushed == batch_size:
+            continue
+
+        # Wait for the next uplink, then give the batch time to fill
+        if ingest_wakeup.wait(INGEST_SPOOL_POLL_SECONDS):
+            ingest_wakeup.clear()
+            time.sleep(batch_wait_ms / 1000)
+
+def drain_ingest_queue(timeout=10):
+    """Wait until the spool is empty (or timeout seconds pass)"""
+    deadline = time.monotonic() + timeout
+    while True:
+        with app.app_context():
+            remaining = db.session.query(db.func.count(IngestSpool.seq)).scalar()
+        if remaining == 0 or time.monotonic() >= deadline:
+            return remaining == 0
+        ingest_wakeup.set()
+        time.sleep(0.01)
+
+@app.before_request
+def start_ingest_thread(batch_size=INGEST_BATCH_SIZE, batch_wait_ms=INGEST_BATCH_WAIT_MS):
+    """
+    Start the background batch flusher once per process, in batch mode
+    Started on any request, so readings spooled by a worker that died are
+    flushed even before the next uplink arrives
+    """
+    global ingest_thread
+    if INGEST_MODE != 'batch' or (ingest_thread is not None and ingest_thread.is_alive()):
         return
-    
-    # for i, reading in enumerate(readings, 1):
-    #     print(f"{i:2d}. Device: {reading.device_id}")
-    #     print(f"    Location: ({reading.la:.4f}, {reading.lo:.4f})")
-    #     print(f"    PM2.5: {reading.pm25} µg/m³, PM10: {reading.pm10} µg/m³")
-    #     print(f"    Time: {reading.t}")
-    #     print(f"    Added: {reading.created_at}")
-    #     print()
-    
-    print(f"Total readings: {len(readings)}")
-    print("="*60)
+    with ingest_thread_lock:
+        if ingest_thread is not None and ingest_thread.is_alive():
+            return
+        ingest_thread = threading.Thread(
+            target=periodic_ingest_flush,
+            args=(batch_size, batch_wait_ms),
+            daemon=True
+        )
+        ingest_thread.start()
+        logger.info("Started ingest flush thread", extra={'batch_size': batch_size, 'batch_wait_ms': batch_wait_ms})
+
+def enqueue_reading(reading_data):
+    """
+    Spool a validated reading for the batch flusher; returns False if the
+    spool is full. The reading is committed before this returns, so an
+    acknowledged uplink survives the process dying
+    """
+    if spool_backlog >= INGEST_QUEUE_SIZE:
+        return False
+    db.session.execute(IngestSpool.__table__.insert().values(reading=json.dumps(reading_data), received_at=datetime.utcnow()))
+    db.session.commit()
+    ingest_wakeup.set()
+    return True
+
+@app.cli.command('replay-frames')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch', 'batch_rows', type=int, default=INGEST_BATCH_SIZE, show_default=True, help='Frames per upsert')
+def replay_frames_command(path, batch_rows):
+    """Load a file of binary frames written back to back (e.g. from a gateway log)"""
+    rows = 0
+    start = time.time()
+    with open(path, 'rb') as frames_file:
+        while True:
+            buffer = frames_file.read(FRAME_SIZE * batch_rows)
+            if not buffer:
+                break
+            readings = [validate_reading(reading) for reading in columns_to_readings(decode_frames(buffer))]
+            upsert_readings(readings)
+            rows += len(readings)
+    print(f"Replayed {rows} frames from {path} in {time.time() - start:.1f}s")
 
 # Website routes
+
 @app.route('/')
 def index():
     """Serve the main map page"""
@@ -360,45 +1625,423 @@ def serve_css():
 def serve_js():
     return send_from_directory('.', 'map.js', mimetype='application/javascript')
 
+def is_valid_location(reading):
+    return reading.la != -1 and reading.lo != -1
+
+def reading_to_json(reading, now=None):
+    """Serialize a reading for the map, with its data age in hours"""
+    if now is None:
+        now = time.time()
+    data = reading_values(reading)
+    data['age_hours'] = (now - reading.t) / 3600
+    return data
+
+# Rows newer than this may still have uncommitted neighbours (created_at is
+# set by the app before commit), so change cursors never pass now minus this
+CHANGES_SETTLE_SECONDS = 5
+CHANGES_LIMIT = 1000
+
+def changes_cursor(reading):
+    """Cursor pointing just past a reading in (created_at, id) order"""
+    return f"{reading.created_at.isoformat()},{reading.id}"
+
+def next_changes_cursor(last_reading, since=None):
+    """
+    Cursor just past last_reading, held back to now minus CHANGES_SETTLE_SECONDS
+    so rows that commit late with an earlier created_at are still picked up
+    """
+    if last_reading is None:
+        return since
+    settled = datetime.utcnow() - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    if last_reading.created_at <= settled:
+        return changes_cursor(last_reading)
+    return settled.isoformat()
+
+def parse_changes_cursor(cursor):
+    """Parse '<iso created_at>[,<id>]'; raises ValueError if malformed"""
+    created_at, _, reading_id = cursor.partition(',')
+    return datetime.fromisoformat(created_at), int(reading_id) if reading_id else None
+
 @app.route('/api/data/latest', methods=['GET'])
 def get_latest_data():
-    """Get latest air quality data for the map"""
+    """
+    Get latest air quality data for the map
+    Supports conditional GET: a matching If-None-Match gets a 304 straight
+    from the in-memory data version, without touching the database
+    """
+    # Read the version before querying so a concurrent write is never hidden
+    etag = data_etag()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
     readings = AirQualityReading.query.order_by(AirQualityReading.created_at.desc()).limit(50).all()
     
-    data = []
-    for reading in readings:
-        # Calculate data age in hours
-        age = (time.time() - reading.t) / 3600
+    now = time.time()
+    data = [reading_to_json(reading, now) for reading in readings if is_valid_location(reading)]
 
-        if reading.la == -1 or reading.lo == -1:
-            continue  # Skip invalid locations
-        
-        data.append({
-            'id': reading.id,
-            't': reading.t,
-            'la': reading.la,
-            'lo': reading.lo,
-            'lad': reading.lad,
-            'lod': reading.lod,
-            'bs': reading.bs,
-            'pm1': reading.pm1,
-            'pm25': reading.pm25,
-            'pm10': reading.pm10,
-            'p0p3': reading.p0p3,
-            'p0p5': reading.p0p5,
-            'p1': reading.p1,
-            'p2p5': reading.p2p5,
-            'p5': reading.p5,
-            'p10': reading.p10,
-            'v': reading.v,
-            'n': reading.n,
-            'c': reading.c,
-            'tmp': reading.tmp,
-            'rh': reading.rh,
-            'src': reading.src,
-            'age_hours': age,
-        })
+    # Starting point for /api/data/changes
+    cursor = next_changes_cursor(readings[0] if readings else None)
     
+    # Weak ETag: age_hours drifts between calls but the readings do not
+    response = jsonify({'data': data, 'count': len(data), 'cursor': cursor})
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/data/changes', methods=['GET'])
+def get_data_changes():
+    """
+    Get readings created or updated after a cursor, oldest first
+    Query params: since (cursor from /api/data/latest or a previous call;
+    omitted means from the beginning), limit (max rows, default and cap 1000)
+    Returns the changed readings, a new cursor and whether more are waiting.
+    The cursor trails the newest rows by a few seconds, so a reading may be
+    sent twice; clients should apply changes idempotently by id. Deletes
+    (retention) are not reported: after a reset, reload in full.
+    """
+    etag = data_etag()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    query = AirQualityReading.query
+    since = request.args.get('since')
+    if since:
+        try:
+            since_created_at, since_id = parse_changes_cursor(since)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'invalid cursor'}), 400
+
+        if since_id is None:
+            query = query.filter(AirQualityReading.created_at >= since_created_at)
+        else:
+            # A row-value comparison, which the (created_at, id) index seeks to
+            query = query.filter(db.tuple_(AirQualityReading.created_at, AirQualityReading.id) > (since_created_at, since_id))
+
+    limit = min(request.args.get('limit', CHANGES_LIMIT, type=int), CHANGES_LIMIT)
+    readings = query.order_by(AirQualityReading.created_at, AirQualityReading.id).limit(limit).all()
+
+    cursor = next_changes_cursor(readings[-1] if readings else None, since)
+
+    now = time.time()
+    data = [reading_to_json(reading, now) for reading in readings if is_valid_location(reading)]
+
+    response = jsonify({'data': data, 'count': len(data), 'cursor': cursor, 'more': len(readings) == limit})
+    response.set_etag(etag, weak=True)
+    return response
+
+# Readings are returned individually from this zoom level up (matches the
+# point at which map.js switches to large numbered markers)
+VIEWPORT_POINTS_MIN_ZOOM = 14
+# More readings than this in the viewport are clustered at any zoom
+VIEWPORT_MAX_POINTS = 2000
+# Clusters cover a square of about this many screen pixels
+VIEWPORT_CLUSTER_PIXELS = 60
+# Upper bound on grid cells (and so clusters) per response
+VIEWPORT_MAX_CLUSTERS = 1000
+
+def parse_bbox(bbox):
+    """Parse 'west,south,east,north' (Leaflet toBBoxString order); raises ValueError"""
+    west, south, east, north = (float(value) for value in bbox.split(','))
+    if not (-180 <= west <= east <= 180 and -90 <= south <= north <= 90):
+        raise ValueError("bbox must be west,south,east,north")
+    return west, south, east, north
+
+def cluster_readings(west, south, east, north, zoom):
+    """
+    Group the readings in a bounding box into grid cells of about
+    VIEWPORT_CLUSTER_PIXELS at the given zoom, aggregated in SQL
+    The number of clusters is bounded by VIEWPORT_MAX_CLUSTERS, whatever the
+    number of sensors
+    """
+    # Degrees per pixel in Web Mercator, using the viewport's centre latitude
+    # for the vertical scale, which is accurate enough at city scale
+    lon_per_pixel = 360 / (256 * 2 ** zoom)
+    lat_per_pixel = lon_per_pixel * cos(radians((south + north) / 2))
+    cell_lon = lon_per_pixel * VIEWPORT_CLUSTER_PIXELS
+    cell_lat = lat_per_pixel * VIEWPORT_CLUSTER_PIXELS
+
+    # A box much larger than a screen at this zoom gets coarser cells
+    while ((east - west) / cell_lon + 1) * ((north - south) / cell_lat + 1) > VIEWPORT_MAX_CLUSTERS:
+        cell_lon *= 2
+        cell_lat *= 2
+
+    # Floor before the cast: Postgres rounds floats cast to integer, which
+    # would shift every cell by half
+    column = db.cast(db.func.floor((AirQualityReading.lo - west) / cell_lon), db.Integer).label('column')
+    row = db.cast(db.func.floor((AirQualityReading.la - south) / cell_lat), db.Integer).label('row')
+
+    query = db.select(
+        column, row,
+        db.func.count().label('count'),
+        db.func.avg(AirQualityReading.la).label('la'),
+        db.func.avg(AirQualityReading.lo).label('lo'),
+        db.func.min(AirQualityReading.la).label('south'),
+        db.func.min(AirQualityReading.lo).label('west'),
+        db.func.max(AirQualityReading.la).label('north'),
+        db.func.max(AirQualityReading.lo).label('east'),
+        # AQI rises with concentration, so the cluster's max AQI comes
+        # from its max PM2.5 and PM10
+        db.func.max(AirQualityReading.pm25).label('pm25'),
+        db.func.max(AirQualityReading.pm10).label('pm10'),
+        db.func.max(AirQualityReading.t).label('t'),
+    ).where(
+        AirQualityReading.la.between(south, north),
+        AirQualityReading.lo.between(west, east),
+        AirQualityReading.la != -1,
+        AirQualityReading.lo != -1
+    ).group_by(column, row)
+
+    clusters = []
+    for cluster in db.session.execute(query).mappings():
+        aqi, pollutant = max_aqi(cluster['pm25'], cluster['pm10'])
+        clusters.append({
+            'count': cluster['count'],
+            'la': cluster['la'],
+            'lo': cluster['lo'],
+            'bbox': [cluster['west'], cluster['south'], cluster['east'], cluster['north']],
+            'max_aqi': aqi,
+            'pollutant': pollutant,
+            't': cluster['t'],
+        })
+    return clusters
+
+def query_viewport(west, south, east, north, zoom):
+    """
+    Readings inside a bounding box as ('points', readings), or as
+    ('clusters', clusters) below VIEWPORT_POINTS_MIN_ZOOM or when the box
+    holds more than VIEWPORT_MAX_POINTS readings
+    """
+    if zoom >= VIEWPORT_POINTS_MIN_ZOOM:
+        readings = AirQualityReading.query.filter(
+            AirQualityReading.la.between(south, north),
+            AirQualityReading.lo.between(west, east),
+            AirQualityReading.la != -1,
+            AirQualityReading.lo != -1
+        ).order_by(AirQualityReading.id).limit(VIEWPORT_MAX_POINTS + 1).all()
+
+        if len(readings) <= VIEWPORT_MAX_POINTS:
+            return 'points', readings
+
+    return 'clusters', cluster_readings(west, south, east, north, zoom)
+
+@app.route('/api/data/viewport', methods=['GET'])
+def get_viewport_data():
+    """
+    Get the readings inside a map viewport
+    Query params: bbox (west,south,east,north), zoom (map zoom level)
+    Below VIEWPORT_POINTS_MIN_ZOOM, or when the box holds more than
+    VIEWPORT_MAX_POINTS readings, returns clusters with counts and max AQI
+    instead of individual readings
+    """
+    try:
+        west, south, east, north = parse_bbox(request.args.get('bbox', ''))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'bbox must be west,south,east,north'}), 400
+    zoom = request.args.get('zoom', type=int)
+    if zoom is None or not 0 <= zoom <= 22:
+        return jsonify({'status': 'error', 'message': 'zoom must be an integer from 0 to 22'}), 400
+
+    mode, data = query_viewport(west, south, east, north, zoom)
+    if mode == 'points':
+        now = time.time()
+        data = [reading_to_json(reading, now) for reading in data]
+
+    return jsonify({'mode': mode, 'zoom': zoom, 'data': data, 'count': len(data)})
+
+NEAR_DEFAULT_RADIUS_METERS = 500
+NEAR_MAX_RADIUS_METERS = float(os.getenv('NEAR_MAX_RADIUS_METERS', '10000'))
+NEAR_MAX_K = 100
+
+@app.route('/api/data/near', methods=['GET'])
+def get_near_data():
+    """
+    Get the readings nearest a point, nearest first
+    Query params: lat, lon (required), radius (meters, default 500, cap
+    NEAR_MAX_RADIUS_METERS), k (max readings, default 10, cap 100)
+    Each reading carries its distance from the point in meters
+    """
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({'status': 'error', 'message': 'lat and lon are required'}), 400
+    radius = min(request.args.get('radius', NEAR_DEFAULT_RADIUS_METERS, type=float), NEAR_MAX_RADIUS_METERS)
+    k = min(request.args.get('k', 10, type=int), NEAR_MAX_K)
+    if not (radius > 0 and k >= 1):
+        return jsonify({'status': 'error', 'message': 'radius and k must be positive'}), 400
+
+    now = time.time()
+    data = [
+        {**reading_to_json(reading, now), 'distance': round(distance, 1)}
+        for reading, distance in query_near(lat, lon, radius, k)
+    ]
+
+    return jsonify({'data': data, 'count': len(data)})
+
+# Rendered tiles per (z, x, y); a new reading evicts only the tiles it lands in
+TILE_MAX_ZOOM = 18
+TILE_MAX_AGE = int(os.getenv('TILE_MAX_AGE', '30'))  # Cache-Control for browsers/CDN
+tile_cache = TileCache(
+    max_entries=int(os.getenv('TILE_CACHE_SIZE', '5000')),
+    ttl=int(os.getenv('TILE_CACHE_TTL', '60'))
+)
+
+def invalidate_tiles(rows):
+    """Evict the cached tiles, at every zoom, that the given readings fall in"""
+    # Even with nothing cached, a render in progress must not be cached
+    keys = set()
+    for row in rows:
+        if row['la'] is None or row['lo'] is None or row['la'] == -1 or row['lo'] == -1:
+            continue
+        keys |= tiles_for_point(row['la'], row['lo'], range(TILE_MAX_ZOOM + 1))
+    return tile_cache.invalidate(keys)
+
+def render_tile(z, x, y):
+    """Build the GeoJSON FeatureCollection for one tile"""
+    west, south, east, north = tile_bounds(z, x, y)
+    mode, data = query_viewport(west, south, east, north, z)
+
+    features = []
+    if mode == 'points':
+        for reading in data:
+            properties = reading_values(reading)
+            properties['max_aqi'], properties['pollutant'] = max_aqi(reading.pm25, reading.pm10)
+            features.append({
+                'type': 'Feature',
+                'id': reading.id,
+                'geometry': {'type': 'Point', 'coordinates': [reading.lo, reading.la]},
+                'properties': properties,
+            })
+    else:
+        for cluster in data:
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [cluster['lo'], cluster['la']]},
+                'properties': {'cluster': True, **{key: cluster[key] for key in ('count', 'bbox', 'max_aqi', 'pollutant', 't')}},
+            })
+
+    # Ages are left out so the tile only changes when its readings do
+    return json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':'))
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>', methods=['GET'])
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.geojson', methods=['GET'])
+def get_tile(z, x, y):
+    """
+    Get the readings in one slippy map tile as GeoJSON
+    Individual readings from zoom 14 up, clusters below (see /api/data/viewport)
+    """
+    if not 0 <= z <= TILE_MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({'status': 'error', 'message': 'tile out of range'}), 404
+
+    key = (z, x, y)
+    cached = tile_cache.get(key)
+    if cached is None:
+        token = tile_cache.reserve(key)
+        try:
+            body = render_tile(z, x, y)
+        except Exception:
+            tile_cache.release(key, token)
+            raise
+        cached = (body, hashlib.sha1(body.encode()).hexdigest()[:16])
+        tile_cache.put(key, cached, token)
+
+    body, etag = cached
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/geo+json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={TILE_MAX_AGE}'
+    return response
+
+@app.route('/api/stream', methods=['GET'])
+def stream_readings():
+    """
+    Server-Sent Events stream of readings as they are committed
+    Each 'reading' event carries the same fields as /api/data/latest. A
+    reconnecting client's Last-Event-ID resumes where it left off; if those
+    events are gone a 'reset' event asks it to reload /api/data/latest.
+    Served under gevent workers only (see STREAM_ENABLED), so idle
+    subscribers do not each hold a thread; elsewhere it answers 204, which
+    tells EventSource not to reconnect.
+    """
+    if not (STREAM_ENABLED == '1' if STREAM_ENABLED else gevent_patched()):
+        return app.response_class(status=204)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+
+    return Response(
+        reading_stream.subscribe(last_event_id, heartbeat=STREAM_HEARTBEAT_SECONDS),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/data/history', methods=['GET'])
+def get_history_data():
+    """
+    Get the recorded history of one location
+    Query params: id (location ID, required), from/to (epoch seconds, inclusive,
+    default the last 24 hours), limit (max rows, default and cap 10000)
+    """
+    location_id = request.args.get('id', type=int)
+    if location_id is None:
+        return jsonify({'status': 'error', 'message': 'id is required'}), 400
+
+    end_time = request.args.get('to', type=int)
+    if end_time is None:
+        end_time = int(time.time())
+    start_time = request.args.get('from', type=int)
+    if start_time is None:
+        start_time = end_time - SECONDS_PER_DAY
+    if start_time > end_time:
+        return jsonify({'status': 'error', 'message': 'from must not be after to'}), 400
+
+    limit = min(request.args.get('limit', 10000, type=int), 10000)
+
+    # The bounds on t let Postgres prune to the partitions for those days
+    readings = AirQualityHistory.query.filter(
+        AirQualityHistory.id == location_id,
+        AirQualityHistory.t >= start_time,
+        AirQualityHistory.t <= end_time
+    ).order_by(AirQualityHistory.t).limit(limit).all()
+
+    data = [reading_values(reading) for reading in readings]
+
+    return jsonify({'data': data, 'count': len(data)})
+
+@app.route('/api/data/rollup', methods=['GET'])
+def get_rollup_data():
+    """
+    Get hourly or daily mean/min/max per location from the rollup tables
+    Query params: period (hour or day, default hour), id (optional location ID),
+    from/to (epoch seconds of bucket starts, default the last 24 hours)
+    """
+    period = ROLLUP_PERIODS.get(request.args.get('period', 'hour'))
+    if period is None:
+        return jsonify({'status': 'error', 'message': 'period must be hour or day'}), 400
+
+    end_time = request.args.get('to', type=int)
+    if end_time is None:
+        end_time = int(time.time())
+    start_time = request.args.get('from', type=int)
+    if start_time is None:
+        start_time = end_time - SECONDS_PER_DAY
+
+    query = AirQualityRollup.query.filter(
+        AirQualityRollup.period == period,
+        AirQualityRollup.bucket >= start_time - start_time % period,
+        AirQualityRollup.bucket <= end_time
+    )
+    location_id = request.args.get('id', type=int)
+    if location_id is not None:
+        query = query.filter(AirQualityRollup.id == location_id)
+
+    data = [rollup_to_dict(rollup) for rollup in query.order_by(AirQualityRollup.id, AirQualityRollup.bucket)]
+
     return jsonify({'data': data, 'count': len(data)})
 
 collecting_data = False
@@ -409,21 +2052,28 @@ def handle_tts_webhook():
     Handle TTS downlink webhook
     Expected TTS payload structure (you may need to adjust based on your actual TTS format)
     """
+    started = time.perf_counter()
     try:
         data = request.get_json()
-        print(f"\nReceived TTS webhook: {datetime.now()}")
-        print(f"Raw payload: {data}")
-
-        raw_text = data["uplink_message"]["decoded_payload"].get('text')
-
-        cleaned_text = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', raw_text)  # Remove control chars
-        cleaned_text = cleaned_text.replace(' ', '')
-
-        print(cleaned_text)
+        json_data = parse_tts_payload(data)
+        stage_started = time_stage('parse', started)
 
-        json_data = json.loads(cleaned_text)
+        if sampled(LOG_PAYLOAD_SAMPLE_RATE):
+            logger.info("Received TTS webhook", extra={'payload': data, 'reading': json_data})
 
-        print(f"Parsed JSON data: {json_data}")
+        if INGEST_MODE == 'batch':
+            # Acknowledge once spooled; the flusher upserts in batches
+            reading_data = validate_reading(json_data)
+            try:
+                spooled = enqueue_reading(reading_data)
+            except Exception:
+                db.session.rollback()
+                logger.exception("Could not spool uplink")
+                return jsonify({'status': 'error', 'message': 'ingest spool unavailable'}), 503
+            if not spooled:
+                return jsonify({'status': 'error', 'message': 'ingest queue full'}), 503
+            time_stage('total', started)
+            return jsonify({'status': 'queued', 'action': 'batch'}), 202
 
         lat = json_data.get('la')
         lon = json_data.get('lo')
@@ -435,90 +2085,303 @@ def handle_tts_webhook():
         
         # Check if database entry already exists by location ID
         existing_entry = AirQualityReading.query.filter_by(id=location_id).first()
+        stage_started = time_stage('lookup', stage_started)
         if existing_entry:
             # Update existing entry by location
-            print(f"Found existing entry at location ({lat}, {lon}) - updating")
-            
             for key, value in json_data.items():
                 setattr(existing_entry, key, value)
 
             existing_entry.created_at = datetime.utcnow()
+            written_values = reading_values(existing_entry)
+            record_history([written_values])
+            announce_readings([written_values])
             db.session.commit()
-            print(f"Existing location entry updated in database")
-
-            # Print all data points after update
-            print_all_data()
+            time_stage('commit', stage_started)
+            readings_committed([written_values])
 
+            logger.debug("Updated reading", extra={'id': location_id, 'la': lat, 'lo': lon})
+            time_stage('total', started)
             return jsonify({'status': 'data_updated', 'action': 'update_location'}), 200
         
         # Create dummy reading with location-based ID
-        reading = AirQualityReading(
-            id=location_id,
-            t=json_data.get('t'),
-            la=-1,
-            lo=-1,
-            lad=None,
-            lod=None,
-            bs=-1,
-            pm1=-1,
-            pm25=-1,
-            pm10=-1,
-            p0p3=-1,
-            p0p5=-1,
-            p1=-1,
-            p2p5=-1,
-            p5=-1,
-            p10=-1,
-            v=-1,
-            n=-1,
-            c=-1,
-            tmp=-1,
-            rh=-1,
-            src=-1
-        )
+        reading = AirQualityReading(id=location_id, **READING_DEFAULTS)
 
         for key, value in json_data.items():
             setattr(reading, key, value)
 
         db.session.add(reading)
+        written_values = reading_values(reading)
+        record_history([written_values])
+        announce_readings([written_values])
         db.session.commit()
+        time_stage('commit', stage_started)
+        readings_committed([written_values])
 
-        print(f"New data point saved to database!")
-
-        # Print all data points after new addition
-        print_all_data()
-
+        logger.debug("Created reading", extra={'id': location_id, 'la': lat, 'lo': lon})
+        time_stage('total', started)
         return jsonify({'status': 'data_received', 'action': 'create_new'}), 200
         
     except Exception as e:
-        print(f"Error processing TTS webhook: {e}")
+        logger.exception("Error processing TTS webhook")
         db.session.rollback()
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Simple health check"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
+    """Simple health check, with the progress of the last retention pass"""
+    return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat(), 'retention': retention_status})
+
+METRICS_TABLES = {
+    'air_quality_readings': AirQualityReading,
+    'air_quality_history': AirQualityHistory,
+    'air_quality_rollups': AirQualityRollup,
+    'job_runs': JobRun,
+}
+
+class TableRowsCollector:
+    """
+    sniff_table_rows, read at scrape time: the planner's estimate on Postgres
+    (summed over partitions), an exact count elsewhere
+    """
+
+    def collect(self):
+        family = GaugeMetricFamily('sniff_table_rows', 'Rows per table (estimated on Postgres)', labels=['table'])
+        with app.app_context():
+            for name, model in METRICS_TABLES.items():
+                if db.engine.dialect.name == 'postgresql':
+                    rows = db.session.execute(db.text(
+                        "SELECT coalesce(sum(greatest(reltuples, 0)), 0) FROM pg_class "
+                        "WHERE relname = :name OR oid IN ("
+                        "SELECT inhrelid FROM pg_inherits JOIN pg_class parent ON parent.oid = inhparent "
+                        "WHERE parent.relname = :name)"
+                    ), {'name': name}).scalar()
+                else:
+                    rows = db.session.query(db.func.count()).select_from(model).scalar()
+                family.add_metric([name], float(rows))
+            db.session.commit()
+        yield family
+
+table_rows_collector = TableRowsCollector()
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics: webhook stage timings, database, jobs and table sizes"""
+    body, content_type = metrics.exposition([table_rows_collector])
+    return Response(body, content_type=content_type)
+
+# Rows fetched per round trip while streaming an export
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '2000'))
+EXPORT_TABLES = {'readings': AirQualityReading, 'history': AirQualityHistory}
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def export_query(model, start_time=None, end_time=None, after_id=None, after_t=None, limit=None):
+    """
+    SELECT of READING_FIELDS from model ordered by (id, t), the history
+    primary key, so after_id/after_t resume an export with an index seek
+    """
+    columns = [getattr(model, field) for field in READING_FIELDS]
+    query = db.select(*columns).order_by(model.id, model.t)
+
+    if start_time is not None:
+        query = query.where(model.t >= start_time)
+    if end_time is not None:
+        query = query.where(model.t <= end_time)
+    if after_id is not None:
+        if after_t is None:
+            query = query.where(model.id > after_id)
+        else:
+            query = query.where(db.tuple_(model.id, model.t) > (after_id, after_t))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def export_rows(query, fmt):
+    """
+    Generate an export body chunk by chunk
+    The rows come from a server-side cursor, so memory use does not grow
+    with the size of the table
+    """
+    if fmt == 'csv':
+        yield ','.join(READING_FIELDS) + '\n'
+
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS).execute(query)
+        for rows in result.partitions():
+            if fmt == 'csv':
+                buffer = io.StringIO()
+                csv.writer(buffer, lineterminator='\n').writerows(
+                    ['' if value is None else value for value in row] for row in rows
+                )
+                yield buffer.getvalue()
+            else:
+                yield ''.join(
+                    json.dumps(dict(zip(READING_FIELDS, row)), separators=(',', ':')) + '\n'
+                    for row in rows
+                )
+
+# Columnar exports query one day of t at a time, which lines up with the
+# history partitions and keeps each statement short
+COLUMNAR_EXPORT_CHUNK_SECONDS = SECONDS_PER_DAY
+COLUMNAR_FORMATS = {'parquet': 'application/vnd.apache.parquet', 'arrow': 'application/vnd.apache.arrow.stream'}
+
+def export_batches(model, start_time=None, end_time=None):
+    """
+    Arrow record batches of the readings in model with start_time <= t <= end_time
+    (default the whole table), ordered by t, read from a server-side cursor
+    one time chunk at a time
+    """
+    with db.engine.connect() as connection:
+        if start_time is None or end_time is None:
+            low, high = connection.execute(db.select(db.func.min(model.t), db.func.max(model.t))).one()
+            if low is None:
+                return
+            start_time = low if start_time is None else start_time
+            end_time = high if end_time is None else end_time
+
+        columns = [getattr(model, field) for field in READING_FIELDS]
+        streaming = connection.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS)
+        for chunk_start in range(start_time, end_time + 1, COLUMNAR_EXPORT_CHUNK_SECONDS):
+            chunk_end = min(chunk_start + COLUMNAR_EXPORT_CHUNK_SECONDS, end_time + 1)
+            query = db.select(*columns).where(
+                model.t >= chunk_start,
+                model.t < chunk_end
+            ).order_by(model.t, model.id)
+            for rows in streaming.execute(query).partitions():
+                yield record_batch(rows, READING_FIELDS)
+
+def columnar_stream(batches, fmt):
+    """Generate a Parquet or Arrow stream body as each row group is written"""
+    sink = ChunkSink()
+    for _ in write_batches(batches, sink, fmt):
+        data = sink.drain()
+        if data:
+            yield data
+
+@app.route('/api/export.<any(parquet, arrow):fmt>', methods=['GET'])
+def export_columnar(fmt):
+    """
+    Export readings as Parquet or an Arrow IPC stream for analysis in pandas
+    Query params: table (readings, the default, or history), from/to (epoch
+    seconds on t, inclusive, default the whole table)
+    Measurements are float32 and lad/lod/src are dictionary encoded; rows
+    without a timestamp are left out
+    """
+    table = request.args.get('table', 'readings')
+    model = EXPORT_TABLES.get(table)
+    if model is None:
+        return jsonify({'status': 'error', 'message': 'table must be readings or history'}), 400
+    start_time = request.args.get('from', type=int)
+    end_time = request.args.get('to', type=int)
+    if start_time is not None and end_time is not None and start_time > end_time:
+        return jsonify({'status': 'error', 'message': 'from must not be after to'}), 400
+
+    response = Response(
+        stream_with_context(columnar_stream(export_batches(model, start_time, end_time), fmt)),
+        mimetype=COLUMNAR_FORMATS[fmt]
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename=sniff-{table}.{fmt}'
+    return response
+
+@app.cli.command('export-readings')
+@click.argument('output', type=click.Path(dir_okay=False, writable=True))
+@click.option('--table', type=click.Choice(list(EXPORT_TABLES)), default='readings', show_default=True)
+@click.option('--from', 'start_time', type=int, help='Earliest t (epoch seconds, inclusive)')
+@click.option('--to', 'end_time', type=int, help='Latest t (epoch seconds, inclusive)')
+@click.option('--format', 'fmt', type=click.Choice(list(COLUMNAR_FORMATS)), help='Default from the file extension')
+def export_readings_command(output, table, start_time, end_time, fmt):
+    """Write readings to a Parquet or Arrow file"""
+    if fmt is None:
+        fmt = 'arrow' if output.endswith(('.arrow', '.arrows')) else 'parquet'
+
+    rows = 0
+    def counted(batches):
+        nonlocal rows
+        for batch in batches:
+            rows += batch.num_rows
+            yield batch
+
+    start = time.time()
+    for _ in write_batches(counted(export_batches(EXPORT_TABLES[table], start_time, end_time)), output, fmt):
+        pass
+    print(f"Wrote {rows} {table} rows to {output} in {time.time() - start:.1f}s")
 
 @app.route('/data', methods=['GET'])
 def get_all_data():
-    """Get all data points as JSON"""
-    readings = AirQualityReading.query.order_by(AirQualityReading.created_at.desc()).all()
-    
-    data = []
-    # for reading in readings:
-    #     data.append({
-    #         'id': reading.id,
-    #         'device_id': reading.device_id,
-    #         'latitude': reading.latitude,
-    #         'longitude': reading.longitude,
-    #         'timestamp': reading.timestamp.isoformat(),
-    #         'pm2_5': reading.pm2_5,
-    #         'pm10': reading.pm10,
-    #         'created_at': reading.created_at.isoformat()
-    #     })
-    
-    return jsonify({'data': data, 'count': len(data)})
+    """
+    Stream an export of readings as NDJSON (default) or CSV
+    Query params: format (ndjson or csv), table (readings, the default, or
+    history), from/to (epoch seconds on t, inclusive), after_id/after_t
+    (resume after the last exported row), limit (max rows)
+    Rows are ordered by (id, t)
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'status': 'error', 'message': 'format must be ndjson or csv'}), 400
+    model = EXPORT_TABLES.get(request.args.get('table', 'readings'))
+    if model is None:
+        return jsonify({'status': 'error', 'message': 'table must be readings or history'}), 400
+
+    params = {}
+    for name in ('from', 'to', 'after_id', 'after_t', 'limit'):
+        value = request.args.get(name)
+        if value is None:
+            continue
+        try:
+            params[name] = int(value)
+        except ValueError:
+            return jsonify({'status': 'error', 'message': f'{name} must be an integer'}), 400
+    if 'after_t' in params and 'after_id' not in params:
+        return jsonify({'status': 'error', 'message': 'after_t requires after_id'}), 400
+    if params.get('limit', 0) < 0:
+        return jsonify({'status': 'error', 'message': 'limit must not be negative'}), 400
+
+    query = export_query(
+        model,
+        start_time=params.get('from'),
+        end_time=params.get('to'),
+        after_id=params.get('after_id'),
+        after_t=params.get('after_t'),
+        limit=params.get('limit')
+    )
+
+    response = Response(stream_with_context(export_rows(query, fmt)), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename=sniff-{request.args.get("table", "readings")}.{fmt}'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Set RUN_JOBS_IN_WEB=1 to start the background jobs in the web process too
+RUN_JOBS_IN_WEB = os.getenv('RUN_JOBS_IN_WEB', '0') == '1'
+# Port for run-jobs to serve its own /metrics on (unset = none)
+JOBS_METRICS_PORT = int(os.getenv('JOBS_METRICS_PORT', '0'))
+
+def create_app(run_jobs=None):
+    """
+    Entry point for WSGI servers, e.g. gunicorn "app:create_app()": wait for
+    the database, create missing tables and return the app
+    Background jobs are left to their own process (flask --app app run-jobs)
+    unless run_jobs, or RUN_JOBS_IN_WEB, is set
+    """
+    if not wait_for_db():
+        raise RuntimeError("Could not connect to database")
+    if RUN_JOBS_IN_WEB if run_jobs is None else run_jobs:
+        start_scheduler()
+    return app
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """Run the background jobs (cleanup, ACHD import) until interrupted"""
+    if not wait_for_db():
+        raise SystemExit(1)
+    if JOBS_METRICS_PORT:
+        # The job metrics (ACHD, cleanup) live in this process
+        prometheus_client.start_http_server(JOBS_METRICS_PORT)
+        logger.info("Serving job metrics", extra={'port': JOBS_METRICS_PORT})
+    jobs = start_scheduler()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        jobs.stop()
 
 if __name__ == '__main__':
     print("Sniff Pittsburgh - Full Stack Air Quality Monitor")
@@ -529,17 +2392,11 @@ if __name__ == '__main__':
         print("Could not connect to database. Exiting.")
         exit(1)
     
-    # Start background cleanup thread
-    # Runs every 24 hours, keeps data from last 30 days
-    start_cleanup_thread(interval_hours=24, days_to_keep=30)
-    
-    # Start background ACHD data collection thread
-    # Runs every 1 hour to fetch latest ACHD air quality data
-    start_achd_thread(interval_hours=1)
-    
-    # Run initial ACHD data collection
-    print("\nRunning initial ACHD data collection...")
-    collect_achd_data()
+    # Start background jobs: daily cleanup (keeps data from last 30 days)
+    # and the hourly ACHD import. Runs missed while the server was down,
+    # including today's cleanup and this hour's import, are caught up at once
+    # (in production they run in their own process, see gunicorn.conf.py)
+    start_scheduler()
     
     print("\nWebsite available at:")
     print("   Main page: http://localhost/")
@@ -548,9 +2405,19 @@ if __name__ == '__main__':
     print("API endpoints:")
     print("   TTS webhook: http://localhost/tts-webhook")
     print("   Health check: http://localhost/health")
-    print("   All data: http://localhost/data")
+    print("   Export: http://localhost/data?format=ndjson|csv&table=readings|history")
     print("   Latest data: http://localhost/api/data/latest")
+    print("   Changes: http://localhost/api/data/changes?since=<cursor>")
+    print("   Live stream: http://localhost/api/stream")
+    print("   Viewport: http://localhost/api/data/viewport?bbox=west,south,east,north&zoom=")
+    print("   Near a point: http://localhost/api/data/near?lat=&lon=&radius=&k=")
+    print("   Tiles: http://localhost/tiles/{z}/{x}/{y}.geojson")
+    print("   Parquet export: http://localhost/api/export.parquet?from=&to=")
+    print("   History: http://localhost/api/data/history?id=&from=&to=")
+    print("   Rollups: http://localhost/api/data/rollup?period=hour&id=&from=&to=")
     print("="*55)
     
-    # Run the app
-    app.run(debug=True, host='0.0.0.0', port=80)
\ No newline at end of file
+    # Run the app on the single-process development server; for production
+    # use gunicorn -c gunicorn.conf.py. The reloader would start the
+    # background jobs twice, so it stays off even with FLASK_DEBUG=1
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', use_reloader=False, threaded=True, host='0.0.0.0', port=int(os.getenv('PORT', '80')))
\ No newline at end of file
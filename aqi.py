@@ -0,0 +1,75 @@
+"""
+US EPA AQI calculation for PM2.5 and PM10
+Python port of calculateAQI/getMaxAQI in map.js; keep the two in sync
+"""
+
+from math import floor
+
+# Breakpoint table for PM2.5 (24-hour) and PM10 (24-hour)
+# (C_low, C_high, I_low, I_high)
+BREAKPOINTS = {
+    'PM2.5': [
+        (0.0, 9.0, 0, 50),
+        (9.1, 35.4, 51, 100),
+        (35.5, 55.4, 101, 150),
+        (55.5, 125.4, 151, 200),
+        (125.5, 225.4, 201, 300),
+        (225.5, 500, 301, 500),
+    ],
+    'PM10': [
+        (0, 54, 0, 50),
+        (55, 154, 51, 100),
+        (155, 254, 101, 150),
+        (255, 354, 151, 200),
+        (355, 424, 201, 300),
+        (425, 604, 301, 500),
+    ],
+}
+
+def calculate_aqi(concentration, pollutant):
+    """
+    AQI for a PM2.5 or PM10 concentration (µg/m³)
+    Returns None for missing (None or negative) concentrations
+    """
+    if concentration is None or concentration < 0:
+        return None
+
+    # Truncate concentration based on pollutant type
+    if pollutant == 'PM2.5':
+        c_p = floor(concentration * 10) / 10
+    elif pollutant == 'PM10':
+        c_p = floor(concentration)
+    else:
+        return None
+
+    ranges = BREAKPOINTS[pollutant]
+    for c_low, c_high, i_low, i_high in ranges:
+        if c_low <= c_p <= c_high:
+            break
+    else:
+        # Beyond the highest breakpoint uses the highest range
+        if c_p <= ranges[-1][1]:
+            return None
+        c_low, c_high, i_low, i_high = ranges[-1]
+
+    i_p = (i_high - i_low) / (c_high - c_low) * (c_p - c_low) + i_low
+
+    # Round half up, like Math.round
+    return floor(i_p + 0.5)
+
+def max_aqi(pm25, pm10):
+    """Highest AQI across PM2.5 and PM10 as (aqi, pollutant), or (None, None)"""
+    candidates = [
+        (aqi, name)
+        for aqi, name in ((calculate_aqi(pm25, 'PM2.5'), 'PM2.5'), (calculate_aqi(pm10, 'PM10'), 'PM10'))
+        if aqi is not None
+    ]
+    if not candidates:
+        return None, None
+
+    # Ties go to PM2.5, as in getMaxAQI
+    best = candidates[0]
+    for candidate in candidates[1:]:
+        if candidate[0] > best[0]:
+            best = candidate
+    return best
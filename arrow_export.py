@@ -0,0 +1,107 @@
+"""
+Columnar export of readings for Sniff Pittsburgh
+Turns chunks of reading rows into Arrow record batches and writes them as
+Parquet or an Arrow IPC stream, a row group at a time
+"""
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Measurements are stored as double but never need more than float32
+# precision; coordinates keep float64 so locations stay exact to the meter
+MEASUREMENT_FIELDS = [
+    'bs', 'pm1', 'pm25', 'pm10', 'p0p3', 'p0p5',
+    'p1', 'p2p5', 'p5', 'p10', 'v', 'n', 'c', 'tmp', 'rh',
+]
+
+READING_SCHEMA = pa.schema(
+    [
+        ('id', pa.int64()),
+        ('t', pa.int64()),  # Epoch seconds
+        ('la', pa.float64()),
+        ('lo', pa.float64()),
+        ('lad', pa.dictionary(pa.int8(), pa.string())),
+        ('lod', pa.dictionary(pa.int8(), pa.string())),
+    ]
+    + [(field, pa.float32()) for field in MEASUREMENT_FIELDS]
+    + [('src', pa.dictionary(pa.int8(), pa.int32()))]
+)
+
+# Rows buffered before a Parquet row group is written; bounds memory use
+ROW_GROUP_ROWS = 131072
+
+def record_batch(rows, fields):
+    """
+    Arrow record batch of READING_SCHEMA from result rows (tuples in the
+    order of fields)
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+    arrays = []
+    for field in READING_SCHEMA:
+        values = columns[fields.index(field.name)]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=field.type.value_type).dictionary_encode().cast(field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=READING_SCHEMA)
+
+class ChunkSink:
+    """
+    Write-only file object that hands back what has been written so far,
+    so a writer's output can be streamed in an HTTP response
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def write_batches(batches, sink, fmt='parquet'):
+    """
+    Write record batches to sink (a path or file object) as Parquet or an
+    Arrow IPC stream
+    A generator: it yields after each row group or batch is written and once
+    the file is complete, so a caller holding a ChunkSink can drain it
+    """
+    if fmt == 'arrow':
+        with pa.ipc.new_stream(sink, READING_SCHEMA) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                yield
+        yield
+        return
+
+    pending = []
+    pending_rows = 0
+    with pq.ParquetWriter(sink, READING_SCHEMA, compression='zstd') as writer:
+        for batch in batches:
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            if pending_rows >= ROW_GROUP_ROWS:
+                writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+                pending = []
+                pending_rows = 0
+                yield
+        if pending_rows:
+            writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+    yield
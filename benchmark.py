@@ -0,0 +1,1374 @@
+#!/usr/bin/env python3
+"""
+Sniff Pittsburgh - in-process benchmarks
+Runs the Flask app through its test client against DATABASE_URL (a temporary
+SQLite file by default) so hot paths can be compared before and after a change.
+"""
+
+import sys
+
+# The stream load test runs the app on gevent, which has to patch the
+# standard library before anything else imports it
+if __name__ == "__main__" and sys.argv[1:2] == ['stream']:
+    from gevent import monkey
+    monkey.patch_all()
+
+import base64
+import contextlib
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+# Only warnings and errors from the app's JSON logs while benchmarking
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import app as sniff
+from test_webhook import create_dummy_payload, get_random_location_around_pittsburgh
+
+def reset_db():
+    """Drop and recreate all tables"""
+    with sniff.app.app_context():
+        sniff.db.drop_all()
+        sniff.db.create_all()
+
+@contextlib.contextmanager
+def quiet():
+    """Discard the app's print and log output while timing"""
+    logger = logging.getLogger('sniff')
+    level = logger.level
+    logger.setLevel(logging.CRITICAL + 1)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        logger.setLevel(level)
+
+def make_payloads(count):
+    """Build TTS uplinks at random Pittsburgh locations (repeats become updates)"""
+    payloads = []
+    for _ in range(count):
+        lat, lon = get_random_location_around_pittsburgh(radius_km=8)
+        payloads.append(create_dummy_payload(lat=lat, lon=lon))
+    return payloads
+
+def dialect_name():
+    with sniff.app.app_context():
+        return sniff.db.engine.dialect.name
+
+def count_readings():
+    with sniff.app.app_context():
+        return sniff.AirQualityReading.query.count()
+
+def bench_ingest(count=2000):
+    """Compare /tts-webhook messages/sec in direct and batch ingestion modes"""
+    payloads = make_payloads(count)
+    client = sniff.app.test_client()
+    results = {}
+
+    for mode in ('direct', 'batch'):
+        reset_db()
+        sniff.INGEST_MODE = mode
+
+        with quiet():
+            start = time.perf_counter()
+            for payload in payloads:
+                response = client.post('/tts-webhook', json=payload)
+                assert response.status_code in (200, 202), response.get_json()
+            if mode == 'batch':
+                sniff.drain_ingest_queue(timeout=60)
+            elapsed = time.perf_counter() - start
+
+        results[mode] = {
+            'messages': count,
+            'seconds': round(elapsed, 3),
+            'messages_per_sec': round(count / elapsed, 1),
+            'rows': count_readings(),
+        }
+
+    sniff.INGEST_MODE = os.getenv('INGEST_MODE', 'direct')
+
+    # Both modes must end up with the same set of locations
+    assert results['direct']['rows'] == results['batch']['rows'], results
+
+    print(f"Webhook ingestion ({count} messages, {dialect_name()})")
+    for mode, result in results.items():
+        print(f"   {mode:>6}: {result['messages_per_sec']:>8} msg/s  ({result['seconds']}s, {result['rows']} rows)")
+    speedup = results['batch']['messages_per_sec'] / results['direct']['messages_per_sec']
+    print(f"   batch speedup: {speedup:.1f}x")
+    return results
+
+def seed_readings(count, window_seconds=48 * 60 * 60):
+    """Insert count readings spread over the last window_seconds (bypasses the webhook)"""
+    reset_db()
+    now = int(time.time())
+    rows = []
+    for reading_id in range(1, count + 1):
+        lat, lon = get_random_location_around_pittsburgh(radius_km=8)
+        rows.append({**sniff.READING_DEFAULTS, 'id': reading_id, 't': now - random.randint(0, window_seconds),
+                     'la': lat + random.uniform(-5e-5, 5e-5), 'lo': lon + random.uniform(-5e-5, 5e-5),
+                     'pm25': round(random.uniform(0, 150), 1), 'src': 2})
+    with sniff.app.app_context():
+        for start in range(0, len(rows), sniff.UPSERT_CHUNK_ROWS):
+            sniff.db.session.execute(sniff.AirQualityReading.__table__.insert(), rows[start:start + sniff.UPSERT_CHUNK_ROWS])
+        sniff.db.session.commit()
+    return rows
+
+def bench_nearby(count=20000, queries=200):
+    """
+    Time the grid-indexed find_nearby_reading against the brute-force scan,
+    and query_near's k nearest (test_nearby.py checks they agree)
+    """
+    seed_readings(count)
+    points = [get_random_location_around_pittsburgh(radius_km=8) for _ in range(queries)]
+
+    print(f"find_nearby_reading ({count} rows, {queries} queries per radius)")
+    with sniff.app.app_context():
+        sniff.nearby_index_loaded = False
+        sniff.load_nearby_index()
+
+        for radius in (50, 500, 5000):
+            start = time.perf_counter()
+            for lat, lon in points:
+                sniff.find_nearby_reading_scan(lat, lon, radius)
+            scan_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            indexed = [sniff.find_nearby_reading(lat, lon, radius) for lat, lon in points]
+            index_elapsed = time.perf_counter() - start
+
+            hits = sum(1 for reading in indexed if reading is not None)
+            print(f"   radius {radius:>5}m: scan {scan_elapsed / queries * 1000:8.3f} ms/query, "
+                  f"index {index_elapsed / queries * 1000:8.3f} ms/query  ({hits} hits)")
+
+        # /api/data/near: the k nearest within a radius
+        backend = 'PostGIS ST_DWithin + <->' if sniff.postgis_enabled() else 'la/lo box + haversine'
+        for radius, k in ((500, 10), (5000, 100)):
+            start = time.perf_counter()
+            for lat, lon in points:
+                sniff.query_near(lat, lon, radius, k)
+            near_elapsed = time.perf_counter() - start
+            print(f"   near radius {radius:>5}m k={k:<3}: {near_elapsed / queries * 1000:8.3f} ms/query via {backend}")
+
+def bench_batch(count=20000, queries=5000):
+    """Compare per-point and NumPy batch nearest-reading lookups and distances"""
+    import numpy as np
+    from geo import haversine_distance, haversine_distances
+
+    seed_readings(count)
+    points = [get_random_location_around_pittsburgh(radius_km=8) for _ in range(queries)]
+    lats = np.array([lat for lat, _ in points])
+    lons = np.array([lon for _, lon in points])
+
+    print(f"Distances ({queries} pairs)")
+    start = time.perf_counter()
+    for lat, lon in points:
+        haversine_distance(lat, lon, 40.4406, -79.9959)
+    scalar_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    haversine_distances(lats, lons, 40.4406, -79.9959)
+    vector_elapsed = time.perf_counter() - start
+    print(f"   math loop: {scalar_elapsed * 1000:8.2f} ms   numpy: {vector_elapsed * 1000:8.2f} ms")
+
+    print(f"Nearest reading ({count} rows, {queries} points)")
+    with sniff.app.app_context():
+        sniff.nearby_index_loaded = False
+        sniff.load_nearby_index()
+
+        for radius in (50, 500):
+            start = time.perf_counter()
+            for lat, lon in points:
+                sniff.find_nearby_reading(lat, lon, radius)
+            single_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            sniff.find_nearby_readings_batch(points, radius)
+            batch_elapsed = time.perf_counter() - start
+
+            print(f"   radius {radius:>4}m: per-point {single_elapsed * 1000:8.1f} ms, "
+                  f"batch {batch_elapsed * 1000:8.1f} ms")
+
+@contextlib.contextmanager
+def count_queries():
+    """Count SQL statements sent to the database inside the block"""
+    from sqlalchemy import event
+    counter = {'queries': 0}
+
+    def before_cursor_execute(*args):
+        counter['queries'] += 1
+
+    with sniff.app.app_context():
+        engine = sniff.db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+def bench_latest(count=2000, polls=500):
+    """Time /api/data/latest full responses against 304s (test_latest.py checks 304s run no queries)"""
+    seed_readings(count)
+    sniff.bump_data_version()
+    client = sniff.app.test_client()
+
+    etag = client.get('/api/data/latest').headers['ETag']
+
+    with count_queries() as counter:
+        start = time.perf_counter()
+        for _ in range(polls):
+            client.get('/api/data/latest', headers={'If-None-Match': etag})
+        not_modified_elapsed = time.perf_counter() - start
+    not_modified_queries = counter['queries']
+
+    with count_queries() as counter:
+        start = time.perf_counter()
+        for _ in range(polls):
+            client.get('/api/data/latest')
+        full_elapsed = time.perf_counter() - start
+    full_queries = counter['queries']
+
+    print(f"/api/data/latest ({count} rows, {polls} polls)")
+    print(f"   full: {full_elapsed / polls * 1000:7.3f} ms/poll ({full_queries} queries)")
+    print(f"    304: {not_modified_elapsed / polls * 1000:7.3f} ms/poll ({not_modified_queries} queries)")
+
+def bench_stream(subscribers=1000, events=50):
+    """
+    Hold many /api/stream subscribers open on a gevent server, push readings
+    through /tts-webhook and time how long each takes to reach every subscriber
+    Run on its own (python benchmark.py stream) so gevent can patch sockets first
+    """
+    import socket
+    import gevent
+    import gevent.event
+    from gevent.pywsgi import WSGIServer
+
+    reset_db()
+    sniff.STREAM_HEARTBEAT_SECONDS = 1
+    server = WSGIServer(('127.0.0.1', 0), sniff.app, log=None)
+    server.start()
+
+    connected = gevent.event.Event()
+    connected_count = [0]
+    arrivals = [[] for _ in range(subscribers)]
+
+    def subscribe(index, last_event_id=None, expected=events):
+        sock = socket.create_connection(('127.0.0.1', server.server_port))
+        request_lines = ['GET /api/stream HTTP/1.0', 'Host: localhost', 'Accept: text/event-stream']
+        if last_event_id:
+            request_lines.append(f'Last-Event-ID: {last_event_id}')
+        sock.sendall(('\r\n'.join(request_lines) + '\r\n\r\n').encode())
+
+        buffer = b''
+        seen = []
+        while len(seen) < expected:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            buffer += chunk
+            if b'retry:' in buffer and index is not None and not seen and connected_count[0] < subscribers:
+                connected_count[0] += 1
+                if connected_count[0] == subscribers:
+                    connected.set()
+            while b'event: reading' in buffer:
+                buffer = buffer.split(b'event: reading', 1)[1]
+                seen.append(time.perf_counter())
+        sock.close()
+        if index is not None:
+            arrivals[index] = seen
+        return seen
+
+    start = time.perf_counter()
+    greenlets = [gevent.spawn(subscribe, index) for index in range(subscribers)]
+    assert connected.wait(timeout=60), f"only {connected_count[0]} subscribers connected"
+    connect_elapsed = time.perf_counter() - start
+
+    client = sniff.app.test_client()
+    first_seq = sniff.reading_stream.last_seq + 1
+    published = []
+    with quiet():
+        for _ in range(events):
+            published.append(time.perf_counter())
+            assert client.post('/tts-webhook', json=create_dummy_payload()).status_code == 200
+            gevent.sleep(0.02)
+
+    gevent.joinall(greenlets, timeout=60)
+    delivered = sum(len(seen) for seen in arrivals)
+    assert delivered == subscribers * events, f"delivered {delivered} of {subscribers * events} events"
+
+    # A reconnecting client resumes right after its Last-Event-ID
+    resumed = subscribe(None, f"{sniff.reading_stream.epoch}-{first_seq + 9}", expected=events - 10)
+    assert len(resumed) == events - 10, f"resume delivered {len(resumed)} of {events - 10} events"
+
+    latencies = sorted(
+        max(seen[i] for seen in arrivals) - published[i]
+        for i in range(events)
+    )
+    server.stop()
+
+    print(f"/api/stream ({subscribers} subscribers, {events} readings)")
+    print(f"   all subscribers connected in {connect_elapsed:.2f}s")
+    print(f"   delivered {delivered} events; resume from Last-Event-ID ok")
+    print(f"   time for a reading to reach every subscriber: "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+
+def stream_export(client, query_string, trace=True):
+    """Read a /data export chunk by chunk; returns (lines, peak traced bytes)"""
+    if trace:
+        tracemalloc.start()
+    response = client.get('/data', query_string=query_string, buffered=False)
+    assert response.status_code == 200, response.status_code
+    lines = 0
+    for chunk in response.response:
+        lines += chunk.count(b'\n') if isinstance(chunk, bytes) else chunk.count('\n')
+    response.close()
+    if not trace:
+        return lines, None
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return lines, peak
+
+def bench_export(count=50000, page=7000):
+    """
+    Stream /data as NDJSON and CSV, check keyset pages add up to the full
+    export, and compare peak memory against an export a tenth the size
+    """
+    rows = seed_readings(count)
+    client = sniff.app.test_client()
+
+    start = time.perf_counter()
+    lines, _ = stream_export(client, {'format': 'ndjson'}, trace=False)
+    elapsed = time.perf_counter() - start
+    assert lines == count, (lines, count)
+
+    # tracemalloc slows everything down, so memory is measured on a second pass
+    _, peak = stream_export(client, {'format': 'ndjson'})
+
+    small_lines, small_peak = stream_export(client, {'format': 'ndjson', 'limit': count // 10})
+    assert small_lines == count // 10
+
+    csv_lines, csv_peak = stream_export(client, {'format': 'csv'})
+    assert csv_lines == count + 1
+
+    # Page through with after_id/after_t and compare to the full export
+    paged = []
+    params = {'limit': page}
+    while True:
+        body = client.get('/data', query_string=params).get_data(as_text=True)
+        batch = [sniff.json.loads(line) for line in body.splitlines()]
+        paged.extend(batch)
+        if len(batch) < page:
+            break
+        params = {'limit': page, 'after_id': batch[-1]['id'], 'after_t': batch[-1]['t']}
+    assert [row['id'] for row in paged] == sorted(row['id'] for row in rows)
+
+    window_start = min(row['t'] for row in rows) + 3600
+    in_window = sum(1 for row in rows if row['t'] >= window_start)
+    window_lines, _ = stream_export(client, {'from': window_start})
+    assert window_lines == in_window
+
+    print(f"/data export ({count} rows, {dialect_name()})")
+    print(f"   ndjson: {count / elapsed:9.0f} rows/s, peak {peak / 1024:7.0f} KiB ({small_peak / 1024:.0f} KiB for {count // 10} rows)")
+    print(f"      csv: peak {csv_peak / 1024:7.0f} KiB")
+    print(f"   keyset: {len(paged)} rows in pages of {page}, matches the full export")
+
+def bench_frames(count=20000):
+    """
+    Compare decode throughput of binary frames (scalar and NumPy decoders)
+    with the JSON text path (test_frames.py checks the round trips)
+    """
+    from frames import encode_frame, decode_frames, columns_to_readings, FRAME_SIZE
+
+    payloads = make_payloads(count)
+    readings = [sniff.json.loads(payload["uplink_message"]["decoded_payload"]["text"]) for payload in payloads]
+
+    frames = [encode_frame(reading) for reading in readings]
+    binary_payloads = [
+        {"uplink_message": {"f_port": sniff.FRAME_FPORT, "frm_payload": base64.b64encode(frame).decode()}}
+        for frame in frames
+    ]
+
+    json_size = sum(len(payload["uplink_message"]["decoded_payload"]["text"]) for payload in payloads) / count
+
+    timings = {}
+    start = time.perf_counter()
+    for payload in payloads:
+        sniff.parse_tts_payload(payload)
+    timings['json text'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for payload in binary_payloads:
+        sniff.parse_tts_payload(payload)
+    timings['frame (struct)'] = time.perf_counter() - start
+
+    buffer = b''.join(frames)
+    start = time.perf_counter()
+    columns = decode_frames(buffer)
+    timings['frames (NumPy)'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    columns_to_readings(columns)
+    timings['frames (NumPy) + dicts'] = timings['frames (NumPy)'] + time.perf_counter() - start
+
+    print(f"Uplink decoding ({count} readings): {FRAME_SIZE} byte frames vs {json_size:.0f} byte JSON text")
+    for name, elapsed in timings.items():
+        print(f"   {name:>22}: {count / elapsed:12.0f} readings/s")
+
+def bench_achd(hours=96, workers=8):
+    """
+    Backfill hours of ACHD data from a local fake CKAN server (with latency
+    and one failed request per range): hour by hour, in ranges with
+    datastore_search_sql and paged datastore_search, and in ranges on a
+    thread pool. Checks every way returns the same readings and that the
+    checkpoint only advances past contiguous complete hours
+    """
+    import datetime
+    import achd_data_request as achd
+    from fake_ckan import FakeCKAN
+
+    # The checkpoint check fails the second range of collect_data, which
+    # needs a whole first range before it
+    if hours < 2 * achd.BACKFILL_RANGE_HOURS:
+        sys.exit(f"achd needs at least {2 * achd.BACKFILL_RANGE_HOURS} hours (two ranges of ACHD_BACKFILL_RANGE_HOURS)")
+    now = datetime.datetime.now().replace(minute=30, second=0, microsecond=0)
+    last_processed = now.replace(minute=0) - datetime.timedelta(hours=hours)
+    hour_names = [hour.isoformat() for hour in achd.missing_hours(last_processed, now)]
+    sites = len(achd.location_map)
+
+    timings = {}
+    results = {}
+    runs = [
+        ('hour by hour', 1, 1, 'sql'),
+        ('24h ranges, sql', 1, 24, 'sql'),
+        ('24h ranges, paged search', 1, 24, 'search'),
+        (f'6h ranges, sql, {workers} workers', workers, 6, 'sql'),
+    ]
+    for name, pool_size, range_hours, method in runs:
+        fake = FakeCKAN(fail_first=1, latency=0.05)
+        achd.CKAN_URL = fake.start()
+        achd.FETCH_METHOD = method
+        start = time.perf_counter()
+        with quiet():
+            completed, results[name] = achd.backfill(last_processed, now, workers=pool_size, backoff=0.01, range_hours=range_hours)
+        timings[name] = (time.perf_counter() - start, fake.requests)
+        fake.stop()
+        assert len(completed) == len(hour_names), (name, len(completed), len(hour_names))
+        # Busy hours are not cut off at CKAN's default 100 rows
+        assert all(len(readings) == sites for readings in results[name].values()), name
+    first = results[runs[0][0]]
+    assert all(result == first for result in results.values())
+    achd.FETCH_METHOD = 'sql'
+
+    # A recent empty hour holds the checkpoint back; an old one does not
+    achd.FINAL_AFTER = datetime.timedelta(hours=12)
+    recent_gap = len(hour_names) - 3
+    fake = FakeCKAN(empty_hours=[hour_names[5], hour_names[recent_gap]])
+    achd.CKAN_URL = fake.start()
+    with quiet():
+        completed, _ = achd.backfill(last_processed, now, workers=workers, backoff=0.01)
+    assert len(completed) == recent_gap, (len(completed), recent_gap)
+
+    # A failed range stops it too, and collect_data writes the checkpoint and files
+    achd.output_dir = tempfile.mkdtemp()
+    achd.save_last_processed(os.path.join(achd.output_dir, "last_processed.txt"), last_processed)
+    fake.fail_first = achd.BACKFILL_RETRIES + 1
+    fake.attempts = {hour_names[0]: fake.fail_first}
+    with quiet():
+        achd.collect_data(workers=workers)
+    fake.stop()
+    with open(os.path.join(achd.output_dir, "last_processed.txt")) as f:
+        checkpoint = f.read().strip()
+    assert checkpoint == hour_names[achd.BACKFILL_RANGE_HOURS - 1], checkpoint
+    written = [name for name in os.listdir(achd.output_dir) if name.endswith('.json')]
+    assert len(written) == achd.BACKFILL_RANGE_HOURS - 1, written  # hour 5 was empty
+
+    # The app's pipeline: each hour is upserted with its checkpoint in one
+    # transaction, so a failure part way leaves the checkpoint on the last
+    # hour whose readings were committed
+    reset_db()
+    achd.FINAL_AFTER = datetime.timedelta(hours=48)
+    fake = FakeCKAN()
+    achd.CKAN_URL = fake.start()
+    with sniff.app.app_context():
+        sniff.save_checkpoint(sniff.ACHD_CHECKPOINT, last_processed.isoformat())
+        sniff.db.session.commit()
+
+    record_history = sniff.record_history
+    def failing_record_history(rows):
+        if rows and rows[0]['t'] >= failing_t:
+            raise RuntimeError("simulated failure")
+        return record_history(rows)
+    failing = len(hour_names) * 5 // 16
+    failing_t = int(datetime.datetime.fromisoformat(hour_names[failing]).replace(tzinfo=datetime.timezone.utc).timestamp())
+    sniff.record_history = failing_record_history
+    with quiet(), contextlib.redirect_stderr(open(os.devnull, 'w')):
+        try:
+            sniff.collect_achd_data()
+            raise AssertionError("failed import was not reported")
+        except RuntimeError:
+            pass
+    sniff.record_history = record_history
+    with sniff.app.app_context():
+        assert sniff.load_checkpoint(sniff.ACHD_CHECKPOINT) == hour_names[failing - 1]
+        assert sniff.db.session.query(sniff.db.func.max(sniff.AirQualityHistory.t)).scalar() < failing_t
+
+    start = time.perf_counter()
+    with quiet():
+        sniff.collect_achd_data()
+    pipeline_elapsed = time.perf_counter() - start
+    fake.stop()
+    with sniff.app.app_context():
+        assert sniff.load_checkpoint(sniff.ACHD_CHECKPOINT) == hour_names[-1]
+        history_hours = sniff.db.session.query(sniff.db.func.count(sniff.db.distinct(sniff.AirQualityHistory.t))).scalar()
+    assert history_hours == len(hour_names), history_hours
+
+    print(f"ACHD backfill of {len(hour_names)} hours (50 ms latency, one failed request per range)")
+    for name, (elapsed, requests) in timings.items():
+        print(f"   {name:>28}: {elapsed:6.2f}s, {requests:4d} requests")
+    print("   same readings every way; checkpoint stops at the first failed or recent empty hour")
+    print(f"   fetch + upsert into {dialect_name()}: {pipeline_elapsed:6.2f}s for the {len(hour_names) - failing} hours left after a failed commit")
+
+def bench_replay(hours=96):
+    """
+    Run the app's ACHD import against a fake CKAN server through the
+    response cache: cold, warm, with recent entries expired, and replayed
+    offline from the cache alone. Checks the replay imports the same history
+    """
+    import datetime
+    import achd_data_request as achd
+    from fake_ckan import FakeCKAN
+
+    if hours < 4:
+        sys.exit("replay needs at least 4 hours")
+    now = datetime.datetime.now()
+    last_processed = now.replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=hours)
+    # The newer half of the hours stays recent (expires with the TTL) and the
+    # older half is final, whatever the number of hours
+    achd.FINAL_AFTER = datetime.timedelta(hours=hours // 2)
+    final_before = now - achd.FINAL_AFTER
+    achd.CACHE_DIR = tempfile.mkdtemp()
+    fake = FakeCKAN(latency=0.05)
+    achd.CKAN_URL = fake.start()
+
+    def run_import():
+        reset_db()
+        with sniff.app.app_context():
+            sniff.save_checkpoint(sniff.ACHD_CHECKPOINT, last_processed.isoformat())
+            sniff.db.session.commit()
+        requests_before = fake.requests
+        fake.attempts.clear()
+        start = time.perf_counter()
+        with quiet():
+            sniff.collect_achd_data()
+        elapsed = time.perf_counter() - start
+        with sniff.app.app_context():
+            history = [
+                tuple(row) for row in sniff.db.session.execute(
+                    sniff.db.select(sniff.AirQualityHistory.id, sniff.AirQualityHistory.t, sniff.AirQualityHistory.pm25)
+                    .order_by(sniff.AirQualityHistory.id, sniff.AirQualityHistory.t)
+                )
+            ]
+        return elapsed, fake.requests - requests_before, history
+
+    runs = {}
+    runs['cold cache'] = run_import()
+    runs['warm cache'] = run_import()
+    achd.CACHE_TTL = 0
+    runs['recent entries expired'] = run_import()
+    # Only hours that were still recent when cached are fetched again
+    refetched = [datetime.datetime.fromisoformat(first_hour) for first_hour in fake.attempts]
+    assert refetched and all(hour + datetime.timedelta(hours=1) > final_before for hour in refetched), refetched
+    fake.stop()
+
+    achd.REPLAY = True
+    runs['offline replay'] = run_import()
+    achd.REPLAY = False
+
+    cold_history = runs['cold cache'][2]
+    assert cold_history, "nothing imported"
+    assert all(history == cold_history for _, _, history in runs.values())
+    assert runs['warm cache'][1] == 0 and runs['offline replay'][1] == 0
+    assert achd.prune_cache() > 0
+
+    print(f"ACHD import of {hours} hours through the response cache (50 ms latency)")
+    for name, (elapsed, requests, history) in runs.items():
+        print(f"   {name:>22}: {elapsed:6.2f}s, {requests:3d} requests, {len(history)} history rows")
+
+def bench_retention(locations=500, days=45):
+    """
+    Seed readings and hourly history spanning days days, then time retention
+    with one big delete vs bounded batches while the webhook keeps writing.
+    Checks expired rows are gone and their daily rollups match a rebuild
+    from the raw history taken before it was deleted
+    """
+    import threading
+
+    keep_days = 30
+    now = int(time.time())
+    cutoff = now - keep_days * sniff.SECONDS_PER_DAY
+    history_cutoff = cutoff - cutoff % sniff.SECONDS_PER_DAY
+    rng = random.Random(1)
+
+    def seed():
+        reset_db()
+        readings = []
+        history = []
+        for location in range(1, locations + 1):
+            readings.append({'id': location, 't': now - rng.randrange(days * sniff.SECONDS_PER_DAY), 'pm25': rng.uniform(0, 60)})
+            for hour in range(days * 24):
+                pm25 = rng.choice([-1, rng.uniform(0, 60)])
+                history.append({'id': location, 't': now - hour * 3600, 'pm25': pm25, 'pm10': rng.uniform(0, 120)})
+        with sniff.app.app_context():
+            for table, rows in ((sniff.AirQualityReading.__table__, readings), (sniff.AirQualityHistory.__table__, history)):
+                for start in range(0, len(rows), 10000):
+                    sniff.db.session.execute(table.insert(), rows[start:start + 10000])
+            sniff.db.session.commit()
+            expected = sniff.rebuild_rollups(sniff.SECONDS_PER_DAY, 0, history_cutoff)
+        return len(history), expected
+
+    def run(batch_rows, pause):
+        history_rows, expected = seed()
+        sniff.RETENTION_BATCH_ROWS = batch_rows
+        sniff.RETENTION_PAUSE_SECONDS = pause
+        payloads = make_payloads(200)
+        client = sniff.app.test_client()
+        latencies = []
+
+        with quiet():
+            cleanup = threading.Thread(target=sniff.cleanup_old_data, kwargs={'days_to_keep': keep_days})
+            start = time.perf_counter()
+            cleanup.start()
+            while cleanup.is_alive():
+                sent = time.perf_counter()
+                client.post('/tts-webhook', json=payloads[len(latencies) % len(payloads)])
+                latencies.append(time.perf_counter() - sent)
+            cleanup.join()
+            elapsed = time.perf_counter() - start
+
+        status = dict(sniff.retention_status)
+        assert status['state'] == 'done', status
+        with sniff.app.app_context():
+            assert sniff.AirQualityHistory.query.filter(sniff.AirQualityHistory.t < history_cutoff).count() == 0
+            assert sniff.AirQualityReading.query.filter(sniff.AirQualityReading.t < cutoff).count() == 0
+            stored = sniff.AirQualityRollup.query.filter(
+                sniff.AirQualityRollup.period == sniff.SECONDS_PER_DAY,
+                sniff.AirQualityRollup.bucket < history_cutoff
+            ).all()
+        assert len(stored) == len(expected) == status['rollups_written']
+        for rollup in stored:
+            row = expected[(rollup.id, rollup.period, rollup.bucket)]
+            for field in sniff.ROLLUP_FIELDS:
+                assert getattr(rollup, f'{field}_count') == row[f'{field}_count']
+                assert abs(getattr(rollup, f'{field}_sum') - row[f'{field}_sum']) < 1e-6 * max(1.0, abs(row[f'{field}_sum']))
+
+        latencies.sort()
+        return history_rows, elapsed, status, latencies
+
+    print(f"Retention of {locations} locations x {days} days of hourly history, keeping {keep_days} days")
+    for name, batch_rows, pause in (('single delete', 10 ** 9, 0.0), ('batches of 5000', 5000, 0.01)):
+        history_rows, elapsed, status, latencies = run(batch_rows, pause)
+        removed = status['history_removed'] + status['readings_deleted']
+        p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0.0
+        print(f"   {name:>16}: {elapsed:5.2f}s, {removed} of {history_rows + locations} rows removed in "
+              f"{status['batches']} batches, {status['rollups_written']} daily rollups kept, "
+              f"{len(latencies)} webhooks during it (p99 {p99 * 1000:.1f} ms, max {latencies[-1] * 1000 if latencies else 0:.1f} ms)")
+
+def bench_scheduler(workers=4, hours=48):
+    """
+    Drive the app's job scheduler on a simulated clock: workers schedulers
+    share one job store, as processes share the database, through a run of
+    hours with a stretch of downtime. Checks every slot runs exactly once,
+    that missed slots are caught up as one run, and that failures are
+    recorded and retried
+    """
+    from scheduler import Job, Scheduler
+
+    reset_db()
+    hour = 3600
+    clock = [float(1700000000 - 1700000000 % hour)]
+    calls = []
+    failures = {'count': 1}
+
+    def flaky():
+        calls.append(clock[0])
+        if failures['count']:
+            failures['count'] -= 1
+            raise RuntimeError("simulated failure")
+
+    store = sniff.JobStore()
+    schedulers = []
+    for _ in range(workers):
+        job = Job('bench', flaky, hour, offset=600, jitter=30, retry_after=120)
+        schedulers.append(Scheduler([job], store, poll=30, clock=lambda: clock[0]))
+
+    downtime = range(hours // 2, hours // 2 + 6)
+    ticks = 0
+    start = time.perf_counter()
+    with quiet():
+        end = clock[0] + hours * hour
+        while clock[0] < end:
+            if int((clock[0] - (end - hours * hour)) // hour) not in downtime:
+                for scheduler in schedulers:
+                    scheduler.tick(scheduler.jobs['bench'])
+                    ticks += 1
+            clock[0] += 30
+    elapsed = time.perf_counter() - start
+
+    with sniff.app.app_context():
+        runs = sniff.JobRun.query.filter_by(job='bench').order_by(sniff.JobRun.run_id).all()
+    ok_slots = [run.slot for run in runs if run.status == 'ok']
+    failed = [run for run in runs if run.status == 'failed']
+    assert len(ok_slots) == len(set(ok_slots)), "a slot ran twice"
+    assert len(failed) == 1 and failed[0].error == "simulated failure"
+    assert failed[0].slot in ok_slots, "failed slot was not retried"
+    # One run per hour (plus the slot already open at the start), except the
+    # downtime, whose slots are caught up as one run
+    assert len(ok_slots) == hours + 1 - (len(downtime) - 1), len(ok_slots)
+    assert len(calls) == len(runs)
+    assert all(run.duration is not None for run in runs)
+
+    print(f"Scheduler: {workers} workers sharing one job store over {hours} simulated hours")
+    print(f"   {len(ok_slots)} slots run once each, {len(downtime)} hours of downtime caught up in one run")
+    print(f"   1 failure recorded and retried; {ticks} ticks in {elapsed:.2f}s ({elapsed / ticks * 1e6:.0f} us/tick)")
+
+def percentiles(latencies):
+    """Count, p50, p95, p99 and max (in ms) of a list of latencies in seconds"""
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'requests': 0}
+    pick = lambda q: round(latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000, 2)
+    return {'requests': len(latencies), 'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99), 'max_ms': pick(1.0)}
+
+def run_clients(port, endpoints, seconds):
+    """
+    Load a server with several endpoints at once: endpoints maps a label to
+    (method, path, bodies, clients). Each client is a thread on its own
+    keep-alive connection; GETs send If-None-Match with the last ETag seen,
+    as the map does when it polls. Returns per-label throughput, latency
+    percentiles, 304s and errors
+    """
+    import http.client
+    import json
+    import threading
+
+    stats = {label: {'latencies': [], 'errors': 0, 'not_modified': 0} for label in endpoints}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(label, method, path, bodies, index, clients):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        latencies = []
+        errors = 0
+        not_modified = 0
+        etag = None
+        while time.perf_counter() < deadline:
+            headers = {'Content-Type': 'application/json'}
+            body = None
+            if bodies:
+                body = json.dumps(bodies[(index + len(latencies) * clients) % len(bodies)])
+            elif etag:
+                headers['If-None-Match'] = etag
+            started = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                etag = response.getheader('ETag') or etag
+                not_modified += response.status == 304
+                errors += response.status >= 400
+                if response.getheader('Connection', '').lower() == 'close':
+                    connection.close()
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                connection.close()
+            latencies.append(time.perf_counter() - started)
+        with lock:
+            stats[label]['latencies'].extend(latencies)
+            stats[label]['errors'] += errors
+            stats[label]['not_modified'] += not_modified
+
+    threads = [
+        threading.Thread(target=client, args=(label, method, path, bodies, index, clients))
+        for label, (method, path, bodies, clients) in endpoints.items()
+        for index in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    results = {}
+    for label, stat in stats.items():
+        result = percentiles(stat['latencies'])
+        result.update({
+            'clients': endpoints[label][3],
+            'requests_per_sec': round(result['requests'] / elapsed, 1),
+            'not_modified': stat['not_modified'],
+            'errors': stat['errors'],
+        })
+        results[label] = result
+    return results
+
+def free_port():
+    import socket
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+@contextlib.contextmanager
+def running_server(command, port):
+    """Start a server process listening on port and stop it afterwards"""
+    import socket
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen(command, cwd=here, env=dict(os.environ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(150):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError(f"{command[:3]} exited with {server.returncode}")
+                time.sleep(0.2)
+        else:
+            raise RuntimeError(f"{command[:3]} did not start")
+        yield server
+    finally:
+        server.terminate()
+        server.wait(10)
+
+def gunicorn_command(port, workers=0):
+    return [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}'] + (
+        ['--workers', str(workers)] if workers else [])
+
+def seed_served_readings(count=500):
+    """Fill the database through the webhook so a server has readings to serve"""
+    reset_db()
+    client = sniff.app.test_client()
+    with quiet():
+        for payload in make_payloads(count):
+            client.post('/tts-webhook', json=payload)
+
+def bench_serve(seconds=5, clients=16, workers=0):
+    """
+    Requests/sec on /api/data/latest and /tts-webhook over HTTP: the app.py
+    development server (debug, as __main__ ran it before) against gunicorn
+    with gunicorn.conf.py (workers=0 keeps its default of 2 * CPUs + 1)
+    """
+    seed_served_readings()
+    payloads = make_payloads(2000)
+    modes = {
+        'dev server (debug)': lambda port: [
+            sys.executable, '-c',
+            f"import app; app.wait_for_db(); app.app.run(debug=True, use_reloader=False, port={port})"
+        ],
+        'gunicorn': lambda port: gunicorn_command(port, workers),
+    }
+
+    results = {}
+    print(f"HTTP load, {clients} keep-alive clients for {seconds}s per endpoint on {dialect_name()} ({os.cpu_count()} CPUs)")
+    for name, command in modes.items():
+        port = free_port()
+        with running_server(command(port), port):
+            for label, method, path, bodies in (
+                ('GET /api/data/latest', 'GET', '/api/data/latest', None),
+                ('POST /tts-webhook', 'POST', '/tts-webhook', payloads),
+            ):
+                result = run_clients(port, {label: (method, path, bodies, clients)}, seconds)[label]
+                results.setdefault(name, {})[label] = result
+                print(f"   {name:>18} {label:<22}: {result['requests_per_sec']:7.0f} req/s, "
+                      f"p50 {result['p50_ms']:6.1f} ms, p99 {result['p99_ms']:6.1f} ms, {result['errors']} errors")
+    return results
+
+def bench_load(seconds=10, posters=8, pollers=32, workers=0):
+    """
+    Mixed load under gunicorn: posters clients replay synthetic TTS uplinks
+    (the PITTSBURGH_LOCATIONS points, so repeats update existing locations,
+    plus random points) while pollers clients poll /api/data/latest with
+    If-None-Match like the map. Point DATABASE_URL at Postgres to measure
+    the production setup
+    """
+    from test_webhook import PITTSBURGH_LOCATIONS
+
+    seed_served_readings()
+    payloads = [create_dummy_payload(lat=lat, lon=lon) for lat, lon, _ in PITTSBURGH_LOCATIONS] * 50 + make_payloads(1500)
+    random.shuffle(payloads)
+
+    port = free_port()
+    with running_server(gunicorn_command(port, workers), port):
+        results = run_clients(port, {
+            'POST /tts-webhook': ('POST', '/tts-webhook', payloads, posters),
+            'GET /api/data/latest': ('GET', '/api/data/latest', None, pollers),
+        }, seconds)
+
+    print(f"Mixed load for {seconds}s under gunicorn on {dialect_name()} ({os.cpu_count()} CPUs)")
+    for label, result in results.items():
+        print(f"   {label:<22} x{result['clients']:<3}: {result['requests_per_sec']:7.1f} req/s, p50 {result['p50_ms']:7.1f} ms, "
+              f"p95 {result['p95_ms']:7.1f} ms, p99 {result['p99_ms']:7.1f} ms, {result['not_modified']} 304s, {result['errors']} errors")
+    return {'seconds': seconds, 'endpoints': results}
+
+def grow_readings(first_id, count, window_seconds=20 * 60 * 60, chunk=20000):
+    """Insert count more readings with ids from first_id, a chunk at a time"""
+    now = int(time.time())
+    with sniff.app.app_context():
+        for start in range(first_id, first_id + count, chunk):
+            rows = []
+            for reading_id in range(start, min(start + chunk, first_id + count)):
+                lat, lon = get_random_location_around_pittsburgh(radius_km=8)
+                rows.append({**sniff.READING_DEFAULTS, 'id': reading_id, 't': now - random.randint(0, window_seconds),
+                             'la': lat + random.uniform(-5e-5, 5e-5), 'lo': lon + random.uniform(-5e-5, 5e-5),
+                             'lad': 'N', 'lod': 'W', 'pm25': round(random.uniform(0, 150), 1), 'src': 2,
+                             'created_at': sniff.datetime.utcfromtimestamp(now - random.randint(0, window_seconds))})
+            sniff.db.session.execute(sniff.AirQualityReading.__table__.insert(), rows)
+            sniff.db.session.commit()
+
+def bench_micro(max_rows=1000000, queries=2000):
+    """
+    Microbenchmarks at 1k, 100k and 1M rows (up to max_rows): haversine_distance
+    calls, find_nearby_reading (index load and per-query time), the
+    /api/data/latest request, and reading_to_json + JSON serialization of
+    every row, streamed from the database
+    """
+    import json
+    from geo import haversine_distance
+
+    sizes = [size for size in (1000, 100000, 1000000) if size <= max_rows]
+    results = {'haversine_distance': {}, 'find_nearby_reading': {}, 'get_latest_data': {}, 'serialize_readings': {}}
+    points = [get_random_location_around_pittsburgh(radius_km=8) for _ in range(queries)]
+
+    print(f"Microbenchmarks on {dialect_name()}")
+    reset_db()
+    rows = 0
+    for size in sizes:
+        pairs = [(points[i % queries], points[(i * 7 + 1) % queries]) for i in range(size)]
+        start = time.perf_counter()
+        for (lat1, lon1), (lat2, lon2) in pairs:
+            haversine_distance(lat1, lon1, lat2, lon2)
+        elapsed = time.perf_counter() - start
+        results['haversine_distance'][size] = {'calls_per_sec': round(size / elapsed)}
+
+        grow_readings(rows + 1, size - rows)
+        rows = size
+
+        with sniff.app.app_context(), quiet():
+            sniff.nearby_index_loaded = False
+            start = time.perf_counter()
+            sniff.load_nearby_index()
+            load_elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            for lat, lon in points:
+                sniff.find_nearby_reading(lat, lon)
+            query_elapsed = time.perf_counter() - start
+        results['find_nearby_reading'][size] = {
+            'index_load_ms': round(load_elapsed * 1000, 1),
+            'us_per_query': round(query_elapsed / queries * 1e6, 1),
+        }
+
+        client = sniff.app.test_client()
+        latencies = []
+        for _ in range(200):
+            start = time.perf_counter()
+            response = client.get('/api/data/latest')
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200
+        results['get_latest_data'][size] = percentiles(latencies)
+
+        with sniff.app.app_context():
+            now = time.time()
+            start = time.perf_counter()
+            serialized = 0
+            readings = sniff.db.session.execute(sniff.db.select(sniff.AirQualityReading).execution_options(yield_per=10000))
+            for reading in readings.scalars():
+                json.dumps(sniff.reading_to_json(reading, now))
+                serialized += 1
+            elapsed = time.perf_counter() - start
+        results['serialize_readings'][size] = {'rows_per_sec': round(serialized / elapsed), 'seconds': round(elapsed, 2)}
+
+        print(f"   {size:>8} rows: haversine {results['haversine_distance'][size]['calls_per_sec']:>9}/s, "
+              f"nearby load {load_elapsed * 1000:8.1f} ms + {query_elapsed / queries * 1e6:6.1f} us/query, "
+              f"latest p50 {results['get_latest_data'][size]['p50_ms']:6.2f} ms, "
+              f"serialize {results['serialize_readings'][size]['rows_per_sec']:>7} rows/s")
+    return results
+
+def bench_metrics(count=300, rounds=15):
+    """
+    Cost of the /metrics instrumentation: /tts-webhook timed with metrics
+    recorded and with METRICS_ENABLED off, alternating request by request.
+    Checks the measured overhead (ratio of median requests) stays under 2%,
+    and breaks the cost down per observation
+    """
+    import statistics
+
+    reset_db()
+    payloads = make_payloads(count)
+    client = sniff.app.test_client()
+    with quiet():
+        for payload in payloads:
+            client.post('/tts-webhook', json=payload)
+
+    def samples_of(name, labels=None):
+        return sniff.metrics.REGISTRY.get_sample_value(name, labels or {}) or 0
+
+    timings = {True: [], False: []}
+    queries_before = samples_of('sniff_db_queries_per_request_sum', {'endpoint': 'handle_tts_webhook'})
+    requests_before = samples_of('sniff_db_queries_per_request_count', {'endpoint': 'handle_tts_webhook'})
+    with quiet():
+        for round_number in range(rounds):
+            for index, payload in enumerate(payloads):
+                # Alternate per request, so both settings see the same drift
+                enabled = (index + round_number) % 2 == 0
+                sniff.METRICS_ENABLED = enabled
+                start = time.perf_counter()
+                client.post('/tts-webhook', json=payload)
+                timings[enabled].append(time.perf_counter() - start)
+    sniff.METRICS_ENABLED = True
+    queries = (samples_of('sniff_db_queries_per_request_sum', {'endpoint': 'handle_tts_webhook'}) - queries_before) / (
+        samples_of('sniff_db_queries_per_request_count', {'endpoint': 'handle_tts_webhook'}) - requests_before)
+
+    # What each observation a webhook makes costs on its own
+    calls = 100000
+    start = time.perf_counter()
+    for _ in range(calls):
+        sniff.time_stage('total', 0.0)
+    stage_cost = (time.perf_counter() - start) / calls
+
+    class Context:
+        pass
+    context = Context()
+    token = sniff.request_statements.set(sniff.StatementTally())
+    start = time.perf_counter()
+    for _ in range(calls):
+        sniff.before_cursor_execute(None, None, None, None, context, False)
+        sniff.after_cursor_execute(None, None, None, None, context, False)
+    query_cost = (time.perf_counter() - start) / calls
+    sniff.request_statements.reset(token)
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        sniff.metrics.DB_POOL_CHECKOUT_SECONDS.observe(0.0)
+        sniff.metrics.DB_QUERIES_PER_REQUEST.labels(endpoint='handle_tts_webhook').observe(1)
+    request_cost = (time.perf_counter() - start) / calls
+
+    enabled = statistics.median(timings[True])
+    disabled = statistics.median(timings[False])
+    overhead = enabled / disabled - 1
+    # The same ratio over each half of the requests, as a check on noise
+    halves = [
+        statistics.median(timings[True][half::2]) / statistics.median(timings[False][half::2]) - 1 for half in (0, 1)
+    ]
+    # 4 stages, the statement hooks, and per request the pool checkout and two per-endpoint histograms
+    estimate = 4 * stage_cost + queries * query_cost + 1.5 * request_cost
+    print(f"Metrics overhead on /tts-webhook ({count} requests x {rounds} rounds, {dialect_name()}, {queries:.1f} statements/request)")
+    print(f"   webhook with metrics {enabled * 1e6:8.1f} us, without {disabled * 1e6:8.1f} us (median request)")
+    print(f"   measured overhead {overhead * 100:+.2f}% (halves {halves[0] * 100:+.2f}%, {halves[1] * 100:+.2f}%)")
+    print(f"   per observation: stage {stage_cost * 1e6:.2f} us, statement hooks {query_cost * 1e6:.2f} us, "
+          f"request histograms {request_cost / 2 * 1e6:.2f} us")
+    print(f"   instrumentation per webhook: {estimate * 1e6:.1f} us = {estimate / enabled * 100:.2f}% of the request")
+    assert overhead < 0.02, f"metrics cost {overhead * 100:.1f}% of a webhook"
+    return {
+        'webhook_us': {'metrics': round(enabled * 1e6, 1), 'no_metrics': round(disabled * 1e6, 1)},
+        'overhead_percent': round(overhead * 100, 2),
+        'instrumentation_us': round(estimate * 1e6, 2),
+    }
+
+def bench_logging(count=100000, webhooks=300):
+    """
+    Per-call cost of the JSON log pipeline on the calling thread against
+    formatting on it (a synchronous handler) and the old print of each
+    payload, then the logging share of a /tts-webhook. Checks the lines are
+    valid JSON and that a forked child still logs
+    """
+    import io
+    import json
+    import queue
+    import statistics
+    import logs
+
+    payload = create_dummy_payload()
+    reading = sniff.parse_tts_payload(payload)
+    extra = {'payload': payload, 'reading': reading}
+
+    def per_call(log):
+        start = time.perf_counter()
+        for _ in range(count):
+            log()
+        return (time.perf_counter() - start) / count
+
+    results = {}
+    with open(os.devnull, 'w') as devnull:
+        pipeline = logs.LogPipeline('INFO', devnull, count + 1, name='bench.queue')
+        queued = logging.getLogger('bench.queue')
+        results['queue_handler_us'] = per_call(lambda: queued.info("Received TTS webhook", extra=extra))
+        pipeline.stop()
+        # The same with the listener stopped: what the calling thread itself
+        # spends, without competing for the GIL while lines are written
+        pipeline.handler.queue = queue.Queue(count + 1)
+        results['enqueue_only_us'] = per_call(lambda: queued.info("Received TTS webhook", extra=extra))
+
+        direct = logging.getLogger('bench.direct')
+        direct.propagate = False
+        direct.setLevel('INFO')
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logs.JsonFormatter())
+        direct.addHandler(handler)
+        results['synchronous_json_us'] = per_call(lambda: direct.info("Received TTS webhook", extra=extra))
+
+        def old_prints():
+            print(f"Raw payload: {payload}", file=devnull)
+            print(f"Parsed JSON data: {reading}", file=devnull)
+        results['print_payload_us'] = per_call(old_prints)
+
+        results['disabled_debug_us'] = per_call(lambda: queued.debug("Updated reading", extra=extra))
+        results['sampled_check_us'] = per_call(lambda: logs.sampled(sniff.LOG_PAYLOAD_SAMPLE_RATE))
+
+    # What the webhook logs per uplink at the default level and sample rate
+    results = {key: round(value * 1e6, 3) for key, value in results.items()}
+    per_webhook = (results['sampled_check_us'] + results['disabled_debug_us']
+                   + sniff.LOG_PAYLOAD_SAMPLE_RATE * results['queue_handler_us'])
+
+    # Lines are JSON with the extra fields, also from a forked child
+    buffer = io.StringIO()
+    read_end, write_end = os.pipe()
+    pipeline = logs.LogPipeline('INFO', buffer, 100, name='bench.check')
+    checked = logging.getLogger('bench.check')
+    checked.info("before fork", extra={'reading': reading})
+    pid = os.fork()
+    if pid == 0:
+        pipeline.output.setStream(os.fdopen(write_end, 'w'))
+        checked.info("in child", extra={'pid': os.getpid()})
+        pipeline.stop()
+        os._exit(0)
+    os.close(write_end)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_end) as child_output:
+        child_lines = child_output.read().splitlines()
+    pipeline.stop()
+    parent_lines = buffer.getvalue().splitlines()
+    assert json.loads(parent_lines[0])['reading'] == reading
+    assert json.loads(child_lines[-1])['msg'] == "in child", child_lines
+
+    reset_db()
+    client = sniff.app.test_client()
+    payloads = make_payloads(webhooks)
+    timings = []
+    with quiet():
+        for _ in range(3):
+            start = time.perf_counter()
+            for body in payloads:
+                client.post('/tts-webhook', json=body)
+            timings.append((time.perf_counter() - start) / webhooks)
+    webhook_us = statistics.median(timings) * 1e6
+
+    print(f"Logging cost per call ({count} calls, output to /dev/null)")
+    print(f"   queue handler (JSON on the listener thread): {results['queue_handler_us']:7.2f} us "
+          f"({results['enqueue_only_us']:.2f} us to enqueue, the rest is the listener sharing the GIL)")
+    print(f"   synchronous JSON handler:                    {results['synchronous_json_us']:7.2f} us")
+    print(f"   old print of raw + parsed payload:           {results['print_payload_us']:7.2f} us")
+    print(f"   disabled debug call:                         {results['disabled_debug_us']:7.2f} us")
+    print(f"   per webhook at {sniff.LOG_PAYLOAD_SAMPLE_RATE:.0%} payload sampling: {per_webhook:.2f} us "
+          f"of a {webhook_us:.0f} us webhook ({dialect_name()}, no logging queries)")
+    print("   JSON lines verified, including from a forked child")
+    assert per_webhook < 10, "logging costs more than 10 us per webhook"
+    return {**results, 'per_webhook_us': round(per_webhook, 3), 'webhook_us': round(webhook_us, 1)}
+
+def migrate_fresh(drop_indexes=()):
+    """
+    Empty the database and build the schema through the migrations
+    drop_indexes are dropped after create_all, and schema_migrations is
+    left empty, to stand in for a database created before migrations
+    """
+    import migrations
+    with sniff.app.app_context():
+        engine = sniff.db.engine
+        sniff.db.drop_all()
+        migrations.schema_migrations.drop(engine, checkfirst=True)
+        if drop_indexes:
+            sniff.db.create_all()
+            with engine.begin() as connection:
+                for name in drop_indexes:
+                    connection.execute(sniff.db.text(f"DROP INDEX IF EXISTS {name}"))
+        return sniff.schema_migrator().upgrade()
+
+def bench_plans(count=20000, min_rows=1000):
+    """
+    Migrate a database as old as the first deploy, seed count readings with
+    history and rollups, then run the app's endpoints and jobs while
+    recording every statement. EXPLAINs each one and fails on a full scan of
+    any table with at least min_rows rows. Whole-table exports (/data with
+    no bounds or cursor) are full scans by design and are left out
+    """
+    from sqlalchemy import event
+    import migrations
+
+    declared = sorted(index.name for table in sniff.db.metadata.sorted_tables for index in table.indexes)
+    start = time.perf_counter()
+    with quiet():
+        applied = migrate_fresh(drop_indexes=declared)
+    upgrade_elapsed = time.perf_counter() - start
+    with sniff.app.app_context():
+        inspector = sniff.db.inspect(sniff.db.engine)
+        present = {index['name'] for table in sniff.db.metadata.sorted_tables for index in inspector.get_indexes(table.name)}
+    missing = set(declared) - present
+    assert applied == [migration.version for migration in migrations.MIGRATIONS], applied
+    assert not missing, f"migrations left out {sorted(missing)}"
+    with sniff.app.app_context(), quiet():
+        assert migrate_fresh() == [migration.version for migration in migrations.MIGRATIONS]
+        assert sniff.schema_migrator().upgrade() == []
+
+    now = int(time.time())
+    grow_readings(1, count, window_seconds=2 * sniff.SECONDS_PER_DAY)
+    with sniff.app.app_context(), quiet():
+        rows = [sniff.reading_values(reading) for reading in sniff.AirQualityReading.query]
+        sniff.record_history(rows)
+        sniff.db.session.commit()
+        with sniff.db.engine.begin() as connection:
+            connection.execute(sniff.db.text('ANALYZE'))
+        sizes = migrations.table_sizes(sniff.db.session.connection())
+
+    statements = []
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters[0] if executemany else parameters))
+
+    client = sniff.app.test_client()
+    lat, lon = rows[0]['la'], rows[0]['lo']
+    west, south, east, north = lon - 0.01, lat - 0.01, lon + 0.01, lat + 0.01
+    z, x, y = sorted(sniff.tiles_for_point(lat, lon, [15]))[0]
+    day_ago = now - sniff.SECONDS_PER_DAY
+
+    with sniff.app.app_context():
+        engine = sniff.db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        with quiet():
+            for payload in make_payloads(20) + [create_dummy_payload(lat=lat, lon=lon)]:
+                client.post('/tts-webhook', json=payload)
+            cursor = client.get('/api/data/latest').get_json()['cursor']
+            client.get('/api/data/changes')
+            client.get(f'/api/data/changes?since={cursor}')
+            for zoom in (17, 10):
+                client.get(f'/api/data/viewport?bbox={west},{south},{east},{north}&zoom={zoom}')
+            client.get(f'/tiles/{z}/{x}/{y}.geojson')
+            client.get(f'/api/data/near?lat={lat}&lon={lon}&radius=1000&k=10')
+            client.get(f"/api/data/history?id={rows[0]['id']}")
+            client.get('/api/data/rollup?period=hour')
+            client.get(f"/api/data/rollup?period=day&id={rows[0]['id']}")
+            client.get(f"/data?table=history&after_id={rows[0]['id']}&limit=100").get_data()
+            client.get(f'/data?table=history&from={day_ago}&to={day_ago + 3600}').get_data()
+            client.get(f'/api/export.parquet?from={day_ago}&to={day_ago + 3600}').get_data()
+            client.get('/health')
+            if dialect_name() == 'postgresql':
+                # Elsewhere /metrics counts table rows exactly, a full scan by design
+                client.get('/metrics')
+            with sniff.app.app_context():
+                sniff.nearby_index_loaded = False
+                sniff.find_nearby_readings_batch([(lat, lon)])
+                sniff.check_rollups(3600, day_ago, now)
+                sniff.cleanup_old_data(days_to_keep=1)
+                store = sniff.JobStore()
+                store.finish_run(store.start_run('cleanup', store.last_slot('cleanup') or 0), 'ok', None)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    with sniff.app.app_context():
+        connection = sniff.db.session.connection()
+        problems = migrations.full_scans(connection, statements, min_rows)
+        sniff.db.session.rollback()
+
+    checked = len({statement for statement, _ in statements if statement.lstrip().upper().startswith(migrations.EXPLAINABLE)})
+    print(f"Query plans ({dialect_name()}, {count} readings, full scans allowed under {min_rows} rows)")
+    print(f"   migrated an old schema in {upgrade_elapsed:.2f}s: versions {applied}, {len(declared)} indexes present")
+    print("   table rows: " + ', '.join(f"{name} {rows}" for name, rows in sorted(sizes.items()) if rows))
+    print(f"   {checked} distinct statements explained, {len(problems)} full scans of large tables")
+    for statement, table, table_rows in problems:
+        print(f"   FULL SCAN of {table} ({table_rows} rows): {' '.join(statement.split())[:200]}")
+    if problems:
+        sys.exit(1)
+    return {'statements': checked, 'full_scans': len(problems), 'upgrade_seconds': round(upgrade_elapsed, 3)}
+
+BENCHMARKS = {
+    'ingest': bench_ingest,
+    'nearby': bench_nearby,
+    'batch': bench_batch,
+    'latest': bench_latest,
+    'stream': bench_stream,
+    'export': bench_export,
+    'frames': bench_frames,
+    'achd': bench_achd,
+    'replay': bench_replay,
+    'retention': bench_retention,
+    'scheduler': bench_scheduler,
+    'serve': bench_serve,
+    'load': bench_load,
+    'micro': bench_micro,
+    'metrics': bench_metrics,
+    'logging': bench_logging,
+    'plans': bench_plans,
+}
+
+def write_results(path, name, args, results):
+    """Save a benchmark's results as JSON, tagged with the commit, to diff between commits"""
+    import json
+    import platform
+    import subprocess
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    with open(path, 'w') as f:
+        json.dump({
+            'benchmark': name,
+            'args': args,
+            'commit': commit,
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'database': dialect_name(),
+            'results': results,
+        }, f, indent=2, sort_keys=True, default=str)
+    print(f"Results written to {path}")
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    json_path = None
+    if '--json' in argv:
+        index = argv.index('--json')
+        json_path = argv[index + 1]
+        del argv[index:index + 2]
+
+    if argv and argv[0] in BENCHMARKS:
+        args = [int(arg) for arg in argv[1:]]
+        results = BENCHMARKS[argv[0]](*args)
+        if json_path:
+            if results is None:
+                sys.exit(f"{argv[0]} has no machine-readable results")
+            write_results(json_path, argv[0], args, results)
+    else:
+        print("Usage:")
+        print("  python benchmark.py ingest [N]     - /tts-webhook msg/s, direct vs batch mode (default 2000)")
+        print("  python benchmark.py nearby [N] [Q] - grid index vs scan for find_nearby_reading, and query_near k-nearest, checked equal")
+        print("  python benchmark.py batch [N] [Q]  - NumPy batch distances and nearest-reading lookups")
+        print("  python benchmark.py latest [N] [P] - /api/data/latest full vs 304 polls, checks 304s run no queries")
+        print("  python benchmark.py stream [S] [E] - S SSE subscribers (default 1000) receiving E readings on gevent")
+        print("  python benchmark.py export [N] [P] - stream /data as NDJSON/CSV, check keyset pages and peak memory")
+        print("  python benchmark.py frames [N]     - binary frame round trips and decode throughput vs JSON text")
+        print("  python benchmark.py achd [H] [W]   - ACHD backfill of H hours from a fake CKAN server, per hour vs ranges (H >= two ranges)")
+        print("  python benchmark.py replay [H]     - ACHD import via the response cache: cold, warm, expired, offline replay")
+        print("  python benchmark.py retention [L] [D] - batched retention with daily downsampling vs one delete, under writes")
+        print("  python benchmark.py scheduler [W] [H] - W schedulers sharing jobs over H simulated hours: once per slot, catch-up, retries")
+        print("  python benchmark.py serve [S] [C] [W] - req/s over HTTP, dev server vs gunicorn (W workers), C clients for S seconds")
+        print("  python benchmark.py load [S] [P] [Q] [W] - P webhook posters and Q /api/data/latest pollers at once under gunicorn")
+        print("  python benchmark.py micro [N] [Q]  - haversine, find_nearby_reading, latest and serialization at 1k/100k/1M rows")
+        print("  python benchmark.py metrics [N] [R] - /tts-webhook with and without /metrics instrumentation, checks overhead < 2%")
+        print("  python benchmark.py logging [N] [W] - per-call cost of the JSON log queue vs synchronous logging and prints")
+        print("  python benchmark.py plans [N] [R]  - migrate an old schema, EXPLAIN every statement the app runs, fail on full scans of tables of R+ rows")
+        print("  Add --json PATH to save a benchmark's results as JSON, e.g. to diff between commits")
@@ -0,0 +1,94 @@
+"""
+Server-Sent Events fan-out for Sniff Pittsburgh
+One publisher, any number of idle subscribers
+"""
+
+import collections
+import json
+import threading
+import time
+
+class Broadcaster:
+    """
+    Fan-out of events to any number of SSE subscribers
+    Events are formatted once and kept in a shared ring buffer with increasing
+    ids. A subscriber only remembers the last id it sent and waits on a
+    shared condition, so an idle connection costs no thread or queue of its
+    own; under gevent workers each connection is just a parked greenlet.
+    Event ids are '<epoch>-<seq>', so a Last-Event-ID from an earlier process
+    is recognised as a gap instead of being compared against new sequence numbers.
+    """
+
+    def __init__(self, history=1000):
+        self.epoch = format(time.time_ns() // 1000000, 'x')
+        self.events = collections.deque(maxlen=history)  # (seq, frame)
+        self.last_seq = 0
+        self.condition = threading.Condition()
+
+    def publish(self, event, data):
+        """Format an event once and wake every waiting subscriber"""
+        with self.condition:
+            self.last_seq += 1
+            frame = f"id: {self.epoch}-{self.last_seq}\nevent: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+            self.events.append((self.last_seq, frame))
+            self.condition.notify_all()
+            return self.last_seq
+
+    def parse_event_id(self, event_id):
+        """
+        Sequence number a Last-Event-ID refers to in this process
+        Returns None when it is missing, malformed or from another process
+        """
+        epoch, _, seq = (event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def since(self, seq):
+        """
+        Frames published after seq, or None if some of them have already
+        been dropped from the ring buffer (the subscriber must resync)
+        """
+        with self.condition:
+            if seq >= self.last_seq:
+                return []
+            if not self.events or self.events[0][0] > seq + 1:
+                return None
+            # Sequence numbers are contiguous, so the newest frames are at the
+            # right end of the deque, where indexing is cheap
+            count = len(self.events)
+            return [self.events[i][1] for i in range(count - (self.last_seq - seq), count)]
+
+    def wait(self, seq, timeout):
+        """Block until something is published after seq or timeout seconds pass"""
+        with self.condition:
+            if self.last_seq <= seq:
+                self.condition.wait(timeout)
+            return self.since(seq), self.last_seq
+
+    def subscribe(self, last_event_id=None, heartbeat=15):
+        """
+        Generate the SSE stream for one client
+        Resumes after last_event_id when it is still buffered, otherwise
+        starts with a 'reset' event telling the client to reload its data
+        Sends a comment line as a heartbeat after heartbeat idle seconds
+        """
+        yield "retry: 5000\n\n"
+
+        seq = self.parse_event_id(last_event_id)
+        if seq is None or self.since(seq) is None:
+            seq = self.last_seq
+            if last_event_id:
+                yield f"id: {self.epoch}-{seq}\nevent: reset\ndata: {{}}\n\n"
+
+        while True:
+            frames, last_seq = self.wait(seq, heartbeat)
+            if frames is None:
+                # Fell behind the ring buffer
+                seq = last_seq
+                yield f"id: {self.epoch}-{seq}\nevent: reset\ndata: {{}}\n\n"
+            elif frames:
+                seq = last_seq
+                yield ''.join(frames)
+            else:
+                yield ": heartbeat\n\n"
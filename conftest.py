@@ -0,0 +1,40 @@
+"""
+Shared pytest fixtures for Sniff Pittsburgh
+The app runs on TEST_DATABASE_URL, a temporary SQLite file by default; its
+tables are dropped and recreated for every test that uses app_db.
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ['DATABASE_URL'] = os.getenv(
+    'TEST_DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+)
+
+import pytest
+
+import app as sniff
+
+@pytest.fixture
+def app_db():
+    """The app module with empty tables and empty per-process caches"""
+    with sniff.app.app_context():
+        sniff.db.drop_all()
+        sniff.db.create_all()
+    sniff.tile_cache.clear()
+    sniff.nearby_index.clear()
+    sniff.nearby_index_loaded = False
+    yield sniff
+
+@pytest.fixture
+def client(app_db):
+    return app_db.app.test_client()
+
+def make_reading(reading_id, la=40.4406, lo=-79.9959, t=None, **values):
+    """A reading dict with every READING_FIELDS key, as the write paths pass them"""
+    reading = {field: None for field in sniff.READING_FIELDS}
+    reading.update(sniff.READING_DEFAULTS)
+    reading.update({'id': reading_id, 'la': la, 'lo': lo, 't': t if t is not None else 1_700_000_000, 'pm25': 12.0})
+    reading.update(values)
+    return reading
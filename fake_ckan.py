@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Sniff Pittsburgh - local stand-in for the WPRDC CKAN API
+Answers datastore_search and datastore_search_sql for the ACHD resource with made-up but repeatable
+records, so the ACHD import can be run and timed offline:
+
+    python fake_ckan.py 8765
+    ACHD_CKAN_URL=http://localhost:8765/ python achd_data_request.py
+"""
+
+import datetime
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from achd_data_request import location_map
+
+# Parameters each fake site reports every hour, with the range of its values
+FAKE_PARAMETERS = {
+    "PM25": (0, 60),
+    "PM10": (0, 120),
+    "OUT_T": (-10, 35),
+    "OUT_RH": (20, 100),
+    "NOX": (0, 80),
+}
+
+class FakeCKAN:
+    """
+    Threaded fake CKAN server
+    empty_hours: datetime_est strings ('YYYY-MM-DDTHH:00:00') with no records
+    fail_first: how many requests for each range (keyed by its first hour)
+    fail with a 500 before it succeeds
+    latency: seconds every request takes, like a slow remote API
+    """
+
+    def __init__(self, port=0, empty_hours=(), fail_first=0, latency=0.0):
+        self.empty_hours = set(empty_hours)
+        self.fail_first = fail_first
+        self.latency = latency
+        self.attempts = {}  # first datetime_est of a request -> requests seen
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def records(self, datetime_est):
+        """Records for one hour, the same on every call"""
+        if datetime_est in self.empty_hours:
+            return []
+        hour = datetime.datetime.fromisoformat(datetime_est)
+        first_id = int(hour.replace(tzinfo=datetime.timezone.utc).timestamp()) // 3600 * 1000
+        records = []
+        for site in location_map:
+            for parameter, (low, high) in FAKE_PARAMETERS.items():
+                digest = hashlib.sha1(f"{site}|{parameter}|{datetime_est}".encode()).digest()
+                fraction = int.from_bytes(digest[:4], 'big') / 0xFFFFFFFF
+                records.append({
+                    "_id": first_id + len(records),
+                    "site": site,
+                    "parameter": parameter,
+                    "datetime_est": datetime_est,
+                    "report_value": round(low + (high - low) * fraction, 3),
+                    "is_valid": "True",
+                })
+        return records
+
+    def range_records(self, hours, parameters):
+        return [
+            record
+            for datetime_est in sorted(hours)
+            for record in self.records(datetime_est)
+            if parameters is None or record["parameter"] in parameters
+        ]
+
+    def fail(self, key):
+        """Whether this request should get a 500; counts requests per key (first hour asked for)"""
+        with self.lock:
+            self.requests += 1
+            attempt = self.attempts[key] = self.attempts.get(key, 0) + 1
+        return attempt <= self.fail_first
+
+    def datastore_search(self, data_dict):
+        filters = data_dict.get("filters", {})
+        hours = filters.get("datetime_est")
+        hours = [hours] if isinstance(hours, str) else list(hours or [])
+        if self.fail(min(hours, default=None)):
+            return 500, {"success": False, "error": {"message": "fake server error", "__type": "Internal Server Error"}}
+
+        # Like CKAN, 100 rows unless asked for more
+        offset = int(data_dict.get("offset", 0))
+        limit = int(data_dict.get("limit", 100))
+        records = self.range_records(hours, filters.get("parameter"))
+        return 200, {"success": True, "result": {"records": records[offset:offset + limit]}}
+
+    def datastore_search_sql(self, data_dict):
+        # Only understands the range query achd_data_request.search_sql builds
+        sql = data_dict.get("sql", "")
+        bounds = re.search(r'"datetime_est" >= \'([^\']+)\' AND "datetime_est" < \'([^\']+)\'', sql)
+        paging = re.search(r'LIMIT (\d+) OFFSET (\d+)', sql)
+        parameters = re.search(r'"parameter" IN \((.*?)\) AND', sql)
+        if not bounds or not paging:
+            return 409, {"success": False, "error": {"message": "fake server cannot run this query", "__type": "Validation Error"}}
+        if self.fail(bounds.group(1)):
+            return 500, {"success": False, "error": {"message": "fake server error", "__type": "Internal Server Error"}}
+
+        start = datetime.datetime.fromisoformat(bounds.group(1))
+        end = datetime.datetime.fromisoformat(bounds.group(2))
+        hours = []
+        while start < end:
+            hours.append(start.isoformat())
+            start += datetime.timedelta(hours=1)
+        limit, offset = int(paging.group(1)), int(paging.group(2))
+        records = self.range_records(hours, re.findall(r"'([^']*)'", parameters.group(1)) if parameters else None)
+        return 200, {"success": True, "result": {"records": records[offset:offset + limit]}}
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                action = {
+                    '/api/action/datastore_search': fake.datastore_search,
+                    '/api/action/datastore_search_sql': fake.datastore_search_sql,
+                }.get(self.path.rstrip('/'))
+                if action is None:
+                    self.send_json(404, {"success": False, "error": {"message": "Not found"}})
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                data_dict = json.loads(self.rfile.read(length) or b'{}')
+                if fake.latency:
+                    time.sleep(fake.latency)
+                self.send_json(*action(data_dict))
+
+            def send_json(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    fake = FakeCKAN(port=port)
+    print(f"Fake CKAN serving ACHD records at {fake.url}")
+    fake.server.serve_forever()
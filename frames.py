@@ -0,0 +1,137 @@
+"""
+Binary LoRaWAN frames for Sniff Pittsburgh
+A fixed-layout, little-endian alternative to the JSON text uplink: every
+reading field is a scaled integer, so a frame is 49 bytes instead of ~300
+"""
+
+import struct
+
+import numpy as np
+
+FRAME_VERSION = 1
+
+# (field, struct code, scale, missing code)
+# Values are stored as round(value * scale); the missing code stands for the
+# -1 / None sentinel the JSON path uses. id is the location ID the sensor
+# computes from its coordinates.
+FRAME_FIELDS = [
+    ('id', 'i', 1, None),
+    ('t', 'I', 1, 0),               # Timestamp; 0 = unknown
+    ('la', 'i', 1000000, None),     # Microdegrees; -1 is encoded as -1000000
+    ('lo', 'i', 1000000, None),
+    ('dirs', 'B', 1, None),         # lad/lod, see DIRECTION_BITS
+    ('bs', 'H', 10, 0xFFFF),
+    ('pm1', 'H', 10, 0xFFFF),
+    ('pm25', 'H', 10, 0xFFFF),
+    ('pm10', 'H', 10, 0xFFFF),
+    ('p0p3', 'H', 1, 0xFFFF),
+    ('p0p5', 'H', 1, 0xFFFF),
+    ('p1', 'H', 1, 0xFFFF),
+    ('p2p5', 'H', 1, 0xFFFF),
+    ('p5', 'H', 1, 0xFFFF),
+    ('p10', 'H', 1, 0xFFFF),
+    ('v', 'H', 1, 0xFFFF),
+    ('n', 'H', 1, 0xFFFF),
+    ('c', 'H', 1, 0xFFFF),
+    ('tmp', 'h', 10, -0x8000),
+    ('rh', 'H', 10, 0xFFFF),
+    ('src', 'B', 1, 0xFF),
+]
+
+# lad/lod share one byte: a 'present' bit and a 'S'/'W' bit for each
+DIRECTION_BITS = [('lad', 0x01, 0x02, 'N', 'S'), ('lod', 0x04, 0x08, 'E', 'W')]
+
+FRAME_STRUCT = struct.Struct('<B' + ''.join(code for _, code, _, _ in FRAME_FIELDS))
+FRAME_SIZE = FRAME_STRUCT.size
+
+NUMPY_CODES = {'i': '<i4', 'I': '<u4', 'h': '<i2', 'H': '<u2', 'B': 'u1'}
+FRAME_DTYPE = np.dtype([('version', 'u1')] + [(name, NUMPY_CODES[code]) for name, code, _, _ in FRAME_FIELDS])
+
+def encode_frame(reading):
+    """
+    Pack a reading dict (the fields of the JSON uplink) into a frame
+    Missing keys, None and -1 are sent as missing
+    """
+    values = [FRAME_VERSION]
+    for name, code, scale, missing in FRAME_FIELDS:
+        if name == 'dirs':
+            dirs = 0
+            for field, present_bit, flag_bit, _, flagged in DIRECTION_BITS:
+                value = reading.get(field)
+                if value:
+                    dirs |= present_bit | (flag_bit if value == flagged else 0)
+            values.append(dirs)
+            continue
+
+        value = reading.get(name)
+        if missing is not None and (value is None or value == -1):
+            values.append(missing)
+        else:
+            values.append(round((-1 if value is None else value) * scale))
+    return FRAME_STRUCT.pack(*values)
+
+def decode_frame(frame):
+    """
+    Unpack one frame into a reading dict shaped like the parsed JSON uplink
+    Raises ValueError for frames of the wrong size or version
+    """
+    if len(frame) != FRAME_SIZE:
+        raise ValueError(f"Frame is {len(frame)} bytes, expected {FRAME_SIZE}")
+    values = FRAME_STRUCT.unpack(frame)
+    if values[0] != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {values[0]}")
+
+    reading = {}
+    for (name, code, scale, missing), value in zip(FRAME_FIELDS, values[1:]):
+        if name == 'dirs':
+            for field, present_bit, flag_bit, plain, flagged in DIRECTION_BITS:
+                reading[field] = (flagged if value & flag_bit else plain) if value & present_bit else None
+        elif value == missing:
+            reading[name] = None if name == 't' else -1
+        else:
+            reading[name] = value / scale if scale != 1 else value
+    return reading
+
+def decode_frames(frames):
+    """
+    Vectorized decode_frame for bulk replay: frames is a list of frames or
+    one buffer of frames back to back
+    Returns a dict of NumPy column arrays (lad/lod as object arrays, t with
+    0 where unknown)
+    """
+    buffer = frames if isinstance(frames, (bytes, bytearray, memoryview)) else b''.join(frames)
+    if len(buffer) % FRAME_SIZE:
+        raise ValueError(f"Buffer of {len(buffer)} bytes is not a whole number of {FRAME_SIZE}-byte frames")
+    records = np.frombuffer(buffer, dtype=FRAME_DTYPE)
+    if len(records) and not np.all(records['version'] == FRAME_VERSION):
+        raise ValueError("Unsupported frame version in batch")
+
+    columns = {}
+    for name, code, scale, missing in FRAME_FIELDS:
+        raw = records[name]
+        if name == 'dirs':
+            for field, present_bit, flag_bit, plain, flagged in DIRECTION_BITS:
+                column = np.where(raw & flag_bit, flagged, plain).astype(object)
+                column[(raw & present_bit) == 0] = None
+                columns[field] = column
+        elif scale != 1:
+            column = raw / scale
+            if missing is not None:
+                column[raw == missing] = -1
+            columns[name] = column
+        else:
+            column = raw.astype(np.int64)
+            if missing is not None and name != 't':
+                column[raw == missing] = -1
+            columns[name] = column
+    return columns
+
+def columns_to_readings(columns):
+    """Turn decode_frames output into reading dicts, as decode_frame returns them"""
+    names = list(columns)
+    lists = [columns[name].tolist() for name in names]
+    readings = [dict(zip(names, row)) for row in zip(*lists)]
+    for reading in readings:
+        if reading['t'] == 0:
+            reading['t'] = None
+    return readings
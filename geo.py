@@ -0,0 +1,281 @@
+"""
+Geospatial helpers for Sniff Pittsburgh
+Great circle distances (scalar and NumPy batch) and an in-memory grid index
+over reading locations
+"""
+
+from math import radians, degrees, cos, sin, asin, sqrt, floor
+import threading
+
+import numpy as np
+
+# Radius of earth in meters
+EARTH_RADIUS_M = 6371000
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+    Returns distance in meters
+    """
+    # Convert decimal degrees to radians
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+
+    # Haversine formula
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a))
+
+    return c * EARTH_RADIUS_M
+
+def haversine_distances(lat1, lon1, lat2, lon2):
+    """
+    Vectorized haversine_distance: arguments are arrays (or scalars) that
+    broadcast against each other, e.g. a column of query points against a
+    row of reading coordinates
+    Returns distances in meters as a NumPy array
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    c = 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    return c * EARTH_RADIUS_M
+
+def distance_matrix(query_lats, query_lons, lats, lons):
+    """Distances in meters from every query point (rows) to every coordinate (columns)"""
+    query_lats = np.asarray(query_lats, dtype=np.float64)[:, None]
+    query_lons = np.asarray(query_lons, dtype=np.float64)[:, None]
+    return haversine_distances(query_lats, query_lons, np.asarray(lats)[None, :], np.asarray(lons)[None, :])
+
+def nearest_within(query_lats, query_lons, lats, lons, radius_meters, max_cells=4_000_000):
+    """
+    For each query point, find the nearest coordinate strictly within radius_meters
+    Returns (indices, distances): the index into lats/lons of each match, or -1
+    where nothing is in range (with distance inf)
+    Coordinates are sorted by latitude once, and queries are processed in
+    latitude order in chunks, so each distance matrix only covers the band of
+    coordinates the chunk can reach and stays under max_cells entries
+    """
+    query_lats = np.asarray(query_lats, dtype=np.float64)
+    query_lons = np.asarray(query_lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+
+    indices = np.full(len(query_lats), -1, dtype=np.int64)
+    distances = np.full(len(query_lats), np.inf)
+    if len(query_lats) == 0 or len(lats) == 0:
+        return indices, distances
+
+    order = np.argsort(lats, kind='stable')
+    sorted_lats = lats[order]
+    sorted_lons = lons[order]
+    query_order = np.argsort(query_lats, kind='stable')
+    dlat = degrees(radius_meters / EARTH_RADIUS_M)
+
+    start = 0
+    while start < len(query_order):
+        size = min(256, len(query_order) - start)
+        while True:
+            chunk = query_order[start:start + size]
+            low = np.searchsorted(sorted_lats, query_lats[chunk[0]] - dlat, side='left')
+            high = np.searchsorted(sorted_lats, query_lats[chunk[-1]] + dlat, side='right')
+            if size == 1 or size * (high - low) <= max_cells:
+                break
+            size //= 2
+        start += size
+
+        if high <= low:
+            continue
+
+        chunk_distances = distance_matrix(query_lats[chunk], query_lons[chunk], sorted_lats[low:high], sorted_lons[low:high])
+        chunk_distances[chunk_distances >= radius_meters] = np.inf
+
+        best = np.argmin(chunk_distances, axis=1)
+        best_distances = chunk_distances[np.arange(len(chunk)), best]
+        matched = np.isfinite(best_distances)
+
+        indices[chunk[matched]] = order[low + best[matched]]
+        distances[chunk[matched]] = best_distances[matched]
+
+    return indices, distances
+
+def k_nearest(lat, lon, lats, lons, k, radius_meters):
+    """
+    Up to k of the points (lats, lons) strictly within radius_meters of
+    (lat, lon), nearest first
+    Returns (indices, distances) as lists
+    """
+    distances = haversine_distances(lat, lon, lats, lons)
+    order = np.argsort(distances, kind='stable')[:k]
+    order = order[distances[order] < radius_meters]
+    return order.tolist(), distances[order].tolist()
+
+def radius_bounds(lat, radius_meters):
+    """
+    Half-height and half-width in degrees of the box enclosing a circle
+    of radius_meters around latitude lat
+    """
+    angle = radius_meters / EARTH_RADIUS_M
+    dlat = degrees(angle)
+
+    # Exact longitude extent of a spherical cap; spans everything near the poles
+    cos_lat = cos(radians(lat))
+    if angle >= radians(90) or sin(angle) >= cos_lat:
+        return dlat, 180.0
+    dlon = degrees(asin(sin(angle) / cos_lat))
+
+    return dlat, dlon
+
+class GridIndex:
+    """
+    Fixed lat/lon grid over reading locations for radius lookups
+    Each cell is cell_deg degrees on a side, so a lookup only measures the
+    readings in the cells overlapping the query circle's bounding box
+    Longitudes are not wrapped at +/-180, which is fine for a city-scale map
+    """
+
+    # Candidate sets at least this large are measured with NumPy
+    VECTORIZE_MIN = 32
+
+    def __init__(self, cell_deg=0.001):
+        self.cell_deg = cell_deg
+        self.cells = {}    # (row, col) -> {reading_id: (lat, lon, t)}
+        self.entries = {}  # reading_id -> (row, col)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def cell_for(self, lat, lon):
+        return (floor(lat / self.cell_deg), floor(lon / self.cell_deg))
+
+    def _remove(self, reading_id):
+        cell = self.entries.pop(reading_id, None)
+        if cell is None:
+            return None
+        bucket = self.cells[cell]
+        entry = bucket.pop(reading_id)
+        if not bucket:
+            del self.cells[cell]
+        return entry
+
+    def upsert(self, reading_id, lat, lon, t):
+        """
+        Add or move a reading
+        A lat or lon of None keeps the reading's indexed location, and a t of
+        None drops it, since timeless readings never match a time window
+        """
+        with self.lock:
+            previous = self._remove(reading_id)
+
+            if lat is None or lon is None:
+                if previous is None:
+                    return
+                lat, lon = previous[0], previous[1]
+            if t is None:
+                return
+
+            cell = self.cell_for(lat, lon)
+            self.cells.setdefault(cell, {})[reading_id] = (lat, lon, t)
+            self.entries[reading_id] = cell
+
+    def remove(self, reading_id):
+        with self.lock:
+            self._remove(reading_id)
+
+    def prune(self, min_t):
+        """Drop readings older than min_t; returns how many were removed"""
+        with self.lock:
+            stale = [
+                reading_id
+                for bucket in self.cells.values()
+                for reading_id, (_, _, t) in bucket.items()
+                if t < min_t
+            ]
+            for reading_id in stale:
+                self._remove(reading_id)
+            return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.cells.clear()
+            self.entries.clear()
+
+    def candidates(self, lat, lon, radius_meters):
+        """List (reading_id, lat, lon, t) for every reading in the cells the circle touches"""
+        dlat, dlon = radius_bounds(lat, radius_meters)
+        row_min, col_min = self.cell_for(lat - dlat, lon - dlon)
+        row_max, col_max = self.cell_for(lat + dlat, lon + dlon)
+
+        with self.lock:
+            # Wide queries are cheaper as a pass over the occupied cells
+            if (row_max - row_min + 1) * (col_max - col_min + 1) > len(self.cells):
+                buckets = [
+                    bucket for (row, col), bucket in self.cells.items()
+                    if row_min <= row <= row_max and col_min <= col <= col_max
+                ]
+            else:
+                buckets = [
+                    self.cells[(row, col)]
+                    for row in range(row_min, row_max + 1)
+                    for col in range(col_min, col_max + 1)
+                    if (row, col) in self.cells
+                ]
+            found = [
+                (reading_id, entry_lat, entry_lon, t)
+                for bucket in buckets
+                for reading_id, (entry_lat, entry_lon, t) in bucket.items()
+            ]
+
+        return found
+
+    def arrays(self, min_t=None):
+        """
+        Snapshot of indexed readings with t >= min_t as (ids, lats, lons)
+        NumPy arrays, for batch lookups with nearest_within
+        """
+        with self.lock:
+            entries = [
+                (reading_id, lat, lon)
+                for bucket in self.cells.values()
+                for reading_id, (lat, lon, t) in bucket.items()
+                if min_t is None or t >= min_t
+            ]
+
+        if not entries:
+            return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+        ids, lats, lons = zip(*entries)
+        return np.array(ids, dtype=np.int64), np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64)
+
+    def nearest(self, lat, lon, radius_meters, min_t=None):
+        """
+        Find the nearest reading strictly within radius_meters of (lat, lon)
+        Readings with t < min_t are ignored
+        Returns (reading_id, distance_meters), or None if nothing is in range
+        """
+        candidates = self.candidates(lat, lon, radius_meters)
+        if min_t is not None:
+            candidates = [entry for entry in candidates if entry[3] >= min_t]
+
+        if len(candidates) >= self.VECTORIZE_MIN:
+            ids, lats, lons, _ = zip(*candidates)
+            distances = haversine_distances(lat, lon, lats, lons)
+            best = int(np.argmin(distances))
+            if distances[best] < radius_meters:
+                return ids[best], float(distances[best])
+            return None
+
+        nearest_id = None
+        min_distance = float('inf')
+
+        for reading_id, entry_lat, entry_lon, t in candidates:
+            distance = haversine_distance(lat, lon, entry_lat, entry_lon)
+            if distance < radius_meters and distance < min_distance:
+                min_distance = distance
+                nearest_id = reading_id
+
+        if nearest_id is None:
+            return None
+        return nearest_id, min_distance
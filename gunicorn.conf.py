@@ -0,0 +1,90 @@
+"""
+Gunicorn settings for Sniff Pittsburgh
+
+    gunicorn -c gunicorn.conf.py
+
+Serves the website and API only. Background jobs (cleanup, ACHD import) run
+in their own process:
+
+    flask --app app run-jobs
+"""
+
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+# The settings and hooks below read .env too, as the app does
+load_dotenv()
+
+wsgi_app = 'app:create_app()'
+bind = f"0.0.0.0:{os.getenv('PORT', '80')}"
+
+# Pre-forked workers, each with a few threads; DB_POOL_SIZE should be at
+# least threads. Under gthread /api/stream answers 204 (map.js then polls),
+# since each open stream would hold a thread; with
+# GUNICORN_WORKER_CLASS=gevent every stream is a parked greenlet instead.
+workers = int(os.getenv('WEB_CONCURRENCY', str(multiprocessing.cpu_count() * 2 + 1)))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Restart each worker after a while to bound memory growth
+max_requests = 10000
+max_requests_jitter = 1000
+
+# Import the app and create tables once in the master, then fork. gevent has
+# to patch the standard library before the app is imported, so it loads the
+# app in each worker instead.
+preload_app = worker_class != 'gevent'
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')  # '-' for stdout; off by default
+errorlog = '-'
+
+def on_starting(server):
+    """Start /metrics from zero: drop samples left by an earlier run's workers"""
+    directory = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.db'):
+                os.remove(os.path.join(directory, name))
+
+def child_exit(server, worker):
+    """Stop counting a dead worker's live gauges in /metrics"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+def gevent_wait(connection, timeout=None):
+    """psycopg2 wait callback that lets other greenlets run during a query"""
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import OperationalError, extensions
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f"Bad result from poll: {state!r}")
+
+def post_fork(server, worker):
+    """Drop connections the master opened; each worker opens its own"""
+    if worker_class == 'gevent':
+        # Otherwise a PostgreSQL query blocks every other request of the worker
+        try:
+            from psycopg2 import extensions
+        except ImportError:
+            pass  # SQLite only
+        else:
+            extensions.set_wait_callback(gevent_wait)
+    if preload_app:
+        from app import app, db
+        with app.app_context():
+            db.engine.dispose(close=False)
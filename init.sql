@@ -4,7 +4,5 @@
 -- Database will be created automatically by Docker environment variables
 -- User will be created automatically by Docker environment variables
 
--- Create any additional indexes for better performance
-CREATE INDEX IF NOT EXISTS idx_air_quality_timestamp ON air_quality_readings(timestamp);
-CREATE INDEX IF NOT EXISTS idx_air_quality_device_id ON air_quality_readings(device_id);
-CREATE INDEX IF NOT EXISTS idx_air_quality_location ON air_quality_readings(latitude, longitude);
\ No newline at end of file
+-- Tables and indexes are not created here: they come from the schema
+-- migrations (migrations.py), applied with `flask --app app migrate`
@@ -0,0 +1,115 @@
+"""
+Structured logging for Sniff Pittsburgh
+Records from the 'sniff' loggers are handed to a queue and written as one
+JSON object per line by a background thread, so a request only pays for
+building the record. Fields passed with extra= become keys of the object.
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# Attributes every LogRecord has; anything else on a record came from extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg, extra fields, exc"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, separators=(',', ':'))
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread and drops
+    records instead of blocking when the queue is full
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve what cannot safely cross threads; JSON encoding happens
+        # later. The record is not shared with other handlers ('sniff' does
+        # not propagate), so it is changed in place instead of copied
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline:
+    """The queue, handler and listener behind a logger (and its children)"""
+
+    def __init__(self, level, stream, queue_size, name='sniff'):
+        self.stream = stream
+        self.queue_size = queue_size
+        self.output = logging.StreamHandler(stream)
+        self.output.setFormatter(JsonFormatter())
+        self.handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+        self.listener = None
+
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.addHandler(self.handler)
+        logger.propagate = False
+        self.start()
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.output)
+        self.listener.start()
+
+    def after_fork(self):
+        # The listener thread does not survive a fork (gunicorn preload), and
+        # a record may have been left half-taken from the old queue
+        if self.listener is None:
+            return
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+pipeline = None
+
+def setup_logging(level='INFO', stream=None, queue_size=10000):
+    """Route the 'sniff' loggers through the JSON pipeline (once per process)"""
+    global pipeline
+    if pipeline is None:
+        pipeline = LogPipeline(level, stream or sys.stdout, queue_size)
+        atexit.register(pipeline.stop)
+    return pipeline
+
+def sampled(rate):
+    """Whether to log this event, keeping about rate of them (0..1)"""
+    return rate >= 1 or (rate > 0 and random.random() < rate)
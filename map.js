@@ -10,6 +10,33 @@ L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
 // Store markers for updates
 let markers = {};
 let markerData = {}; // Store reading data for zoom updates
+let popupIds = {}; // Element id of each marker's popup content
+
+// Cursor and ETag for /api/data/changes polling
+let changesCursor = null;
+let changesEtag = null;
+
+// Last /api/data/latest response and its ETag, for conditional requests
+let latestEtag = null;
+let latestResult = null;
+
+// Fetch latest readings, sending If-None-Match so unchanged data costs a 304
+// Returns { result, changed } where changed is false when the server had nothing new
+async function fetchLatestData() {
+    const headers = latestEtag ? { 'If-None-Match': latestEtag } : {};
+    const response = await fetch('/api/data/latest', { headers, cache: 'no-store' });
+
+    if (response.status === 304 && latestResult) {
+        return { result: latestResult, changed: false };
+    }
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+    }
+
+    latestResult = await response.json();
+    latestEtag = response.headers.get('ETag');
+    return { result: latestResult, changed: true };
+}
 
 // Function to get marker size and style based on zoom level
 function getMarkerStyle(zoom) {
@@ -74,42 +101,15 @@ function updateMarkerIcons() {
     });
 }
 
-// Function to update any open popup with fresh content from database
-async function updateOpenPopups() {
-    // Check if any popups are open
-    const openPopups = Object.entries(markers).filter(([key, marker]) => {
+// Function to refresh any open popup from the stored reading data
+function updateOpenPopups() {
+    Object.entries(markers).forEach(([key, marker]) => {
         const popup = marker.getPopup();
-        return popup && popup.isOpen();
+        const reading = markerData[key];
+        if (popup && popup.isOpen() && reading) {
+            updatePopupFields(popupIds[key], reading);
+        }
     });
-    
-    if (openPopups.length === 0) {
-        return; // No open popups, skip database query
-    }
-    
-    // Fetch fresh data from database
-    try {
-        const response = await fetch('/api/data/latest');
-        const result = await response.json();
-        
-        // Update markerData with fresh readings
-        result.data.forEach(reading => {
-            const key = `${reading.id}`;
-            if (markerData[key]) {
-                markerData[key] = reading;
-            }
-        });
-        
-        // Update open popups with fresh data by updating individual fields
-        openPopups.forEach(([key, marker]) => {
-            const reading = markerData[key];
-            if (reading) {
-                const popupId = `popup-${reading.t}`;
-                updatePopupFields(popupId, reading);
-            }
-        });
-    } catch (error) {
-        console.error('Error updating popups:', error);
-    }
 }
 
 // Function to update individual fields in a popup without replacing the entire content
@@ -226,10 +226,10 @@ function updatePopupFields(popupId, reading) {
 }
 
 // Function to dynamically update marker ages and appearance
-async function updateMarkerAges() {
+function updateMarkerAges() {
     recalculateAges();
     updateMarkerIcons();
-    await updateOpenPopups();
+    updateOpenPopups();
 }
 
 // Listen for zoom events to update marker sizes
@@ -747,41 +747,57 @@ window.toggleDetails = function(popupId) {
     }
 }
 
-// Function to update map with latest data
+// Function to add a marker for a reading, or update the existing one in place
+function applyReading(reading) {
+    // Skip readings with invalid coordinates
+    if (reading.la == -1 || reading.lo == -1) {
+        return;
+    }
+
+    const key = `${reading.id}`;
+    const currentZoom = map.getZoom();
+    markerData[key] = reading;
+
+    const marker = markers[key];
+    if (!marker) {
+        // Create marker with custom icon based on current zoom level
+        markers[key] = L.marker([reading.la, reading.lo], { icon: createMarkerIcon(reading, currentZoom) })
+            .bindPopup(createPopupContent(reading))
+            .addTo(map);
+        popupIds[key] = `popup-${reading.t}`;
+        return;
+    }
+
+    marker.setLatLng([reading.la, reading.lo]);
+    marker.setIcon(createMarkerIcon(reading, currentZoom));
+
+    // Keep an open popup in place; rebuild closed ones
+    const popup = marker.getPopup();
+    if (popup && popup.isOpen()) {
+        updatePopupFields(popupIds[key], reading);
+    } else {
+        marker.setPopupContent(createPopupContent(reading));
+        popupIds[key] = `popup-${reading.t}`;
+    }
+}
+
+function setStatus(text) {
+    // Update status only if element exists
+    const statusEl = document.getElementById('status');
+    if (statusEl) {
+        statusEl.textContent = text;
+    }
+}
+
+// Function to load the map with latest data
 async function updateMap(fitBounds = false) {
     try {
-        const response = await fetch('/api/data/latest');
-        const result = await response.json();
+        const { result, changed } = await fetchLatestData();
         
-        console.log(`Received ${result.count} readings`);
+        console.log(changed ? `Received ${result.count} readings` : 'Readings unchanged');
         
-        result.data.forEach(reading => {
-            // Skip readings with invalid coordinates
-            if (reading.la == -1 || reading.lo == -1) {
-                return;
-            }
-            
-            const key = `${reading.id}`;
-            
-            // Don't create duplicate markers
-            if (markers[key]) {
-                return;
-            }
-            
-            // Store reading data for zoom updates
-            markerData[key] = reading;
-            
-            // Create custom icon based on current zoom level
-            const currentZoom = map.getZoom();
-            const icon = createMarkerIcon(reading, currentZoom);
-
-            // Create marker with custom icon
-            const marker = L.marker([reading.la, reading.lo], { icon: icon })
-                .bindPopup(createPopupContent(reading))
-                .addTo(map);
-            
-            markers[key] = marker;
-        });
+        result.data.forEach(applyReading);
+        changesCursor = result.cursor;
         
         // Fit map bounds to show all markers (only on initial load)
         if (fitBounds) {
@@ -795,30 +811,82 @@ async function updateMap(fitBounds = false) {
             }
         }
         
-        // Update status only if element exists
-        const statusEl = document.getElementById('status');
-        if (statusEl) {
-            statusEl.textContent = `Last updated: ${new Date().toLocaleTimeString()} - ${result.count} readings`;
-        }
+        setStatus(`Last updated: ${new Date().toLocaleTimeString()} - ${result.count} readings`);
         
         console.log(`Map updated with ${result.count} readings`);
             
     } catch (error) {
         console.error('Error fetching data:', error);
-        
-        // Update status only if element exists
-        const statusEl = document.getElementById('status');
-        if (statusEl) {
-            statusEl.textContent = `Error: ${error.message}`;
+        setStatus(`Error: ${error.message}`);
+    }
+}
+
+// Function to apply readings changed since the last poll
+async function pollChanges() {
+    try {
+        let more = true;
+        let applied = 0;
+
+        while (more) {
+            const params = changesCursor ? `?since=${encodeURIComponent(changesCursor)}` : '';
+            const headers = changesEtag ? { 'If-None-Match': changesEtag } : {};
+            const response = await fetch(`/api/data/changes${params}`, { headers, cache: 'no-store' });
+
+            if (response.status === 304) {
+                break; // Nothing written since the last poll
+            }
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+
+            const result = await response.json();
+            result.data.forEach(applyReading);
+            applied += result.count;
+            changesCursor = result.cursor;
+            changesEtag = result.more ? null : response.headers.get('ETag');
+            more = result.more;
+        }
+
+        setStatus(`Last updated: ${new Date().toLocaleTimeString()} - ${Object.keys(markers).length} readings`);
+
+        if (applied > 0) {
+            console.log(`Applied ${applied} changed readings`);
         }
+    } catch (error) {
+        console.error('Error fetching changes:', error);
+        setStatus(`Error: ${error.message}`);
+    }
+}
+
+// Live updates over Server-Sent Events; the browser reconnects on its own
+// and resumes from the last event id
+let stream = null;
+
+function connectStream() {
+    if (!window.EventSource) {
+        return; // Fall back to polling
     }
+
+    stream = new EventSource('/api/stream');
+
+    stream.addEventListener('reading', (event) => {
+        applyReading(JSON.parse(event.data));
+        setStatus(`Last updated: ${new Date().toLocaleTimeString()} - ${Object.keys(markers).length} readings`);
+    });
+
+    // Events were missed (server restart or slow client): reload, then catch up
+    stream.addEventListener('reset', () => {
+        updateMap(false).then(() => pollChanges());
+    });
 }
 
-// Update map every 30 seconds
 // Initial load: fit bounds to show all markers
 updateMap(true);
-// Subsequent updates: don't change zoom/center
+connectStream();
+// Subsequent updates: apply only the readings that changed, polling only
+// while the live stream is unavailable
 setInterval(() => {
-    updateMap(false);
-    updateOpenPopups(); // Refresh any open popups with latest data
+    if (!stream || stream.readyState !== EventSource.OPEN) {
+        pollChanges();
+    }
 }, 10000);
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""
+Prometheus metrics for Sniff Pittsburgh
+Metric definitions and the pieces that do not need the app: the connection
+pool that times checkouts and the /metrics exposition. Under gunicorn, set
+PROMETHEUS_MULTIPROC_DIR (an empty directory shared by the workers) so every
+worker's samples are added up in each scrape.
+"""
+
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+from sqlalchemy.pool import QueuePool
+
+# Sub-millisecond buckets: most stages of a webhook take well under 10 ms
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+RUN_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600)
+
+WEBHOOK_STAGE_SECONDS = Histogram(
+    'sniff_webhook_stage_seconds',
+    'Time spent in each stage of /tts-webhook: parse (JSON clean and parse), '
+    'lookup (existing-row lookup), commit (history write and commit) and total',
+    ['stage'], buckets=FAST_BUCKETS
+)
+WEBHOOK_STAGES = {stage: WEBHOOK_STAGE_SECONDS.labels(stage=stage) for stage in ('parse', 'lookup', 'commit', 'total')}
+
+DB_QUERY_SECONDS = Histogram('sniff_db_query_seconds', 'Duration of each database statement', buckets=FAST_BUCKETS)
+DB_QUERIES_PER_REQUEST = Histogram(
+    'sniff_db_queries_per_request', 'Database statements run by one request', ['endpoint'],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+)
+DB_SECONDS_PER_REQUEST = Histogram(
+    'sniff_db_seconds_per_request', 'Time one request spent in database statements', ['endpoint'], buckets=FAST_BUCKETS
+)
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    'sniff_db_pool_checkout_seconds',
+    'Wait for a pooled connection, including opening or pinging it', buckets=FAST_BUCKETS
+)
+
+ACHD_RUN_SECONDS = Histogram('sniff_achd_run_seconds', 'Duration of ACHD import runs', ['status'], buckets=RUN_BUCKETS)
+ACHD_ROWS_PER_RUN = Histogram(
+    'sniff_achd_rows_per_run', 'Readings imported by one ACHD run', buckets=(0, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+)
+ACHD_ROWS_IMPORTED = Counter('sniff_achd_rows_imported', 'Readings imported from ACHD')
+
+CLEANUP_RUN_SECONDS = Histogram('sniff_cleanup_run_seconds', 'Duration of retention runs', ['status'], buckets=RUN_BUCKETS)
+CLEANUP_DELETED = Counter(
+    'sniff_cleanup_deleted', 'Rows (or history partitions on Postgres) removed by retention', ['table']
+)
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout takes"""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+def exposition(collectors=()):
+    """
+    Body and content type of a /metrics response: this process's metrics, or
+    every worker's in multiprocess mode, plus collectors evaluated per scrape
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in collectors:
+            registry.register(collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+    body = generate_latest(REGISTRY)
+    if collectors:
+        registry = CollectorRegistry()
+        for collector in collectors:
+            registry.register(collector)
+        body += generate_latest(registry)
+    return body, CONTENT_TYPE_LATEST
@@ -0,0 +1,302 @@
+"""
+Schema migrations for Sniff Pittsburgh
+Numbered steps applied in order and recorded in schema_migrations, run at
+deploy time with `flask --app app migrate`. Version 1 creates the tables
+from the models, so a new database gets every declared index at once and
+later steps only bring existing databases up to date. Steps must therefore
+be safe to run against a schema that already has their change (IF NOT
+EXISTS and the like).
+
+Also here: the query plan check, which EXPLAINs statements the app ran and
+reports full scans of large tables.
+"""
+
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+
+logger = logging.getLogger('sniff.migrations')
+
+schema_metadata = sa.MetaData()
+schema_migrations = sa.Table(
+    'schema_migrations', schema_metadata,
+    sa.Column('version', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('description', sa.String(200), nullable=False),
+    sa.Column('applied_at', sa.DateTime, nullable=False),
+    sa.Column('duration', sa.Float),  # Seconds
+)
+
+class Migration:
+    """
+    One schema change: upgrade(connection, metadata) with the app's models
+    A transactional step runs in one transaction with its schema_migrations
+    row. Steps that cannot run in a transaction (CREATE INDEX CONCURRENTLY)
+    get an autocommit connection and must be safe to repeat, since a crash
+    can leave them done but unrecorded.
+    """
+
+    def __init__(self, version, description, upgrade, transactional=True):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.transactional = transactional
+
+    def __repr__(self):
+        return f'<Migration {self.version}: {self.description}>'
+
+def create_index(connection, name, table, columns, concurrently=False, method=None):
+    """
+    CREATE INDEX IF NOT EXISTS, optionally without blocking writes on Postgres
+    An interrupted concurrent build leaves an invalid index behind that
+    IF NOT EXISTS would keep, so that one is dropped and built again
+    """
+    if method:
+        table = f"{table} USING {method}"
+    if connection.dialect.name != 'postgresql':
+        connection.execute(sa.text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+        return
+
+    if concurrently:
+        valid = connection.execute(sa.text(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+        ), {'name': name}).scalar()
+        if valid is False:
+            connection.execute(sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        connection.execute(sa.text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})"))
+    else:
+        connection.execute(sa.text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+def create_partitioned_index(connection, name, table, columns):
+    """
+    Index a partitioned Postgres table without locking it against writes:
+    an (invalid) index on the parent only, then each partition's index built
+    concurrently and attached. Partitions created later get it automatically.
+    """
+    if connection.dialect.name != 'postgresql':
+        create_index(connection, name, table, columns)
+        return
+
+    connection.execute(sa.text(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} ({columns})"))
+    partitions = connection.execute(sa.text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname"
+    ), {'table': table}).scalars().all()
+    for partition in partitions:
+        partition_index = f"{partition}_{columns.replace(', ', '_')}_idx"
+        create_index(connection, partition_index, partition, columns, concurrently=True)
+        # A no-op when the partition's index is already attached
+        connection.execute(sa.text(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}"))
+
+def create_tables(connection, metadata):
+    metadata.create_all(connection)
+
+def create_earlier_indexes(connection, metadata):
+    # Declared on the models before migrations existed; create_all skips
+    # tables that already exist, so older databases may lack them
+    create_index(connection, 'idx_air_quality_created_at_id', 'air_quality_readings', 'created_at, id')
+    create_index(connection, 'idx_air_quality_la_lo', 'air_quality_readings', 'la, lo')
+    create_index(connection, 'idx_job_runs_job_slot', 'job_runs', 'job, slot')
+
+def index_reading_time(connection, metadata):
+    create_index(connection, 'idx_air_quality_t', 'air_quality_readings', 't', concurrently=True)
+    create_partitioned_index(connection, 'idx_air_quality_history_t', 'air_quality_history', 't')
+    create_index(connection, 'idx_air_quality_rollups_period_bucket', 'air_quality_rollups', 'period, bucket', concurrently=True)
+
+# Point for each reading's la/lo; NULL for readings without a location (-1)
+# and for coordinates geography would reject, so no insert fails on them
+READING_GEOGRAPHY = (
+    "CASE WHEN la BETWEEN -90 AND 90 AND lo BETWEEN -180 AND 180 AND la <> -1 AND lo <> -1 "
+    "THEN CAST(ST_SetSRID(ST_MakePoint(lo, la), 4326) AS geography) END"
+)
+
+def add_reading_geography(connection, metadata):
+    # Only where PostGIS can be installed; elsewhere radius and nearest
+    # queries stay on la/lo (see app.query_near)
+    if connection.dialect.name != 'postgresql':
+        return
+    available = connection.execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'postgis'"
+    )).scalar()
+    if not available:
+        logger.warning("PostGIS is not installed; skipping the geography column")
+        return
+
+    connection.execute(sa.text("CREATE EXTENSION IF NOT EXISTS postgis"))
+    # Adding a stored generated column rewrites the table under an exclusive
+    # lock: a few seconds for the current-state table, which holds one row
+    # per location
+    connection.execute(sa.text(
+        f"ALTER TABLE air_quality_readings ADD COLUMN IF NOT EXISTS geog geography(Point, 4326) "
+        f"GENERATED ALWAYS AS ({READING_GEOGRAPHY}) STORED"
+    ))
+    create_index(connection, 'idx_air_quality_geog', 'air_quality_readings', 'geog', concurrently=True, method='gist')
+
+def create_ingest_spool(connection, metadata):
+    metadata.tables['ingest_spool'].create(connection, checkfirst=True)
+
+def add_history_default_partition(connection, metadata):
+    # Readings for a day without a daily partition go here instead of
+    # failing; app.create_history_partitions moves them out
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(sa.text(
+        "CREATE TABLE IF NOT EXISTS air_quality_history_default PARTITION OF air_quality_history DEFAULT"
+    ))
+
+MIGRATIONS = [
+    Migration(1, 'Create tables from the models', create_tables),
+    Migration(2, 'Indexes declared before migrations', create_earlier_indexes),
+    Migration(3, 'Index readings, history and rollups by time', index_reading_time, transactional=False),
+    Migration(4, 'PostGIS geography column with a GiST index on readings', add_reading_geography, transactional=False),
+    Migration(5, 'Spool for uplinks acknowledged in batch ingestion mode', create_ingest_spool),
+    Migration(6, 'DEFAULT partition for history days without one of their own', add_history_default_partition),
+]
+
+# Serializes migration runs within a process where there is no advisory lock
+local_lock = threading.Lock()
+
+class Migrator:
+    """Applies MIGRATIONS to engine; metadata holds the app's models"""
+
+    def __init__(self, engine, metadata, migrations=MIGRATIONS):
+        self.engine = engine
+        self.metadata = metadata
+        self.migrations = sorted(migrations, key=lambda migration: migration.version)
+
+    def applied(self):
+        """{version: applied_at} of the migrations already run"""
+        with self.engine.connect() as connection:
+            if not sa.inspect(connection).has_table('schema_migrations'):
+                return {}
+            rows = connection.execute(sa.select(schema_migrations.c.version, schema_migrations.c.applied_at))
+            return dict(rows.all())
+
+    def pending(self):
+        applied = self.applied()
+        return [migration for migration in self.migrations if migration.version not in applied]
+
+    def upgrade(self):
+        """
+        Run every pending migration in order; returns the versions applied
+        Concurrent runs (several containers starting at once) wait for each
+        other on an advisory lock, then find nothing left to do
+        """
+        with self.lock():
+            schema_metadata.create_all(self.engine)
+            done = []
+            for migration in self.pending():
+                started = time.time()
+                if migration.transactional:
+                    with self.engine.begin() as connection:
+                        migration.upgrade(connection, self.metadata)
+                        self.record(connection, migration, time.time() - started)
+                else:
+                    with self.engine.connect() as connection:
+                        migration.upgrade(connection.execution_options(isolation_level='AUTOCOMMIT'), self.metadata)
+                    with self.engine.begin() as connection:
+                        self.record(connection, migration, time.time() - started)
+                done.append(migration.version)
+                logger.info("Applied migration", extra={
+                    'version': migration.version,
+                    'description': migration.description,
+                    'seconds': round(time.time() - started, 3),
+                })
+            return done
+
+    def record(self, connection, migration, duration):
+        connection.execute(schema_migrations.insert().values(
+            version=migration.version, description=migration.description,
+            applied_at=datetime.utcnow(), duration=duration
+        ))
+
+    def lock(self):
+        if self.engine.dialect.name != 'postgresql':
+            return local_lock
+        return AdvisoryLock(self.engine, 'schema_migrations')
+
+class AdvisoryLock:
+    """Session-level Postgres advisory lock held on its own connection"""
+
+    def __init__(self, engine, name):
+        self.engine = engine
+        self.name = name
+        self.connection = None
+
+    def __enter__(self):
+        self.connection = self.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        self.connection.execute(sa.text("SELECT pg_advisory_lock(hashtext(:name))"), {'name': self.name})
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.connection.execute(sa.text("SELECT pg_advisory_unlock(hashtext(:name))"), {'name': self.name})
+        finally:
+            self.connection.close()
+
+# Statements that can be EXPLAINed; DDL, locks and SELECT 1 cannot or need not be
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+def table_sizes(connection):
+    """Estimated rows of each table (Postgres statistics, or COUNT(*) elsewhere)"""
+    if connection.dialect.name == 'postgresql':
+        rows = connection.execute(sa.text(
+            "SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p') "
+            "AND relnamespace = 'public'::regnamespace"
+        ))
+        return {name: max(int(count), 0) for name, count in rows}
+    return {
+        name: connection.execute(sa.text(f'SELECT COUNT(*) FROM "{name}"')).scalar()
+        for name in sa.inspect(connection).get_table_names()
+    }
+
+def scanned_tables(connection, statement, parameters):
+    """
+    Tables a statement reads in full, from its plan: Seq Scan nodes on
+    Postgres, SCAN steps without an index on SQLite
+    statement and parameters are as the DBAPI cursor got them
+    """
+    if connection.dialect.name == 'postgresql':
+        plan = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        tables = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan':
+                tables.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        return tables
+
+    # "SCAN t" reads every row and "SCAN t USING INDEX i" every index entry,
+    # which is only cheap when a LIMIT stops it early
+    limited = ' LIMIT ' in statement.upper()
+    tables = []
+    for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters):
+        words = [word for word in row[-1].split() if word != 'TABLE']
+        if words[:1] == ['SCAN'] and len(words) > 1 and not (limited and 'USING' in words):
+            tables.append(words[1])
+    return tables
+
+def full_scans(connection, statements, min_rows):
+    """
+    Check captured (statement, parameters) pairs
+    Returns [(statement, table, rows)] for every full scan of a table
+    holding at least min_rows rows
+    """
+    sizes = table_sizes(connection)
+    problems = []
+    seen = set()
+    for statement, parameters in statements:
+        if statement in seen or not statement.lstrip().upper().startswith(EXPLAINABLE):
+            continue
+        seen.add(statement)
+        for table in scanned_tables(connection, statement, parameters):
+            if sizes.get(table, 0) >= min_rows:
+                problems.append((statement, table, sizes[table]))
+    return problems
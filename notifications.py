@@ -0,0 +1,107 @@
+"""
+Cross-process change notifications for Sniff Pittsburgh
+PostgreSQL LISTEN/NOTIFY between the gunicorn workers and the job runner.
+A writer queues a notification in the transaction that writes readings, so
+it is delivered only when, and only if, that transaction commits; every
+listening process gets the notifications of all writers in commit order.
+"""
+
+import json
+import logging
+import select
+import threading
+
+import sqlalchemy as sa
+
+logger = logging.getLogger('sniff.notifications')
+
+CHANNEL = 'sniff_changes'
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD_BYTES = 7500
+
+def change_payloads(version, rows=(), **fields):
+    """
+    JSON payloads for one change: its version, any other fields, and rows
+    split across as many payloads as it takes to keep each under
+    MAX_PAYLOAD_BYTES (every payload repeats version and fields)
+    """
+    head = {'version': version, **fields}
+    base = len(json.dumps({**head, 'rows': []}, separators=(',', ':')))
+    chunks = [[]]
+    size = base
+    for row in rows:
+        row_size = len(json.dumps(row, separators=(',', ':'))) + 1
+        if chunks[-1] and size + row_size > MAX_PAYLOAD_BYTES:
+            chunks.append([])
+            size = base
+        chunks[-1].append(row)
+        size += row_size
+    return [json.dumps({**head, 'rows': chunk}, separators=(',', ':')) for chunk in chunks]
+
+def notify_change(session, version, rows=(), **fields):
+    """Queue a change in session's transaction; listeners get it on commit"""
+    session.execute(
+        sa.text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"),
+        {'channel': CHANNEL, 'payloads': change_payloads(version, rows, **fields)}
+    )
+
+class ChangeListener:
+    """
+    Thread that LISTENs on CHANNEL over a connection of its own (engine
+    should not pool it, e.g. NullPool) and calls on_change(message) for
+    each notification, in commit order
+    on_reset() runs each time listening starts, including after a lost
+    connection: notifications sent in between are gone, so whatever they
+    would have kept current has to be rebuilt
+    """
+
+    def __init__(self, engine, on_change, on_reset, idle_seconds=30, retry_seconds=5):
+        self.engine = engine
+        self.on_change = on_change
+        self.on_reset = on_reset
+        self.idle_seconds = idle_seconds
+        self.retry_seconds = retry_seconds
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='change-listener', daemon=True)
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+            except Exception as e:
+                logger.warning("Change listener lost its connection", extra={'error': str(e)})
+            self.stopped.wait(self.retry_seconds)
+
+    def listen(self):
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.dbapi_connection
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"LISTEN {CHANNEL}")
+            self.on_reset()
+            logger.info("Listening for changes", extra={'channel': CHANNEL})
+
+            while not self.stopped.is_set():
+                if not select.select([dbapi_connection], [], [], self.idle_seconds)[0]:
+                    # Quiet for a while: make sure the connection is still there
+                    cursor.execute("SELECT 1")
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notification = dbapi_connection.notifies.pop(0)
+                    try:
+                        self.on_change(json.loads(notification.payload))
+                    except Exception:
+                        logger.exception("Failed to apply a change notification")
+        finally:
+            connection.close()
@@ -0,0 +1,136 @@
+"""
+Background job scheduler for Sniff Pittsburgh
+Runs each job at fixed wall-clock slots (every interval seconds, offset from
+the epoch), with random jitter and catch-up of slots missed while no process
+was up. Which process runs a slot is left to a store, so several workers
+can share a schedule and each slot still runs once.
+"""
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger('sniff.scheduler')
+
+class Job:
+    """
+    A function run once per slot
+    Slots start at offset + k * interval (epoch seconds), so interval=3600,
+    offset=600 runs at ten past every hour, like a cron entry. Each process
+    waits a random 0..jitter seconds into the slot before trying it.
+    With catch_up, a process that finds slots missed since the last run runs
+    the job once for all of them; without it, a slot more than grace seconds
+    old is skipped. A failed run is retried after retry_after seconds.
+    """
+
+    def __init__(self, name, func, interval, offset=0, jitter=0, catch_up=True, grace=120, retry_after=300):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.offset = offset
+        self.jitter = jitter
+        self.catch_up = catch_up
+        self.grace = grace
+        self.retry_after = retry_after
+
+        self.done_slot = None  # Latest slot known to have run
+        self.delay_slot = None  # Slot the jitter delay was drawn for
+        self.delay = 0.0
+        self.retry_at = 0.0
+
+    def slot(self, now):
+        """Start of the slot containing now"""
+        return int(now - (now - self.offset) % self.interval)
+
+class Scheduler:
+    """
+    Runs jobs on one daemon thread each
+    store provides lock(name), a context manager yielding whether this
+    process may run the job now; last_slot(name), the latest slot a run was
+    started for; start_run(name, slot) and finish_run(run, status, error).
+    """
+
+    def __init__(self, jobs, store, poll=30, clock=time.time):
+        self.jobs = {job.name: job for job in jobs}
+        self.store = store
+        self.poll = poll
+        self.clock = clock
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def tick(self, job):
+        """
+        Run job if its current slot is due and still unclaimed
+        Returns the seconds to wait before the next check
+        """
+        now = self.clock()
+        slot = job.slot(now)
+        next_slot = slot + job.interval
+        if job.done_slot is not None and job.done_slot >= slot:
+            return max(0.0, min(self.poll, next_slot - now))
+        if now < job.retry_at:
+            return min(self.poll, job.retry_at - now)
+
+        if job.delay_slot != slot:
+            job.delay_slot = slot
+            job.delay = random.uniform(0, job.jitter)
+        if now < slot + job.delay:
+            return min(self.poll, slot + job.delay - now)
+
+        with self.store.lock(job.name) as acquired:
+            if not acquired:
+                # Another process is running it; look again once it may be done
+                return self.poll
+
+            last = self.store.last_slot(job.name)
+            if last is not None and last >= slot:
+                job.done_slot = last
+                return max(0.0, min(self.poll, next_slot - now))
+
+            missed = 0 if last is None else (slot - last) // job.interval - 1
+            if not job.catch_up and now - slot > job.grace:
+                logger.info("Skipping late job run", extra={'job': job.name, 'slot': slot, 'late': int(now - slot)})
+                job.done_slot = slot
+                return max(0.0, min(self.poll, next_slot - now))
+            if missed > 0:
+                logger.info("Catching up missed job runs", extra={'job': job.name, 'missed': missed, 'last_slot': last})
+
+            run = self.store.start_run(job.name, slot)
+            started = time.time()
+            try:
+                job.func()
+            except Exception as e:
+                logger.error("Job failed", extra={
+                    'job': job.name, 'slot': slot, 'seconds': round(time.time() - started, 3), 'error': str(e)
+                })
+                self.store.finish_run(run, 'failed', str(e))
+                job.retry_at = self.clock() + job.retry_after
+                return min(self.poll, job.retry_after)
+
+            self.store.finish_run(run, 'ok', None)
+            job.done_slot = slot
+            logger.info("Job finished", extra={'job': job.name, 'slot': slot, 'seconds': round(time.time() - started, 3)})
+            return max(0.0, min(self.poll, next_slot - self.clock()))
+
+    def loop(self, job):
+        while not self.stopped.is_set():
+            try:
+                delay = self.tick(job)
+            except Exception:
+                # The store itself failed, e.g. the database is unreachable
+                logger.exception("Scheduler error", extra={'job': job.name})
+                delay = self.poll
+            self.stopped.wait(delay)
+
+    def start(self):
+        for job in self.jobs.values():
+            thread = threading.Thread(target=self.loop, args=(job,), daemon=True, name=f'job-{job.name}')
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
@@ -0,0 +1,39 @@
+"""
+Tests for binary LoRaWAN frames: encode/decode round trips with the scalar
+and NumPy decoders, and a frame posted through /tts-webhook
+"""
+
+import base64
+import json
+
+import pytest
+
+from frames import FRAME_SIZE, columns_to_readings, decode_frame, decode_frames, encode_frame
+from test_webhook import create_dummy_payload
+
+@pytest.fixture
+def readings():
+    payloads = [create_dummy_payload(lat=round(40.44 + index * 1e-3, 4), lon=round(-79.99 - index * 1e-3, 4)) for index in range(20)]
+    readings = [json.loads(payload["uplink_message"]["decoded_payload"]["text"]) for payload in payloads]
+    # Missing values and directions must survive too
+    readings[0].update({'t': None, 'la': -1, 'lo': -1, 'lad': None, 'lod': 'E', 'pm25': -1, 'tmp': -12.5, 'src': 0})
+    return readings
+
+def test_scalar_round_trip(readings):
+    for reading in readings:
+        frame = encode_frame(reading)
+        assert len(frame) == FRAME_SIZE
+        assert decode_frame(frame) == reading
+
+def test_batch_round_trip(readings):
+    assert columns_to_readings(decode_frames([encode_frame(reading) for reading in readings])) == readings
+
+def test_webhook_stores_a_frame(app_db, client, readings):
+    sniff = app_db
+    reading = readings[1]
+    payload = {"uplink_message": {"f_port": sniff.FRAME_FPORT, "frm_payload": base64.b64encode(encode_frame(reading)).decode()}}
+    assert sniff.parse_tts_payload(payload) == reading
+
+    assert client.post('/tts-webhook', json=payload).status_code == 200
+    with sniff.app.app_context():
+        assert sniff.reading_values(sniff.db.session.get(sniff.AirQualityReading, reading['id'])) == reading
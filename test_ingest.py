@@ -0,0 +1,78 @@
+"""
+Tests for batch ingestion: uplinks are spooled before they are acknowledged
+and every acknowledged uplink is eventually written
+"""
+
+import pytest
+
+from test_webhook import create_dummy_payload
+
+class RunningThread:
+    def is_alive(self):
+        return True
+
+@pytest.fixture
+def batch_mode(app_db, monkeypatch):
+    monkeypatch.setattr(app_db, 'INGEST_MODE', 'batch')
+    # The tests flush by hand: keep the background flusher from starting
+    monkeypatch.setattr(app_db, 'ingest_thread', RunningThread())
+    monkeypatch.setattr(app_db, 'spool_backlog', 0)
+    return app_db
+
+def spooled(sniff):
+    with sniff.app.app_context():
+        return sniff.IngestSpool.query.count()
+
+def readings(sniff):
+    with sniff.app.app_context():
+        return sniff.AirQualityReading.query.count()
+
+def test_acknowledged_uplinks_are_spooled(batch_mode, client):
+    sniff = batch_mode
+    for lat in (40.44, 40.45, 40.46):
+        response = client.post('/tts-webhook', json=create_dummy_payload(lat=lat, lon=-79.99))
+        assert response.status_code == 202
+
+    # Nothing is written yet, but nothing lives only in memory either
+    assert spooled(sniff) == 3
+    assert readings(sniff) == 0
+
+    assert sniff.flush_spool(batch_size=2) == 2
+    assert sniff.flush_spool(batch_size=2) == 1
+    assert sniff.flush_spool(batch_size=2) == 0
+    assert spooled(sniff) == 0
+    assert readings(sniff) == 3
+
+def test_failed_flush_keeps_the_batch(batch_mode, client, monkeypatch):
+    sniff = batch_mode
+    client.post('/tts-webhook', json=create_dummy_payload(lat=40.44, lon=-79.99))
+
+    def fail(readings, checkpoint=None):
+        raise RuntimeError("database went away")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(sniff, 'upsert_readings', fail)
+        with pytest.raises(RuntimeError):
+            sniff.flush_spool()
+    assert spooled(sniff) == 1
+
+    assert sniff.flush_spool() == 1
+    assert spooled(sniff) == 0
+    assert readings(sniff) == 1
+
+def test_full_spool_answers_503(batch_mode, client, monkeypatch):
+    sniff = batch_mode
+    monkeypatch.setattr(sniff, 'spool_backlog', sniff.INGEST_QUEUE_SIZE)
+    response = client.post('/tts-webhook', json=create_dummy_payload(lat=40.44, lon=-79.99))
+    assert response.status_code == 503
+    assert spooled(sniff) == 0
+
+def test_unwritable_spool_answers_503(batch_mode, client, monkeypatch):
+    sniff = batch_mode
+
+    def fail(reading_data):
+        raise RuntimeError("database went away")
+
+    monkeypatch.setattr(sniff, 'enqueue_reading', fail)
+    response = client.post('/tts-webhook', json=create_dummy_payload(lat=40.44, lon=-79.99))
+    assert response.status_code == 503
@@ -0,0 +1,61 @@
+"""
+Tests for conditional GETs of /api/data/latest: a matching ETag is answered
+with 304 without touching the database, and any write changes the ETag
+"""
+
+import contextlib
+
+from sqlalchemy import event
+
+from test_webhook import create_dummy_payload
+
+@contextlib.contextmanager
+def count_queries(sniff):
+    """Count SQL statements sent to the database inside the block"""
+    counter = {'queries': 0}
+
+    def before_cursor_execute(*args):
+        counter['queries'] += 1
+
+    with sniff.app.app_context():
+        engine = sniff.db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+def test_not_modified_runs_no_queries(app_db, client):
+    client.post('/tts-webhook', json=create_dummy_payload())
+    first = client.get('/api/data/latest')
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and etag
+
+    with count_queries(app_db) as counter:
+        for _ in range(5):
+            assert client.get('/api/data/latest', headers={'If-None-Match': etag}).status_code == 304
+    assert counter['queries'] == 0
+
+def test_write_changes_the_etag(app_db, client):
+    etag = client.get('/api/data/latest').headers['ETag']
+    assert client.post('/tts-webhook', json=create_dummy_payload()).status_code == 200
+
+    response = client.get('/api/data/latest', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(response.get_json()['data']) == 1
+
+def test_changes_resume_after_the_cursor(app_db, client):
+    sniff = app_db
+    with sniff.app.app_context():
+        created_at = sniff.datetime(2026, 1, 1, 12)
+        for reading_id in (1, 2, 3):
+            sniff.db.session.add(sniff.AirQualityReading(id=reading_id, la=40.44, lo=-79.99, t=1_700_000_000, created_at=created_at))
+        sniff.db.session.add(sniff.AirQualityReading(id=4, la=40.44, lo=-79.99, t=1_700_000_000, created_at=created_at.replace(hour=13)))
+        sniff.db.session.commit()
+
+    # Rows sharing the cursor's created_at are split by id
+    first = client.get('/api/data/changes?limit=2').get_json()
+    assert [reading['id'] for reading in first['data']] == [1, 2] and first['more']
+    rest = client.get('/api/data/changes', query_string={'since': first['cursor']}).get_json()
+    assert [reading['id'] for reading in rest['data']] == [3, 4]
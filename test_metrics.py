@@ -0,0 +1,53 @@
+"""
+Tests for the /metrics instrumentation: what one webhook records, and that
+METRICS_ENABLED=0 records nothing
+"""
+
+from test_webhook import create_dummy_payload
+
+WEBHOOK = {'endpoint': 'handle_tts_webhook'}
+
+def sample(sniff, name, labels=None):
+    return sniff.metrics.REGISTRY.get_sample_value(name, labels or {}) or 0
+
+def snapshot(sniff):
+    return {
+        'requests': sample(sniff, 'sniff_db_queries_per_request_count', WEBHOOK),
+        'queries': sample(sniff, 'sniff_db_queries_per_request_sum', WEBHOOK),
+        'statements': sample(sniff, 'sniff_db_query_seconds_count'),
+        'totals': sample(sniff, 'sniff_webhook_stage_seconds_count', {'stage': 'total'}),
+    }
+
+def test_webhook_records_statements_and_stages(app_db, client):
+    before = snapshot(app_db)
+    assert client.post('/tts-webhook', json=create_dummy_payload()).status_code == 200
+    after = snapshot(app_db)
+
+    assert after['requests'] - before['requests'] == 1
+    queries = after['queries'] - before['queries']
+    assert queries > 0
+    # Every statement of the request is also timed on its own
+    assert after['statements'] - before['statements'] >= queries
+    assert after['totals'] - before['totals'] == 1
+
+def test_statements_outside_requests_are_not_counted(app_db, client):
+    client.post('/tts-webhook', json=create_dummy_payload())
+    assert app_db.request_statements.get() is None
+    before = snapshot(app_db)
+    with app_db.app.app_context():
+        app_db.AirQualityReading.query.count()
+    after = snapshot(app_db)
+    assert after['statements'] - before['statements'] == 1
+    assert after['queries'] == before['queries']
+
+def test_disabled_records_nothing(app_db, client, monkeypatch):
+    monkeypatch.setattr(app_db, 'METRICS_ENABLED', False)
+    before = snapshot(app_db)
+    assert client.post('/tts-webhook', json=create_dummy_payload()).status_code == 200
+    assert snapshot(app_db) == before
+
+def test_metrics_endpoint(app_db, client):
+    client.post('/tts-webhook', json=create_dummy_payload())
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'sniff_webhook_stage_seconds_bucket' in body
+    assert 'sniff_db_queries_per_request_count{endpoint="handle_tts_webhook"}' in body
@@ -0,0 +1,71 @@
+"""
+Tests for nearest-reading lookups: the grid index, the batch API and
+query_near against brute-force measurement of every row
+"""
+
+import random
+import time
+
+import numpy as np
+import pytest
+
+from conftest import make_reading
+from geo import haversine_distance, haversine_distances
+
+@pytest.fixture
+def seeded(app_db):
+    """300 recent readings scattered around Pittsburgh, some closer than 50 m"""
+    sniff = app_db
+    rng = random.Random(0)
+    now = int(time.time())
+    rows = []
+    for reading_id in range(1, 301):
+        rows.append(make_reading(
+            reading_id, la=40.44 + rng.uniform(-0.01, 0.01), lo=-79.99 + rng.uniform(-0.01, 0.01),
+            t=now - rng.randint(0, 3600), src=2
+        ))
+    # One stale reading, which lookups must ignore
+    rows.append(make_reading(301, la=40.44, lo=-79.99, t=now - sniff.NEARBY_WINDOW_SECONDS - 60, src=2))
+    with sniff.app.app_context():
+        sniff.db.session.execute(sniff.AirQualityReading.__table__.insert(), rows)
+        sniff.db.session.commit()
+    points = [(40.44 + rng.uniform(-0.011, 0.011), -79.99 + rng.uniform(-0.011, 0.011)) for _ in range(100)]
+    return sniff, rows, points
+
+def ids(readings):
+    return [reading and reading.id for reading in readings]
+
+@pytest.mark.parametrize('radius', [50, 500, 5000])
+def test_grid_index_matches_scan(seeded, radius):
+    sniff, _, points = seeded
+    with sniff.app.app_context():
+        scanned = [sniff.find_nearby_reading_scan(lat, lon, radius) for lat, lon in points]
+        indexed = [sniff.find_nearby_reading(lat, lon, radius) for lat, lon in points]
+    assert ids(indexed) == ids(scanned)
+    assert any(scanned) and 301 not in ids(scanned)
+
+@pytest.mark.parametrize('radius', [50, 500])
+def test_batch_matches_single_lookups(seeded, radius):
+    sniff, _, points = seeded
+    with sniff.app.app_context():
+        single = [sniff.find_nearby_reading(lat, lon, radius) for lat, lon in points]
+        batch = sniff.find_nearby_readings_batch(points, radius)
+    assert ids(batch) == ids(single)
+
+@pytest.mark.parametrize('radius, k', [(500, 10), (5000, 100)])
+def test_query_near_matches_brute_force(seeded, radius, k):
+    sniff, rows, points = seeded
+    with sniff.app.app_context():
+        for lat, lon in points:
+            distances = haversine_distances(lat, lon, [row['la'] for row in rows], [row['lo'] for row in rows])
+            expected = sorted((distance, row['id']) for row, distance in zip(rows, distances) if distance < radius)[:k]
+            assert [reading.id for reading, _ in sniff.query_near(lat, lon, radius, k)] == [
+                reading_id for _, reading_id in expected
+            ]
+
+def test_vector_haversine_matches_scalar():
+    rng = random.Random(1)
+    points = [(40.44 + rng.uniform(-0.1, 0.1), -79.99 + rng.uniform(-0.1, 0.1)) for _ in range(200)]
+    scalar = [haversine_distance(lat, lon, 40.4406, -79.9959) for lat, lon in points]
+    vector = haversine_distances(np.array([lat for lat, _ in points]), np.array([lon for _, lon in points]), 40.4406, -79.9959)
+    assert np.allclose(scalar, vector, rtol=0, atol=1e-6)
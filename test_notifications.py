@@ -0,0 +1,183 @@
+"""
+Tests for cross-process change notifications: payload splitting, applying
+changes to a process's caches, and the reset after the listener reconnects
+"""
+
+import json
+import socket
+
+from conftest import make_reading
+from notifications import CHANNEL, MAX_PAYLOAD_BYTES, ChangeListener, change_payloads, notify_change
+from tiles import tiles_for_point
+
+def test_payloads_split_under_the_limit():
+    rows = [make_reading(reading_id, la=40.44 + reading_id * 1e-4, src='achd') for reading_id in range(500)]
+    payloads = change_payloads('v1', rows)
+
+    assert len(payloads) > 1
+    assert all(len(payload.encode()) < MAX_PAYLOAD_BYTES for payload in payloads)
+    messages = [json.loads(payload) for payload in payloads]
+    assert all(message['version'] == 'v1' for message in messages)
+    assert [row for message in messages for row in message['rows']] == rows
+
+def test_payload_without_rows():
+    assert [json.loads(payload) for payload in change_payloads('v2', deleted=True)] == [
+        {'version': 'v2', 'deleted': True, 'rows': []}
+    ]
+
+def test_notify_change_sends_every_payload():
+    class Session:
+        def execute(self, statement, parameters):
+            self.parameters = parameters
+
+    session = Session()
+    rows = [make_reading(reading_id) for reading_id in range(100)]
+    notify_change(session, 'v3', rows)
+    assert session.parameters['channel'] == CHANNEL
+    assert session.parameters['payloads'] == change_payloads('v3', rows)
+
+def cached_tile(sniff, reading):
+    """Cache a tile holding reading's location and return its key"""
+    key = min(tiles_for_point(reading['la'], reading['lo'], [12]))
+    sniff.tile_cache.put(key, ('{}', 'etag'))
+    return key
+
+def test_apply_readings(app_db):
+    sniff = app_db
+    reading = make_reading(7, t=sniff.time.time())
+    key = cached_tile(sniff, reading)
+    sniff.nearby_index_loaded = True
+    last_seq = sniff.reading_stream.last_seq
+
+    sniff.apply_readings([reading], 'v1')
+
+    assert sniff.data_etag() == 'v1'
+    assert sniff.tile_cache.get(key) is None
+    assert sniff.nearby_index.nearest(reading['la'], reading['lo'], 10)[0] == 7
+    frames = sniff.reading_stream.since(last_seq)
+    assert len(frames) == 1 and 'event: reading' in frames[0] and '"id":7' in frames[0]
+
+def test_apply_change_from_payloads(app_db):
+    sniff = app_db
+    rows = [make_reading(reading_id, la=40.44 + reading_id * 1e-4) for reading_id in range(300)]
+    last_seq = sniff.reading_stream.last_seq
+
+    for payload in change_payloads('v2', rows):
+        sniff.apply_change(json.loads(payload))
+
+    assert sniff.data_etag() == 'v2'
+    assert sniff.reading_stream.last_seq - last_seq == len(rows)
+
+def test_apply_deletes(app_db):
+    sniff = app_db
+    key = cached_tile(sniff, make_reading(1))
+    stale = sniff.time.time() - sniff.NEARBY_WINDOW_SECONDS - 60
+    sniff.nearby_index.upsert(1, 40.44, -79.99, stale)
+
+    sniff.apply_change({'version': 'v4', 'deleted': True, 'rows': []})
+
+    assert sniff.data_etag() == 'v4'
+    assert sniff.tile_cache.get(key) is None
+    assert len(sniff.nearby_index) == 0
+
+def test_changes_missed_resets_the_process(app_db):
+    sniff = app_db
+    sniff.apply_readings([make_reading(1)], 'v5')
+    key = cached_tile(sniff, make_reading(1))
+    sniff.nearby_index_loaded = True
+    last_seq = sniff.reading_stream.last_seq
+
+    sniff.changes_missed()
+
+    # A version of this process's own, which no other worker hands out
+    assert sniff.data_etag() != 'v5'
+    assert sniff.data_etag().startswith(sniff.DATA_VERSION_EPOCH + '-')
+    assert sniff.tile_cache.get(key) is None
+    assert not sniff.nearby_index_loaded
+    assert 'event: reset' in sniff.reading_stream.since(last_seq)[0]
+
+class FakeNotify:
+    def __init__(self, payload):
+        self.payload = payload
+
+class FakeConnection:
+    """
+    psycopg2-like connection that is always readable and hands out one
+    queued notification per poll(), then fails as a dropped connection does
+    """
+
+    def __init__(self, payloads):
+        self.reader, self.writer = socket.socketpair()
+        self.writer.send(b'x')
+        self.pending = list(payloads)
+        self.notifies = []
+        self.statements = []
+        self.autocommit = False
+        self.closed = False
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        self.statements.append(statement)
+
+    def poll(self):
+        if not self.pending:
+            raise ConnectionError("server closed the connection unexpectedly")
+        self.notifies.append(FakeNotify(self.pending.pop(0)))
+
+    # The pool's wrapper, as engine.raw_connection() returns it
+    @property
+    def dbapi_connection(self):
+        return self
+
+    def close(self):
+        self.closed = True
+        self.reader.close()
+        self.writer.close()
+
+class FakeEngine:
+    def __init__(self, connections):
+        self.connections = list(connections)
+
+    def raw_connection(self):
+        return self.connections.pop(0)
+
+def test_listener_resets_after_reconnecting():
+    events = []
+
+    def on_change(message):
+        events.append(('change', message['version']))
+        if message['version'] == 'last':
+            listener.stop()
+
+    first = FakeConnection([json.dumps({'version': 'a', 'rows': []}), json.dumps({'version': 'b', 'rows': []})])
+    second = FakeConnection([json.dumps({'version': 'last', 'rows': []})])
+    listener = ChangeListener(
+        FakeEngine([first, second]), on_change, lambda: events.append(('reset',)), idle_seconds=1, retry_seconds=0
+    )
+    listener.run()
+
+    assert events == [('reset',), ('change', 'a'), ('change', 'b'), ('reset',), ('change', 'last')]
+    assert first.statements == [f"LISTEN {CHANNEL}"] and first.autocommit and first.closed
+    assert second.closed
+
+def test_listener_survives_a_bad_notification():
+    events = []
+
+    def on_change(message):
+        events.append(message['version'])
+        if message['version'] == 'last':
+            listener.stop()
+
+    connection = FakeConnection(['not json', json.dumps({'version': 'last', 'rows': []})])
+    listener = ChangeListener(FakeEngine([connection]), on_change, lambda: None, retry_seconds=0)
+    listener.run()
+    assert events == ['last']
+
+def test_stream_off_without_gevent(app_db, client, monkeypatch):
+    monkeypatch.setattr(app_db, 'STREAM_ENABLED', '')
+    assert client.get('/api/stream').status_code == 204
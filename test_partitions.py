@@ -0,0 +1,69 @@
+"""
+Tests for daily history partitions on PostgreSQL (set TEST_DATABASE_URL):
+writes never need a partition to exist, and the partitions job gives
+readings that landed in the DEFAULT partition a partition of their own
+"""
+
+import time
+
+import pytest
+
+import migrations
+from conftest import make_reading
+
+@pytest.fixture
+def partitioned(app_db):
+    sniff = app_db
+    with sniff.app.app_context():
+        if sniff.db.engine.dialect.name != 'postgresql':
+            pytest.skip("history is only partitioned on PostgreSQL")
+        with sniff.db.engine.begin() as connection:
+            migrations.add_history_default_partition(connection, sniff.db.metadata)
+    return sniff
+
+def count(sniff, table, day_start=None):
+    condition = f" WHERE t >= {day_start} AND t < {day_start + sniff.SECONDS_PER_DAY}" if day_start is not None else ""
+    return sniff.db.session.execute(sniff.db.text(f"SELECT count(*) FROM {table}{condition}")).scalar()
+
+def write_history(sniff, rows):
+    with sniff.app.app_context():
+        sniff.record_history(rows)
+        sniff.db.session.commit()
+
+def test_backdated_write_moves_into_its_own_partition(partitioned):
+    sniff = partitioned
+    now = int(time.time())
+    day_start = now - now % sniff.SECONDS_PER_DAY - 5 * sniff.SECONDS_PER_DAY
+    write_history(sniff, [make_reading(1, t=day_start + 60), make_reading(2, t=day_start + 120)])
+
+    with sniff.app.app_context():
+        assert count(sniff, sniff.HISTORY_DEFAULT_PARTITION) == 2
+        assert day_start not in sniff.history_partition_days()
+
+    # Today, the days ahead and the backdated day
+    assert sniff.create_history_partitions(days_ahead=2) == 4
+    assert sniff.create_history_partitions(days_ahead=2) == 0
+
+    with sniff.app.app_context():
+        assert count(sniff, sniff.HISTORY_DEFAULT_PARTITION) == 0
+        assert count(sniff, sniff.history_partition_name(day_start)) == 2
+        assert sniff.AirQualityHistory.query.count() == 2
+
+    # Later writes for the day go straight to its partition
+    write_history(sniff, [make_reading(3, t=day_start + 180)])
+    with sniff.app.app_context():
+        assert count(sniff, sniff.history_partition_name(day_start)) == 3
+
+def test_retention_clears_expired_default_rows(partitioned):
+    sniff = partitioned
+    now = int(time.time())
+    expired = now - 40 * sniff.SECONDS_PER_DAY
+    write_history(sniff, [make_reading(1, t=expired), make_reading(2, t=now)])
+
+    sniff.cleanup_old_data(days_to_keep=30)
+
+    with sniff.app.app_context():
+        assert count(sniff, sniff.HISTORY_DEFAULT_PARTITION) == 1
+        assert sniff.retention_status['history_default_deleted'] == 1
+        # The expired day was downsampled before its readings went
+        assert sniff.AirQualityRollup.query.filter_by(id=1, period=sniff.SECONDS_PER_DAY).count() == 1
@@ -2,6 +2,7 @@ import requests
 import json
 import time
 import random
+import base64
 
 # Your webhook URL
 WEBHOOK_URL = "http://localhost/tts-webhook"
@@ -111,6 +112,19 @@ def create_dummy_payload(timestamp=None, lat=None, lon=None, pm25=None):
     
     return tts_payload
 
+def create_binary_payload(timestamp=None, lat=None, lon=None, pm25=None):
+    """Create a dummy TTS webhook payload carrying a binary frame (see frames.py)"""
+    from frames import encode_frame
+
+    sensor_data = json.loads(create_dummy_payload(timestamp, lat, lon, pm25)["uplink_message"]["decoded_payload"]["text"])
+
+    return {
+        "uplink_message": {
+            "f_port": 2,
+            "frm_payload": base64.b64encode(encode_frame(sensor_data)).decode()
+        }
+    }
+
 def send_dummy_data():
     """Send a dummy POST request to the webhook"""
     print("🚀 Sending dummy data to webhook...")
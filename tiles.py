@@ -0,0 +1,117 @@
+"""
+Slippy map tile helpers for Sniff Pittsburgh
+Tile coordinate math and an LRU cache of rendered tiles
+"""
+
+from collections import OrderedDict
+from math import atan, sinh, pi, degrees, radians, log, tan, cos, floor
+import threading
+import time
+
+# Web Mercator cannot represent the poles
+MAX_LATITUDE = 85.0511287798
+
+def tile_bounds(z, x, y):
+    """(west, south, east, north) in degrees of tile x/y at zoom z"""
+    n = 2 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = degrees(atan(sinh(pi * (1 - 2 * y / n))))
+    south = degrees(atan(sinh(pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+def tile_for(lat, lon, z):
+    """(x, y) of the tile at zoom z containing a point"""
+    n = 2 ** z
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    x = floor((lon + 180) / 360 * n)
+    y = floor((1 - log(tan(radians(lat)) + 1 / cos(radians(lat))) / pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tiles_for_point(lat, lon, zooms, margin=1e-7):
+    """
+    Every (z, x, y) whose tile may contain a point at one of the zooms
+    A point within margin degrees of a tile edge counts for the tiles on
+    both sides, since tile queries include their edges
+    """
+    tiles = set()
+    for z in zooms:
+        for dlat in (-margin, margin):
+            for dlon in (-margin, margin):
+                tiles.add((z, *tile_for(lat + dlat, lon + dlon, z)))
+    return tiles
+
+class TileCache:
+    """
+    Thread-safe LRU cache of rendered tiles keyed by (z, x, y)
+    Entries are dropped when a reading lands in their tile, and also expire
+    after ttl seconds so caches in other processes do not stay stale
+    """
+
+    def __init__(self, max_entries=5000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (z, x, y) -> (expires_at, value)
+        self.pending = {}  # (z, x, y) -> token of the render in progress
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def reserve(self, key):
+        """
+        Call before rendering a tile from the database; pass the token to put
+        so a render that raced with an invalidation is not cached
+        """
+        token = object()
+        with self.lock:
+            self.pending[key] = token
+        return token
+
+    def put(self, key, value, token=None):
+        """Cache a rendered tile; returns False if it was invalidated while rendering"""
+        with self.lock:
+            if token is not None:
+                if self.pending.get(key) is not token:
+                    return False
+                del self.pending[key]
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True
+
+    def release(self, key, token):
+        """Give up a reservation whose render failed"""
+        with self.lock:
+            if self.pending.get(key) is token:
+                del self.pending[key]
+
+    def invalidate(self, keys):
+        """Drop the given tiles; returns how many were cached"""
+        with self.lock:
+            dropped = 0
+            for key in keys:
+                self.pending.pop(key, None)
+                if self.entries.pop(key, None) is not None:
+                    dropped += 1
+            return dropped
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.entries.clear()